@@ -1,5 +1,5 @@
 import os
-from typing import TYPE_CHECKING
+from typing import TYPE_CHECKING, List
 
 import torch
 from toolkit.config_modules import GenerateImageConfig, ModelConfig
@@ -309,6 +309,31 @@ class ChromaModel(BaseModel):
         ).images[0]
         return img
 
+    def generate_batched_images(
+        self,
+        pipeline: ChromaPipeline,
+        gen_configs: List[GenerateImageConfig],
+        conditional_embeds: PromptEmbeds,
+        unconditional_embeds: PromptEmbeds,
+        generators: List[torch.Generator],
+        extra: dict,
+    ):
+        # all configs share size, steps and guidance
+        extra['negative_prompt_embeds'] = unconditional_embeds.text_embeds
+        extra['negative_prompt_attn_mask'] = unconditional_embeds.attention_mask
+
+        images = pipeline(
+            prompt_embeds=conditional_embeds.text_embeds,
+            prompt_attn_mask=conditional_embeds.attention_mask,
+            height=gen_configs[0].height,
+            width=gen_configs[0].width,
+            num_inference_steps=gen_configs[0].num_inference_steps,
+            guidance_scale=gen_configs[0].guidance_scale,
+            generator=generators,
+            **extra
+        ).images
+        return images
+
     def get_noise_prediction(
         self,
         latent_model_input: torch.Tensor,
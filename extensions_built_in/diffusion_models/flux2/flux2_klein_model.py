@@ -62,6 +62,12 @@ class Flux2KleinModel(Flux2Model):
                 text_encoder,
                 self.device_torch,
                 offload_percent=self.model_config.layer_offloading_text_encoder_percent,
+                vram_budget_gb=self.model_config.layer_offloading_text_encoder_vram_gb,
+                pinned_ram_gb=self.model_config.layer_offloading_text_encoder_pinned_ram_gb,
+                tiers=self.model_config.layer_offloading_tiers,
+                disk_path=self.model_config.layer_offloading_disk_path,
+                prefetch_layers=self.model_config.layer_offloading_prefetch,
+                prefetch_buffers=self.model_config.layer_offloading_prefetch_buffers,
             )
 
         tokenizer = Qwen2Tokenizer.from_pretrained(self.flux2_klein_te_path)
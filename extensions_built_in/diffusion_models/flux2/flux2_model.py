@@ -119,6 +119,12 @@ class Flux2Model(BaseModel):
                 text_encoder,
                 self.device_torch,
                 offload_percent=self.model_config.layer_offloading_text_encoder_percent,
+                vram_budget_gb=self.model_config.layer_offloading_text_encoder_vram_gb,
+                pinned_ram_gb=self.model_config.layer_offloading_text_encoder_pinned_ram_gb,
+                tiers=self.model_config.layer_offloading_tiers,
+                disk_path=self.model_config.layer_offloading_disk_path,
+                prefetch_layers=self.model_config.layer_offloading_prefetch,
+                prefetch_buffers=self.model_config.layer_offloading_prefetch_buffers,
             )
 
         tokenizer = AutoProcessor.from_pretrained(MISTRAL_PATH)
@@ -175,6 +181,12 @@ class Flux2Model(BaseModel):
                 transformer,
                 self.device_torch,
                 offload_percent=self.model_config.layer_offloading_transformer_percent,
+                vram_budget_gb=self.model_config.layer_offloading_transformer_vram_gb,
+                pinned_ram_gb=self.model_config.layer_offloading_transformer_pinned_ram_gb,
+                tiers=self.model_config.layer_offloading_tiers,
+                disk_path=self.model_config.layer_offloading_disk_path,
+                prefetch_layers=self.model_config.layer_offloading_prefetch,
+                prefetch_buffers=self.model_config.layer_offloading_prefetch_buffers,
             )
 
         if self.model_config.low_vram:
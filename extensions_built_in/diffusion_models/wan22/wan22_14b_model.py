@@ -363,12 +363,24 @@ class Wan2214bModel(Wan21):
                 transformer_1,
                 self.device_torch,
                 offload_percent=self.model_config.layer_offloading_transformer_percent,
+                vram_budget_gb=self.model_config.layer_offloading_transformer_vram_gb,
+                pinned_ram_gb=self.model_config.layer_offloading_transformer_pinned_ram_gb,
+                tiers=self.model_config.layer_offloading_tiers,
+                disk_path=self.model_config.layer_offloading_disk_path,
+                prefetch_layers=self.model_config.layer_offloading_prefetch,
+                prefetch_buffers=self.model_config.layer_offloading_prefetch_buffers,
                 ignore_modules=[transformer_1.scale_shift_table] + [block.scale_shift_table for block in transformer_1.blocks]
             )
             MemoryManager.attach(
                 transformer_2,
                 self.device_torch,
                 offload_percent=self.model_config.layer_offloading_transformer_percent,
+                vram_budget_gb=self.model_config.layer_offloading_transformer_vram_gb,
+                pinned_ram_gb=self.model_config.layer_offloading_transformer_pinned_ram_gb,
+                tiers=self.model_config.layer_offloading_tiers,
+                disk_path=self.model_config.layer_offloading_disk_path,
+                prefetch_layers=self.model_config.layer_offloading_prefetch,
+                prefetch_buffers=self.model_config.layer_offloading_prefetch_buffers,
                 ignore_modules=[transformer_2.scale_shift_table] + [block.scale_shift_table for block in transformer_2.blocks]
             )
 
@@ -446,10 +458,17 @@ class Wan2214bModel(Wan21):
         state_dict: Dict[str, torch.Tensor],
         output_path: str,
         metadata: Optional[Dict[str, Any]] = None,
+        atomic: bool = False,
     ):
+        if atomic:
+            # temp file and rename, a crash never leaves a truncated lora
+            from toolkit.checkpoint_writer import atomic_save_file
+            save_fn = atomic_save_file
+        else:
+            save_fn = save_file
         if not self.network.network_config.split_multistage_loras:
             # just save as a combo lora
-            save_file(state_dict, output_path, metadata=metadata)
+            save_fn(state_dict, output_path, metadata=metadata)
             return
 
         # we need to build out both dictionaries for high and low noise LoRAs
@@ -475,14 +494,14 @@ class Wan2214bModel(Wan21):
             high_noise_lora_path = output_path.replace(
                 ".safetensors", "_high_noise.safetensors"
             )
-            save_file(high_noise_lora, high_noise_lora_path, metadata=metadata)
+            save_fn(high_noise_lora, high_noise_lora_path, metadata=metadata)
 
         if len(low_noise_lora.keys()) > 0:
             # save the low noise LoRA
             low_noise_lora_path = output_path.replace(
                 ".safetensors", "_low_noise.safetensors"
             )
-            save_file(low_noise_lora, low_noise_lora_path, metadata=metadata)
+            save_fn(low_noise_lora, low_noise_lora_path, metadata=metadata)
 
     def load_lora(self, file: str):
         # if it doesnt have high_noise or low_noise, it is a combo LoRA
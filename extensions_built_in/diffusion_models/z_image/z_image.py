@@ -190,6 +190,12 @@ class ZImageModel(BaseModel):
                 transformer,
                 self.device_torch,
                 offload_percent=self.model_config.layer_offloading_transformer_percent,
+                vram_budget_gb=self.model_config.layer_offloading_transformer_vram_gb,
+                pinned_ram_gb=self.model_config.layer_offloading_transformer_pinned_ram_gb,
+                tiers=self.model_config.layer_offloading_tiers,
+                disk_path=self.model_config.layer_offloading_disk_path,
+                prefetch_layers=self.model_config.layer_offloading_prefetch,
+                prefetch_buffers=self.model_config.layer_offloading_prefetch_buffers,
                 ignore_modules=[
                     transformer.x_pad_token,
                     transformer.cap_pad_token,
@@ -218,6 +224,12 @@ class ZImageModel(BaseModel):
                 text_encoder,
                 self.device_torch,
                 offload_percent=self.model_config.layer_offloading_text_encoder_percent,
+                vram_budget_gb=self.model_config.layer_offloading_text_encoder_vram_gb,
+                pinned_ram_gb=self.model_config.layer_offloading_text_encoder_pinned_ram_gb,
+                tiers=self.model_config.layer_offloading_tiers,
+                disk_path=self.model_config.layer_offloading_disk_path,
+                prefetch_layers=self.model_config.layer_offloading_prefetch,
+                prefetch_buffers=self.model_config.layer_offloading_prefetch_buffers,
             )
 
         text_encoder.to(self.device_torch, dtype=dtype)
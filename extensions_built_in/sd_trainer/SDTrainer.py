@@ -36,6 +36,7 @@ from toolkit.models.diffusion_feature_extraction import DiffusionFeatureExtracto
 from toolkit.util.losses import wavelet_loss, stepped_loss
 import torch.nn.functional as F
 from toolkit.unloader import unload_text_encoder
+from toolkit.text_embedding_cache import hash_control_images
 from PIL import Image
 from torchvision.transforms import functional as TF
 
@@ -122,6 +123,7 @@ class SDTrainer(BaseSDTrainProcess):
         if self.sample_config is not None and self.sample_config.samples is not None and len(self.sample_config.samples) > 0:
             # cache all the samples
             self.sd.sample_prompts_cache = []
+            text_embedding_cache = self.sd.text_embedding_cache
             sample_folder = os.path.join(self.save_root, 'samples')
             output_path = os.path.join(sample_folder, 'test.jpg')
             for i in range(len(self.sample_config.prompts)):
@@ -191,14 +193,39 @@ class SDTrainer(BaseSDTrainProcess):
                         ctrl_img = ctrl_img_list[0] if len(ctrl_img_list) > 0 else None
                     
                     
-                    positive = self.sd.encode_prompt(
-                        gen_img_config.prompt,
-                        control_images=ctrl_img
-                    ).to('cpu')
-                    negative = self.sd.encode_prompt(
-                        gen_img_config.negative_prompt,
-                        control_images=ctrl_img
-                    ).to('cpu')
+                    if text_embedding_cache is not None:
+                        control_hash = hash_control_images([
+                            x for x in [
+                                gen_img_config.ctrl_img,
+                                gen_img_config.ctrl_img_1,
+                                gen_img_config.ctrl_img_2,
+                                gen_img_config.ctrl_img_3,
+                            ] if x is not None
+                        ])
+                        positive = text_embedding_cache.encode_prompt(
+                            self.sd,
+                            gen_img_config.prompt,
+                            control_images=ctrl_img,
+                            control_hash=control_hash
+                        )
+                        negative = text_embedding_cache.encode_prompt(
+                            self.sd,
+                            gen_img_config.negative_prompt,
+                            control_images=ctrl_img,
+                            control_hash=control_hash
+                        )
+                    else:
+                        positive = self.sd.encode_prompt(
+                            gen_img_config.prompt,
+                            control_images=ctrl_img
+                        ).to('cpu')
+                        negative = self.sd.encode_prompt(
+                            gen_img_config.negative_prompt,
+                            control_images=ctrl_img
+                        ).to('cpu')
+                elif text_embedding_cache is not None:
+                    positive = text_embedding_cache.encode_prompt(self.sd, gen_img_config.prompt)
+                    negative = text_embedding_cache.encode_prompt(self.sd, gen_img_config.negative_prompt)
                 else:
                     positive = self.sd.encode_prompt(gen_img_config.prompt).to('cpu')
                     negative = self.sd.encode_prompt(gen_img_config.negative_prompt).to('cpu')
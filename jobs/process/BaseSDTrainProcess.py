@@ -23,6 +23,7 @@ from huggingface_hub.utils import HfFolder
 from toolkit.memory_management import MemoryManager
 
 from toolkit.basic import value_map
+from toolkit.checkpoint_writer import CheckpointWriter, atomic_torch_save
 from toolkit.clip_vision_adapter import ClipVisionAdapter
 from toolkit.custom_adapter import CustomAdapter
 from toolkit.data_loader import get_dataloader_from_datasets, trigger_dataloader_setup_epoch
@@ -38,7 +39,7 @@ from toolkit.lycoris_special import LycorisSpecialNetwork
 from toolkit.models.decorator import Decorator
 from toolkit.network_mixins import Network
 from toolkit.optimizer import get_optimizer
-from toolkit.paths import CONFIG_ROOT
+from toolkit.paths import CONFIG_ROOT, TEXT_EMBEDDING_CACHE_PATH
 from toolkit.progress_bar import ToolkitProgressBar
 from toolkit.reference_adapter import ReferenceAdapter
 from toolkit.sampler import get_sampler
@@ -48,6 +49,7 @@ from toolkit.saving import save_t2i_from_diffusers, load_t2i_model, save_ip_adap
 from toolkit.scheduler import get_lr_scheduler
 from toolkit.sd_device_states_presets import get_train_sd_device_state_preset
 from toolkit.stable_diffusion_model import StableDiffusion
+from toolkit.text_embedding_cache import get_text_embedding_cache
 
 from jobs.process import BaseTrainProcess
 from toolkit.metadata import get_meta_for_safetensors, load_metadata_from_safetensors, add_base_model_info_to_meta, \
@@ -118,6 +120,9 @@ class BaseSDTrainProcess(BaseTrainProcess):
         self.model_config = ModelConfig(**model_config)
 
         self.save_config = SaveConfig(**self.get_conf('save', {}))
+        self.checkpoint_writer: Optional[CheckpointWriter] = None
+        if self.save_config.async_save:
+            self.checkpoint_writer = CheckpointWriter()
         self.sample_config = SampleConfig(**self.get_conf('sample', {}))
         first_sample_config = self.get_conf('first_sample', None)
         if first_sample_config is not None:
@@ -365,7 +370,12 @@ class BaseSDTrainProcess(BaseTrainProcess):
             self.adapter.is_sampling = True
         
         # send to be generated
-        self.sd.generate_images(gen_img_config_list, sampler=sample_config.sampler)
+        self.sd.generate_images(
+            gen_img_config_list,
+            sampler=sample_config.sampler,
+            batch_size=sample_config.batch_size,
+            cached_merge=sample_config.cached_merge,
+        )
 
         
         if self.adapter is not None and isinstance(self.adapter, CustomAdapter):
@@ -491,6 +501,26 @@ class BaseSDTrainProcess(BaseTrainProcess):
     def end_step_hook(self):
         pass
 
+    def _write_async_save(self, network_save, optimizer_state_dict, file_path):
+        # runs on the checkpoint writer thread, with snapshots that are already in cpu memory
+        if network_save is not None:
+            network_state_dict, network_file_path, save_meta = network_save
+            self.network.save_state_dict(network_state_dict, network_file_path, metadata=save_meta, atomic=True)
+        print_acc(f"Saved checkpoint to {file_path}")
+
+        if optimizer_state_dict is not None:
+            try:
+                optimizer_path = os.path.join(self.save_root, 'optimizer.pt')
+                atomic_torch_save(optimizer_state_dict, optimizer_path)
+                print_acc(f"Saved optimizer to {optimizer_path}")
+            except Exception as e:
+                print_acc(e)
+                print_acc("Could not save optimizer")
+
+        # only remove old saves once the new one is on disk
+        self.clean_up_saves()
+        self.post_save_hook(file_path)
+
     def save(self, step=None):
         if not self.accelerator.is_main_process:
             return
@@ -522,6 +552,9 @@ class BaseSDTrainProcess(BaseTrainProcess):
 
         # prepare meta
         save_meta = get_meta_for_safetensors(save_meta, self.job.name)
+        # the LoRA and optimizer are snapshotted to pinned memory and written by the checkpoint writer
+        use_async_save = self.checkpoint_writer is not None and not self.is_fine_tuning and self.network is not None
+        async_network_save = None
         if not self.is_fine_tuning:
             if self.network is not None:
                 lora_name = self.job.name
@@ -536,12 +569,22 @@ class BaseSDTrainProcess(BaseTrainProcess):
 
                 # if we are doing embedding training as well, add that
                 embedding_dict = self.embedding.state_dict() if self.embedding else None
-                self.network.save_weights(
-                    file_path,
-                    dtype=get_torch_dtype(self.save_config.dtype),
-                    metadata=save_meta,
-                    extra_state_dict=embedding_dict
-                )
+                if use_async_save:
+                    # leave the tensors on device, the snapshot copies them to pinned memory
+                    network_state_dict = self.network.get_state_dict(
+                        extra_state_dict=embedding_dict,
+                        dtype=get_torch_dtype(self.save_config.dtype),
+                        device=None
+                    )
+                    network_state_dict = self.checkpoint_writer.snapshot(network_state_dict, 'network')
+                    async_network_save = (network_state_dict, file_path, save_meta)
+                else:
+                    self.network.save_weights(
+                        file_path,
+                        dtype=get_torch_dtype(self.save_config.dtype),
+                        metadata=save_meta,
+                        extra_state_dict=embedding_dict
+                    )
                 self.network.multiplier = prev_multiplier
                 # if we have an embedding as well, pair it with the network
 
@@ -663,25 +706,41 @@ class BaseSDTrainProcess(BaseTrainProcess):
             with open(path_to_save, 'w') as f:
                 json.dump(json_data, f, indent=4)
         
-        print_acc(f"Saved checkpoint to {file_path}")
+        if use_async_save:
+            optimizer_state_dict = None
+            if self.optimizer is not None:
+                try:
+                    optimizer_state_dict = unwrap_model(self.optimizer).state_dict()
+                except Exception:
+                    optimizer_state_dict = self.optimizer.state_dict()
+                optimizer_state_dict = self.checkpoint_writer.snapshot(optimizer_state_dict, 'optimizer')
+            self.checkpoint_writer.submit(
+                self._write_async_save,
+                async_network_save,
+                optimizer_state_dict,
+                file_path
+            )
+            print_acc(f"Queued checkpoint write to {file_path}")
+        else:
+            print_acc(f"Saved checkpoint to {file_path}")
 
-        # save optimizer
-        if self.optimizer is not None:
-            try:
-                filename = f'optimizer.pt'
-                file_path = os.path.join(self.save_root, filename)
+            # save optimizer
+            if self.optimizer is not None:
                 try:
-                    state_dict = unwrap_model(self.optimizer).state_dict()
+                    filename = f'optimizer.pt'
+                    file_path = os.path.join(self.save_root, filename)
+                    try:
+                        state_dict = unwrap_model(self.optimizer).state_dict()
+                    except Exception as e:
+                        state_dict = self.optimizer.state_dict()
+                    torch.save(state_dict, file_path)
+                    print_acc(f"Saved optimizer to {file_path}")
                 except Exception as e:
-                    state_dict = self.optimizer.state_dict()
-                torch.save(state_dict, file_path)
-                print_acc(f"Saved optimizer to {file_path}")
-            except Exception as e:
-                print_acc(e)
-                print_acc("Could not save optimizer")
+                    print_acc(e)
+                    print_acc("Could not save optimizer")
 
-        self.clean_up_saves()
-        self.post_save_hook(file_path)
+            self.clean_up_saves()
+            self.post_save_hook(file_path)
 
         if self.ema is not None:
             self.ema.train()
@@ -1713,6 +1772,15 @@ class BaseSDTrainProcess(BaseTrainProcess):
                     self.snr_gos.scale.data = torch.tensor(json_data['scale'], device=self.device_torch)
                     self.snr_gos.gamma.data = torch.tensor(json_data['gamma'], device=self.device_torch)
 
+        if self.train_config.text_embedding_cache:
+            cache_dir = self.train_config.text_embedding_cache_dir
+            if cache_dir is None:
+                cache_dir = TEXT_EMBEDDING_CACHE_PATH
+            self.sd.text_embedding_cache = get_text_embedding_cache(
+                cache_dir,
+                max_memory_mb=self.train_config.text_embedding_cache_memory_mb
+            )
+
         self.hook_after_model_load()
         flush()
         if not self.is_fine_tuning:
@@ -2368,6 +2436,9 @@ class BaseSDTrainProcess(BaseTrainProcess):
         print_acc("")
         if self.accelerator.is_main_process:
             self.save()
+            if self.checkpoint_writer is not None:
+                # the final save has to be on disk before we push it or exit
+                self.checkpoint_writer.close()
             self.logger.finish()
         try:
             self.accelerator.end_training()
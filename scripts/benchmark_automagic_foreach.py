@@ -0,0 +1,103 @@
+# measures the Automagic optimizer step on a LoRA shaped set of params with the per param loop (old)
+# and with the stacked foreach update (optimizer_params foreach: true), and compares the state both
+# leave behind. lr masks and polarities should match exactly, the rest to within float rounding
+
+import argparse
+import copy
+import os
+import sys
+import time
+
+import torch
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from toolkit.optimizers.automagic import Automagic
+from toolkit.train_tools import get_torch_dtype
+
+parser = argparse.ArgumentParser(description='Benchmark the foreach Automagic optimizer step.')
+parser.add_argument("--steps", type=int, default=20, help="Optimizer steps to time per method")
+parser.add_argument("--modules", type=int, default=500, help="LoRA modules, each has a down and an up param")
+parser.add_argument("--dim", type=int, default=3072)
+parser.add_argument("--rank", type=int, default=16)
+parser.add_argument("--dtype", type=str, default="fp32")
+parser.add_argument("--weight_decay", type=float, default=0.0)
+args = parser.parse_args()
+
+device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+dtype = get_torch_dtype(args.dtype)
+
+
+def build_params():
+    torch.manual_seed(0)
+    params = []
+    for _ in range(args.modules):
+        params.append(torch.nn.Parameter(torch.randn(args.rank, args.dim, device=device, dtype=dtype) * 0.01))
+        params.append(torch.nn.Parameter(torch.zeros(args.dim, args.rank, device=device, dtype=dtype)))
+    # a few 1d ones for the unfactored path
+    for _ in range(args.modules // 10):
+        params.append(torch.nn.Parameter(torch.zeros(args.dim, device=device, dtype=dtype)))
+    return params
+
+
+def build_grads(params, steps):
+    generator = torch.Generator(device=device).manual_seed(1)
+    return [
+        [torch.randn(p.shape, device=device, dtype=dtype, generator=generator) for p in params]
+        for _ in range(steps)
+    ]
+
+
+def sync():
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+
+
+def run(foreach, grads):
+    params = build_params()
+    optimizer = Automagic(params, lr=1e-6, weight_decay=args.weight_decay, foreach=foreach)
+    # warm up and create the state
+    for p, g in zip(params, grads[0]):
+        p.grad = g
+    optimizer.step()
+    sync()
+    start = time.perf_counter()
+    for step_grads in grads[1:]:
+        for p, g in zip(params, step_grads):
+            p.grad = g
+        optimizer.step()
+    sync()
+    step_time = (time.perf_counter() - start) / (len(grads) - 1)
+    return step_time, params, optimizer
+
+
+def max_diff(a, b):
+    return (a.float() - b.float()).abs().max().item()
+
+
+grads = build_grads(build_params(), args.steps + 1)
+old_time, old_params, old_optimizer = run(False, grads)
+new_time, new_params, new_optimizer = run(True, grads)
+
+param_diff = max(max_diff(a, b) for a, b in zip(old_params, new_params))
+lr_mask_same = True
+polarity_same = True
+moment_diff = 0.0
+for old_p, new_p in zip(old_params, new_params):
+    old_state = old_optimizer.state[old_p]
+    new_state = new_optimizer.state[new_p]
+    lr_mask_same = lr_mask_same and torch.equal(old_state['lr_mask'].quantized, new_state['lr_mask'].quantized) \
+        and old_state['lr_mask'].scale == new_state['lr_mask'].scale
+    polarity_same = polarity_same and torch.equal(old_state['last_polarity'], new_state['last_polarity'])
+    for key in ('exp_avg_sq_row', 'exp_avg_sq_col', 'exp_avg_sq'):
+        if key in old_state:
+            moment_diff = max(moment_diff, max_diff(old_state[key], new_state[key]))
+
+# the saved state has to load into either
+state_dict = copy.deepcopy(new_optimizer.state_dict())
+old_optimizer.load_state_dict(state_dict)
+
+print(f"{len(old_params)} params on {device}")
+print(f"loop (old): {old_time * 1e3:.2f}ms per step")
+print(f"foreach: {new_time * 1e3:.2f}ms per step, {old_time / new_time:.2f}x speedup")
+print(f"lr masks identical: {lr_mask_same}, polarities identical: {polarity_same}, "
+      f"max abs diff params {param_diff:.2e}, second moments {moment_diff:.2e}")
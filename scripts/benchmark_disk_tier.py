@@ -0,0 +1,92 @@
+# measures a forward and backward through a stack of offloaded linear layers with every weight in
+# pinned ram against the disk tier (model layer_offloading_*_pinned_ram_gb), where the weights are
+# memory mapped from a file and staged through pinned buffers. Drop the page cache between runs
+# (echo 3 > /proc/sys/vm/drop_caches) to time cold reads from disk instead of the page cache
+
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from toolkit.memory_management import MemoryManager
+from toolkit.memory_management.planner import TIER_DISK
+from toolkit.train_tools import get_torch_dtype
+
+parser = argparse.ArgumentParser(description='Benchmark the disk tier of layer offloading.')
+parser.add_argument("--iterations", type=int, default=10, help="Forward and backward passes to time per method")
+parser.add_argument("--blocks", type=int, default=16)
+parser.add_argument("--dim", type=int, default=3072)
+parser.add_argument("--tokens", type=int, default=4096)
+parser.add_argument("--dtype", type=str, default="bf16")
+parser.add_argument("--pinned_ram_gb", type=float, nargs='+', default=[0.0], help="Pinned ram budgets to time")
+parser.add_argument("--prefetch", type=int, default=2, help="Prefetch depth, 0 bounces each layer when called")
+parser.add_argument("--disk_path", type=str, default=None)
+args = parser.parse_args()
+
+if not torch.cuda.is_available():
+    print("the disk tier benchmark needs a cuda device")
+    sys.exit(0)
+
+device = torch.device('cuda')
+dtype = get_torch_dtype(args.dtype)
+
+
+def build_model():
+    torch.manual_seed(0)
+    layers = []
+    for _ in range(args.blocks):
+        layers += [
+            torch.nn.Linear(args.dim, args.dim * 4),
+            torch.nn.GELU(),
+            torch.nn.Linear(args.dim * 4, args.dim),
+        ]
+    model = torch.nn.Sequential(*layers).to(dtype)
+    model.requires_grad_(False)
+    return model
+
+
+def time_offloaded(pinned_ram_gb):
+    model = build_model()
+    MemoryManager.attach(
+        model,
+        device,
+        pinned_ram_gb=pinned_ram_gb,
+        disk_path=args.disk_path,
+        prefetch_layers=args.prefetch,
+    )
+    model.to(device)
+    disk_bytes = 0
+    for module in model.modules():
+        layer = getattr(module, '_layer_memory_manager', None)
+        if layer is not None and layer.disk_tier:
+            disk_bytes += module.weight.numel() * module.weight.element_size()
+
+    x = torch.randn(1, args.tokens, args.dim, device=device, dtype=dtype, requires_grad=True)
+    # the first pass records the layer order for the prefetcher
+    for _ in range(2):
+        model(x).float().mean().backward()
+    torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(args.iterations):
+        out = model(x)
+        out.float().mean().backward()
+    torch.cuda.synchronize()
+    step_time = (time.perf_counter() - start) / args.iterations
+    return step_time, disk_bytes, out.detach().float(), x.grad.detach().float()
+
+
+pinned_time, _, reference, reference_grad = time_offloaded(None)
+print(f"all pinned: {pinned_time * 1e3:.1f}ms")
+
+for pinned_ram_gb in args.pinned_ram_gb:
+    step_time, disk_bytes, out, grad = time_offloaded(pinned_ram_gb)
+    max_diff = max(
+        (out - reference).abs().max().item(),
+        (grad - reference_grad).abs().max().item(),
+    )
+    print(f"{TIER_DISK} tier with {pinned_ram_gb:.2f}GB pinned: {step_time * 1e3:.1f}ms, "
+          f"{disk_bytes / (1024 ** 3):.2f}GB mapped from disk, {pinned_time / step_time:.2f}x of all pinned, "
+          f"max abs diff {max_diff:.2e}")
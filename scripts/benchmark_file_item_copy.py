@@ -0,0 +1,61 @@
+# measures the per sample cost of copying a FileItemDTO in AiToolkitDataset._get_single_item,
+# copy.deepcopy (old) against FileItemDTO.clone
+
+import argparse
+import copy
+import os
+import sys
+import tempfile
+import time
+
+import torch
+from PIL import Image
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from toolkit.config_modules import DatasetConfig
+from toolkit.data_transfer_object.data_loader import FileItemDTO
+
+parser = argparse.ArgumentParser(description='Benchmark copying file items.')
+parser.add_argument("--iterations", type=int, default=2000, help="Copies to time per method")
+parser.add_argument("--latent_size", type=int, default=128, help="Size of the in memory cached latent, 0 for none")
+args = parser.parse_args()
+
+
+def time_per_item(fn, item, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn(item)
+    return (time.perf_counter() - start) / iterations
+
+
+with tempfile.TemporaryDirectory() as tmp_dir:
+    img_path = os.path.join(tmp_dir, 'img.png')
+    Image.new('RGB', (1024, 768)).save(img_path)
+    with open(os.path.join(tmp_dir, 'img.txt'), 'w') as f:
+        f.write('a photo of something, with a reasonably long caption to copy around')
+
+    dataset_config = DatasetConfig(
+        folder_path=tmp_dir,
+        resolution=512,
+        augments=['ColorJitter'],
+        extra_values=[0.5, 1.0],
+    )
+    file_item = FileItemDTO(
+        path=img_path,
+        dataset_config=dataset_config,
+        dataloader_transforms=None,
+        size_database={},
+        dataset_root=tmp_dir,
+    )
+    file_item.load_caption(None)
+    if args.latent_size > 0:
+        # cache_latents keeps these in memory on every item
+        file_item._encoded_latent = torch.randn(16, args.latent_size, args.latent_size, dtype=torch.bfloat16)
+        file_item.is_latent_cached = True
+
+    deepcopy_time = time_per_item(copy.deepcopy, file_item, args.iterations)
+    clone_time = time_per_item(lambda x: x.clone(), file_item, args.iterations)
+
+print(f"copy.deepcopy: {deepcopy_time * 1e6:.1f}us per item")
+print(f"clone:         {clone_time * 1e6:.1f}us per item")
+print(f"speedup:       {deepcopy_time / clone_time:.1f}x")
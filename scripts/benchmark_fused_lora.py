@@ -0,0 +1,87 @@
+# measures a LoRA wrapped Linear and Conv2d forward with the per module path (old) against
+# ToolkitModuleMixin._fused_forward (network fused_forward)
+
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from toolkit.config_modules import NetworkConfig
+from toolkit.lora_special import LoRAModule
+from toolkit.network_mixins import ToolkitNetworkMixin
+from toolkit.train_tools import get_torch_dtype
+
+parser = argparse.ArgumentParser(description='Benchmark the fused LoRA forward.')
+parser.add_argument("--iterations", type=int, default=200, help="Forwards to time per method")
+parser.add_argument("--batch_size", type=int, default=2)
+parser.add_argument("--rank", type=int, default=16)
+parser.add_argument("--dtype", type=str, default="bf16")
+parser.add_argument("--multiplier", type=float, nargs='+', default=[1.0], help="Per batch multipliers")
+args = parser.parse_args()
+
+device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+dtype = get_torch_dtype(args.dtype)
+
+
+class BenchmarkNetwork(ToolkitNetworkMixin, torch.nn.Module):
+    def __init__(self):
+        ToolkitNetworkMixin.__init__(self, network_config=NetworkConfig(fused_forward=True))
+        torch.nn.Module.__init__(self)
+        self.network_type = 'lora'
+        self.torch_multiplier = None
+        self.unet_loras = []
+
+
+def sync():
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+
+
+def time_forward(module, x, iterations):
+    for _ in range(5):
+        module(x)
+    sync()
+    start = time.perf_counter()
+    for _ in range(iterations):
+        module(x)
+    sync()
+    return (time.perf_counter() - start) / iterations
+
+
+def benchmark(name, org_module, x):
+    network = BenchmarkNetwork()
+    org_module = org_module.to(device, dtype)
+    lora = LoRAModule(
+        f'lora_{name}',
+        org_module,
+        lora_dim=args.rank,
+        alpha=args.rank // 2,
+        network=network,
+    )
+    torch.nn.init.normal_(lora.lora_up.weight, std=0.01)
+    lora.apply_to()
+    lora.to(device, dtype)
+    network.unet_loras = [lora]
+    network.multiplier = args.multiplier
+    network.is_active = True
+    x = x.to(device, dtype)
+
+    with torch.no_grad():
+        network.fused_forward = False
+        reference = org_module(x)
+        old_time = time_forward(org_module, x, args.iterations)
+        network.fused_forward = True
+        fused = org_module(x)
+        fused_time = time_forward(org_module, x, args.iterations)
+
+    max_diff = (reference.float() - fused.float()).abs().max().item()
+    print(f"{name}: {old_time * 1e6:.1f}us old, {fused_time * 1e6:.1f}us fused, "
+          f"{old_time / fused_time:.2f}x speedup, max abs diff {max_diff:.2e}")
+
+
+batch_size = args.batch_size * len(args.multiplier)
+benchmark('linear', torch.nn.Linear(3072, 3072), torch.randn(batch_size, 4096, 3072))
+benchmark('conv', torch.nn.Conv2d(320, 320, 3, padding=1), torch.randn(batch_size, 320, 64, 64))
@@ -0,0 +1,124 @@
+# measures the to_q/to_k/to_v LoRAs of an attention block run per module (old) against one
+# LoRAModuleGroup (network grouped_forward) without grad, which is the only time the group runs.
+# They are not bit identical, the fused matmuls accumulate in a different order. The max abs diff
+# is printed next to the tolerance for the dtype. On cuda it also counts the kernels per forward
+
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from toolkit.config_modules import NetworkConfig
+from toolkit.lora_special import LoRAModule
+from toolkit.network_mixins import ToolkitNetworkMixin
+from toolkit.train_tools import get_torch_dtype
+
+parser = argparse.ArgumentParser(description='Benchmark grouped LoRA projections.')
+parser.add_argument("--iterations", type=int, default=200, help="Forwards to time per method")
+parser.add_argument("--batch_size", type=int, default=2)
+parser.add_argument("--tokens", type=int, default=4096)
+parser.add_argument("--dim", type=int, default=3072)
+parser.add_argument("--rank", type=int, default=16)
+parser.add_argument("--dtype", type=str, default="bf16")
+args = parser.parse_args()
+
+device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+dtype = get_torch_dtype(args.dtype)
+# matmuls with a different shape may sum in a different order, this is a few ulp of the dtype
+tolerance = {torch.float32: 1e-4, torch.float16: 1e-2, torch.bfloat16: 5e-2}.get(dtype, 5e-2)
+
+
+class BenchmarkNetwork(ToolkitNetworkMixin, torch.nn.Module):
+    def __init__(self):
+        ToolkitNetworkMixin.__init__(self, network_config=NetworkConfig(grouped_forward=True))
+        torch.nn.Module.__init__(self)
+        self.network_type = 'lora'
+        self.torch_multiplier = None
+        self.unet_loras = []
+
+
+class Attention(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.to_q = torch.nn.Linear(args.dim, args.dim)
+        self.to_k = torch.nn.Linear(args.dim, args.dim)
+        self.to_v = torch.nn.Linear(args.dim, args.dim)
+
+    def forward(self, x):
+        return self.to_q(x), self.to_k(x), self.to_v(x)
+
+
+def sync():
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+
+
+def build(grouped):
+    torch.manual_seed(0)
+    network = BenchmarkNetwork()
+    attn = Attention().to(device, dtype)
+    attn.requires_grad_(False)
+    loras = []
+    for name in ['to_q', 'to_k', 'to_v']:
+        lora = LoRAModule(
+            f'lora_unet_attn_{name}',
+            getattr(attn, name),
+            lora_dim=args.rank,
+            alpha=args.rank // 2,
+            network=network,
+        )
+        torch.nn.init.normal_(lora.lora_up.weight, std=0.01)
+        lora.apply_to()
+        lora.to(device, dtype)
+        loras.append(lora)
+    network.unet_loras = loras
+    network.multiplier = [1.0] * args.batch_size
+    network.is_active = True
+    network.grouped_forward = grouped
+    network.setup_lora_groups()
+    return attn, loras
+
+
+@torch.no_grad()
+def time_forward(attn, x, iterations):
+    for _ in range(5):
+        attn(x)
+    sync()
+    start = time.perf_counter()
+    for _ in range(iterations):
+        attn(x)
+    sync()
+    return (time.perf_counter() - start) / iterations
+
+
+def count_kernels(attn, x):
+    if device.type != 'cuda':
+        return None
+    from torch.profiler import ProfilerActivity, profile
+    with torch.no_grad():
+        attn(x)
+        sync()
+        with profile(activities=[ProfilerActivity.CUDA]) as prof:
+            attn(x)
+            sync()
+    return sum(1 for e in prof.events() if e.device_type.name == 'CUDA')
+
+
+x = torch.randn(args.batch_size, args.tokens, args.dim, device=device, dtype=dtype)
+results = {}
+for grouped in [False, True]:
+    attn, _ = build(grouped)
+    with torch.no_grad():
+        outputs = attn(x)
+    results[grouped] = (outputs, time_forward(attn, x, args.iterations), count_kernels(attn, x))
+
+old, new = results[False], results[True]
+output_diff = max((a.float() - b.float()).abs().max().item() for a, b in zip(old[0], new[0]))
+print(f"no grad: {old[1] * 1e6:.1f}us old, {new[1] * 1e6:.1f}us grouped, {old[1] / new[1]:.2f}x speedup")
+if old[2] is not None:
+    print(f"kernels per forward: {old[2]} old, {new[2]} grouped")
+print(f"max abs diff outputs {output_diff:.2e}, tolerance {tolerance:.0e}: "
+      f"{'ok' if output_diff <= tolerance else 'FAILED'}")
@@ -0,0 +1,95 @@
+# measures a forward and backward through a stack of offloaded linear layers with weights resident on
+# the gpu, with the per layer bounce of the MemoryManager (old), and with lookahead prefetching
+# (model layer_offloading_prefetch). overlap efficiency is the share of the transfer time the prefetch
+# hides behind compute, 100% means offloaded runs as fast as resident
+
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from toolkit.memory_management import MemoryManager
+from toolkit.train_tools import get_torch_dtype
+
+parser = argparse.ArgumentParser(description='Benchmark lookahead prefetching for layer offloading.')
+parser.add_argument("--iterations", type=int, default=10, help="Forward and backward passes to time per method")
+parser.add_argument("--blocks", type=int, default=16)
+parser.add_argument("--dim", type=int, default=3072)
+parser.add_argument("--tokens", type=int, default=4096)
+parser.add_argument("--dtype", type=str, default="bf16")
+parser.add_argument("--prefetch", type=int, nargs='+', default=[1, 2, 4], help="Prefetch depths to time")
+parser.add_argument("--prefetch_buffers", type=int, default=None)
+args = parser.parse_args()
+
+if not torch.cuda.is_available():
+    print("layer offloading prefetch needs a cuda device")
+    sys.exit(0)
+
+device = torch.device('cuda')
+dtype = get_torch_dtype(args.dtype)
+
+
+def build_model():
+    torch.manual_seed(0)
+    layers = []
+    for _ in range(args.blocks):
+        layers += [
+            torch.nn.Linear(args.dim, args.dim * 4),
+            torch.nn.GELU(),
+            torch.nn.Linear(args.dim * 4, args.dim),
+        ]
+    model = torch.nn.Sequential(*layers).to(dtype)
+    model.requires_grad_(False)
+    return model
+
+
+def time_model(model):
+    x = torch.randn(1, args.tokens, args.dim, device=device, dtype=dtype, requires_grad=True)
+    # the first pass records the layer order for the prefetcher
+    for _ in range(2):
+        model(x).float().mean().backward()
+    torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(args.iterations):
+        out = model(x)
+        out.float().mean().backward()
+    torch.cuda.synchronize()
+    return (time.perf_counter() - start) / args.iterations, out.detach().float(), x.grad.detach().float()
+
+
+def time_offloaded(prefetch_layers):
+    model = build_model()
+    MemoryManager.attach(
+        model,
+        device,
+        prefetch_layers=prefetch_layers,
+        prefetch_buffers=args.prefetch_buffers,
+    )
+    model.to(device)
+    scheduler = model._memory_manager.prefetch_scheduler
+    if scheduler is not None:
+        scheduler.reset_stats()
+    result = time_model(model)
+    return result, scheduler
+
+
+resident_time, reference, reference_grad = time_model(build_model().to(device))
+(old_time, _, _), _ = time_offloaded(0)
+transfer_time = old_time - resident_time
+print(f"resident: {resident_time * 1e3:.1f}ms")
+print(f"offloaded (old): {old_time * 1e3:.1f}ms, {transfer_time * 1e3:.1f}ms not hidden")
+
+for prefetch_layers in args.prefetch:
+    (prefetch_time, out, grad), scheduler = time_offloaded(prefetch_layers)
+    hidden = (old_time - prefetch_time) / transfer_time * 100 if transfer_time > 0 else 100.0
+    total = scheduler.hits + scheduler.misses
+    hit_rate = scheduler.hits / total * 100 if total > 0 else 0.0
+    max_diff = max(
+        (out - reference).abs().max().item(),
+        (grad - reference_grad).abs().max().item(),
+    )
+    print(f"prefetch {prefetch_layers}: {prefetch_time * 1e3:.1f}ms, {old_time / prefetch_time:.2f}x speedup, "
+          f"{hidden:.1f}% overlap efficiency, {hit_rate:.1f}% prefetch hits, max abs diff {max_diff:.2e}")
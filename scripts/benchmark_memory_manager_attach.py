@@ -0,0 +1,82 @@
+# measures MemoryManager.attach startup time on a synthetic deep model against the nested
+# named_modules traversal with list membership it used before (old). Layers are tiny so the time
+# is the traversal, not pinning weights
+
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from toolkit.memory_management import MemoryManager
+from toolkit.memory_management.manager import (
+    CONV_MODULES,
+    LINEAR_MODULES,
+    UNMANAGED_MODULES,
+    UNMANAGED_MODULES_INCLUDES,
+)
+
+parser = argparse.ArgumentParser(description='Benchmark MemoryManager.attach startup time.')
+parser.add_argument("--blocks", type=int, nargs='+', default=[16, 32, 64], help="Transformer blocks to time")
+parser.add_argument("--depth", type=int, default=4, help="Nesting depth of the modules in each block")
+args = parser.parse_args()
+
+
+class Attention(torch.nn.Module):
+    def __init__(self, depth):
+        super().__init__()
+        self.norm = torch.nn.LayerNorm(8)
+        self.to_q = torch.nn.Linear(8, 8)
+        self.to_k = torch.nn.Linear(8, 8)
+        self.to_v = torch.nn.Linear(8, 8)
+        self.to_out = torch.nn.ModuleList([torch.nn.Linear(8, 8), torch.nn.Dropout(0.0)])
+        self.inner = Attention(depth - 1) if depth > 1 else None
+
+
+class Block(torch.nn.Module):
+    def __init__(self, depth):
+        super().__init__()
+        self.attn = Attention(depth)
+        self.ff = torch.nn.Sequential(torch.nn.Linear(8, 32), torch.nn.GELU(), torch.nn.Linear(32, 8))
+        self.conv = torch.nn.Conv2d(8, 8, 1)
+        self.norm = torch.nn.GroupNorm(1, 8)
+
+
+def build_model(num_blocks):
+    return torch.nn.ModuleList([Block(args.depth) for _ in range(num_blocks)])
+
+
+def old_traversal(module):
+    # the classification loop attach used before, without the attaching
+    modules_processed = []
+    managed = []
+    unmanaged = []
+    for name, sub_module in module.named_modules():
+        for child_name, child_module in sub_module.named_modules():
+            class_name = child_module.__class__.__name__
+            if class_name in LINEAR_MODULES + CONV_MODULES and child_module not in modules_processed:
+                managed.append(child_module)
+                modules_processed.append(child_module)
+            elif class_name in UNMANAGED_MODULES or any(inc in class_name for inc in UNMANAGED_MODULES_INCLUDES):
+                unmanaged.append(child_module)
+    return managed
+
+
+for num_blocks in args.blocks:
+    model = build_model(num_blocks)
+    num_modules = len(list(model.named_modules()))
+
+    start = time.perf_counter()
+    old_managed = old_traversal(model)
+    old_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    MemoryManager.attach(model, torch.device('cpu'), print_plan=False)
+    new_time = time.perf_counter() - start
+
+    new_managed = [m for _, m in model.named_modules() if hasattr(m, '_layer_memory_manager')]
+    same = set(id(m) for m in old_managed) == set(id(m) for m in new_managed)
+    print(f"{num_blocks} blocks, {num_modules} modules: {old_time * 1e3:.1f}ms old traversal, "
+          f"{new_time * 1e3:.1f}ms attach, {old_time / new_time:.1f}x speedup, same layers managed: {same}")
@@ -0,0 +1,47 @@
+# packs existing _latent_cache folders (one safetensors file per image) into the sharded format
+# used when a dataset has latent_cache_format: sharded. Records are copied byte for byte.
+
+import argparse
+import os
+import sys
+
+from tqdm import tqdm
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from toolkit.latent_shards import get_latent_shard_store
+
+parser = argparse.ArgumentParser(description='Pack _latent_cache folders into latent shards.')
+parser.add_argument("dataset_folder", type=str, help="Dataset folder. All _latent_cache folders under it are packed")
+parser.add_argument("--delete", action="store_true", help="Delete the safetensors files once they are packed")
+
+args = parser.parse_args()
+
+cache_dirs = []
+for root, dirs, _ in os.walk(args.dataset_folder):
+    if os.path.basename(root) == '_latent_cache':
+        cache_dirs.append(root)
+print(f"Found {len(cache_dirs)} _latent_cache folders")
+
+num_packed = 0
+num_skipped = 0
+for cache_dir in cache_dirs:
+    store = get_latent_shard_store(cache_dir)
+    files = sorted([f for f in os.listdir(cache_dir) if f.endswith('.safetensors')])
+    to_delete = []
+    for filename in tqdm(files, desc=cache_dir):
+        file_path = os.path.join(cache_dir, filename)
+        key = os.path.splitext(filename)[0]
+        if key in store:
+            num_skipped += 1
+        else:
+            with open(file_path, 'rb') as f:
+                store.append_bytes(key, f.read())
+            num_packed += 1
+        if args.delete:
+            to_delete.append(file_path)
+    # only delete files once the index points at their records
+    store.flush()
+    for file_path in to_delete:
+        os.remove(file_path)
+
+print(f"Packed {num_packed} latents, {num_skipped} were already packed")
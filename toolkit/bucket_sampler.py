@@ -0,0 +1,182 @@
+import bisect
+import math
+import random
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Dict, Iterator, List
+
+import numpy as np
+from torch.utils.data import ConcatDataset, Sampler
+
+from toolkit.print import print_acc
+
+if TYPE_CHECKING:
+    from toolkit.data_loader import AiToolkitDataset
+    from toolkit.data_transfer_object.data_loader import FileItemDTO
+
+
+def get_batch_compatibility_key(dataset: 'AiToolkitDataset') -> tuple:
+    # items from datasets with different keys cannot be collated into one batch. DataLoaderBatchDTO
+    # fills what some items lack with zeros or another item's value, or raises, so everything it
+    # collates has to come from all items of a batch or from none
+    config = dataset.dataset_config
+    if config.control_path is None:
+        num_control_paths = 0
+    elif isinstance(config.control_path, list):
+        num_control_paths = len(config.control_path)
+    else:
+        num_control_paths = 1
+    has_augments = len(config.augments) > 0 or (config.augmentations is not None and len(config.augmentations) > 0)
+    return (
+        dataset.is_caching_latents,
+        dataset.is_caching_text_embeddings,
+        dataset.is_caching_clip_vision_to_disk,
+        config.num_frames,
+        # controls are stacked per item, so the count has to match too
+        num_control_paths + len(config.controls),
+        config.inpaint_path is not None,
+        config.mask_path is not None or config.alpha_mask,
+        config.unconditional_path is not None,
+        config.clip_image_path is not None or config.clip_image_from_same_folder,
+        has_augments,
+        config.do_audio,
+        len(config.extra_values),
+    )
+
+
+class BucketItemDataset(ConcatDataset):
+    """
+    ConcatDataset of AiToolkitDatasets indexed by file item instead of by batch. The
+    GlobalBucketBatchSampler hands the dataloader batches of indexes into it.
+    """
+
+    def __init__(self, datasets: List['AiToolkitDataset']):
+        super().__init__(datasets)
+        # ConcatDataset sizes them with len, which counts batches for bucketed datasets
+        self.cumulative_sizes = np.cumsum([len(d.file_table) for d in datasets]).tolist()
+
+    def __getitem__(self, idx: int) -> 'FileItemDTO':
+        if idx < 0:
+            idx += len(self)
+        dataset_idx = bisect.bisect_right(self.cumulative_sizes, idx)
+        sample_idx = idx if dataset_idx == 0 else idx - self.cumulative_sizes[dataset_idx - 1]
+        return self.datasets[dataset_idx]._get_single_item(sample_idx)
+
+
+class GlobalBucketBatchSampler(Sampler):
+    """
+    Batches same size items across all datasets, instead of each dataset batching its own buckets.
+    Small datasets no longer end every bucket with an undersized batch. Each epoch:
+    - every dataset is drawn round(len * sampling_weight) times, num_repeats and flips are already in its items
+    - the draws are pooled by bucket size (and batch compatibility) and shuffled
+    - each pool is cut into full batches. A leftover is topped up with random items from the same pool
+    - batches are shuffled
+    Padding, and what per dataset batching would have wasted, is printed every epoch.
+    """
+
+    def __init__(self, dataset: BucketItemDataset, batch_size: int, verbose: bool = True):
+        super().__init__()
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.verbose = verbose
+        self.last_epoch_stats: Dict[str, float] = {}
+
+    def _get_draw_counts(self) -> List[int]:
+        counts = []
+        for dataset in self.dataset.datasets:
+            weight = dataset.dataset_config.sampling_weight
+            counts.append(int(round(len(dataset.file_table) * weight)))
+        return counts
+
+    def _get_pools(self, draw_indexes: bool) -> 'OrderedDict[tuple, List[int]]':
+        # pool key -> global item indexes. Without draw_indexes only the pool sizes are meaningful
+        pools: 'OrderedDict[tuple, List[int]]' = OrderedDict()
+        for dataset_idx, (dataset, num_draws) in enumerate(zip(self.dataset.datasets, self._get_draw_counts())):
+            file_table = dataset.file_table
+            num_items = len(file_table)
+            if num_draws == 0 or num_items == 0:
+                continue
+            offset = 0 if dataset_idx == 0 else self.dataset.cumulative_sizes[dataset_idx - 1]
+            if draw_indexes:
+                # whole passes, then a random subset for the remainder
+                drawn = np.concatenate([
+                    np.tile(np.arange(num_items, dtype=np.int64), num_draws // num_items),
+                    np.array(sorted(random.sample(range(num_items), num_draws % num_items)), dtype=np.int64),
+                ])
+            else:
+                drawn = np.arange(num_draws, dtype=np.int64) % num_items
+            compatibility_key = get_batch_compatibility_key(dataset)
+            bucket_keys = (file_table.crop_width[drawn].astype(np.int64) << 32) | file_table.crop_height[drawn]
+            unique_keys, first_idx, inverse = np.unique(bucket_keys, return_index=True, return_inverse=True)
+            inverse = inverse.reshape(-1)
+            for key_idx in np.argsort(first_idx):
+                bucket_key = int(unique_keys[key_idx])
+                pool_key = (bucket_key >> 32, bucket_key & 0xFFFFFFFF) + compatibility_key
+                pools.setdefault(pool_key, []).extend((drawn[inverse == key_idx] + offset).tolist())
+        return pools
+
+    def __len__(self) -> int:
+        # exact unless a sampling_weight subsamples a dataset, then the remainder draw can shift between buckets
+        return sum(math.ceil(len(pool) / self.batch_size) for pool in self._get_pools(draw_indexes=False).values())
+
+    def __iter__(self) -> Iterator[List[int]]:
+        pools = self._get_pools(draw_indexes=True)
+        batches: List[List[int]] = []
+        num_padded = 0
+        for pool in pools.values():
+            random.shuffle(pool)
+            for start_idx in range(0, len(pool), self.batch_size):
+                batch = pool[start_idx:start_idx + self.batch_size]
+                if len(batch) < self.batch_size:
+                    # top up with other items of the same size, preferring ones not already in the batch
+                    num_missing = self.batch_size - len(batch)
+                    others = pool[:start_idx]
+                    if len(others) >= num_missing:
+                        batch = batch + random.sample(others, num_missing)
+                    else:
+                        batch = batch + [random.choice(pool) for _ in range(num_missing)]
+                    num_padded += num_missing
+                batches.append(batch)
+        random.shuffle(batches)
+
+        self.last_epoch_stats = self._get_epoch_stats(pools, len(batches), num_padded)
+        if self.verbose:
+            self.print_stats()
+        for batch in batches:
+            yield batch
+
+    def _get_epoch_stats(self, pools: 'OrderedDict[tuple, List[int]]', num_batches: int, num_padded: int) -> Dict[str, float]:
+        # compare with every dataset batching its own buckets
+        num_dataset_batches = 0
+        num_dataset_partial_batches = 0
+        num_dataset_empty_slots = 0
+        for dataset in self.dataset.datasets:
+            for bucket in dataset.buckets.values():
+                bucket_len = len(bucket.file_list_idx)
+                num_dataset_batches += math.ceil(bucket_len / self.batch_size)
+                if bucket_len % self.batch_size != 0:
+                    num_dataset_partial_batches += 1
+                    num_dataset_empty_slots += self.batch_size - bucket_len % self.batch_size
+        num_slots = num_batches * self.batch_size
+        num_dataset_slots = num_dataset_batches * self.batch_size
+        return {
+            'num_batches': num_batches,
+            'num_pools': len(pools),
+            'num_samples': sum(len(pool) for pool in pools.values()),
+            'num_padded': num_padded,
+            'padding_ratio': num_padded / num_slots if num_slots > 0 else 0.0,
+            'num_dataset_batches': num_dataset_batches,
+            'num_dataset_partial_batches': num_dataset_partial_batches,
+            'dataset_waste_ratio': num_dataset_empty_slots / num_dataset_slots if num_dataset_slots > 0 else 0.0,
+        }
+
+    def print_stats(self):
+        stats = self.last_epoch_stats
+        print_acc(
+            f"Global buckets: {stats['num_batches']} full batches of {self.batch_size} from "
+            f"{stats['num_samples']} samples in {stats['num_pools']} buckets, "
+            f"{stats['num_padded']} padded ({stats['padding_ratio'] * 100:.1f}%)"
+        )
+        print_acc(
+            f" - per dataset buckets: {stats['num_dataset_batches']} batches, "
+            f"{stats['num_dataset_partial_batches']} undersized, {stats['dataset_waste_ratio'] * 100:.1f}% of slots empty"
+        )
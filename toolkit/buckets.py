@@ -1,4 +1,7 @@
-from typing import Type, List, Union, TypedDict
+from functools import lru_cache
+from typing import Type, List, Tuple, Union, TypedDict
+
+import numpy as np
 
 
 class BucketResolution(TypedDict):
@@ -126,4 +129,73 @@ def get_bucket_for_image_size(
     if closest_bucket is None:
         raise ValueError("No suitable bucket found")
 
-    return closest_bucket
\ No newline at end of file
+    return closest_bucket
+
+
+# images per chunk when bucketing arrays, bounds the images x buckets temporaries
+BUCKET_CHUNK_SIZE = 65536
+
+
+@lru_cache(maxsize=None)
+def get_bucket_table(resolution: int, divisibility: int = 8) -> np.ndarray:
+    # get_bucket_sizes as an (n, 2) array of width, height. Cached per resolution and divisibility
+    bucket_size_list = get_bucket_sizes(resolution=resolution, divisibility=divisibility)
+    table = np.array([[b["width"], b["height"]] for b in bucket_size_list], dtype=np.int64)
+    table.flags.writeable = False
+    return table
+
+
+def get_resolutions(widths: np.ndarray, heights: np.ndarray) -> np.ndarray:
+    # get_resolution for arrays
+    return np.sqrt((widths * heights).astype(np.float64)).astype(np.int64)
+
+
+def _closest_buckets(widths: np.ndarray, heights: np.ndarray, table: np.ndarray) -> np.ndarray:
+    # bucket index per image, same rules as get_bucket_for_image_size
+    bucket_widths = table[:, 0][None, :]
+    bucket_heights = table[:, 1][None, :]
+    w = widths[:, None]
+    h = heights[:, None]
+
+    scale = np.maximum(bucket_widths / w, bucket_heights / h)
+    new_width = (w * scale).astype(np.int64)
+    new_height = (h * scale).astype(np.int64)
+    removed_pixels = (new_width - bucket_widths) * new_height + (new_height - bucket_heights) * new_width
+    # argmin takes the first minimum, like the strict less than in the loop
+    bucket_idx = np.argmin(removed_pixels, axis=1)
+
+    # exact matches win, first one in the list
+    exact = (bucket_widths == w) & (bucket_heights == h)
+    has_exact = exact.any(axis=1)
+    bucket_idx[has_exact] = np.argmax(exact[has_exact], axis=1)
+    return bucket_idx
+
+
+def get_buckets_for_image_sizes(
+        widths: np.ndarray,
+        heights: np.ndarray,
+        resolution: int,
+        divisibility: int = 8
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    get_bucket_for_image_size(width, height, resolution=resolution, divisibility=divisibility) for arrays
+    of sizes at once. Returns arrays of bucket widths and heights, identical to calling it per image.
+    """
+    widths = np.asarray(widths, dtype=np.int64)
+    heights = np.asarray(heights, dtype=np.int64)
+    bucket_widths = np.empty_like(widths)
+    bucket_heights = np.empty_like(heights)
+    if len(widths) == 0:
+        return bucket_widths, bucket_heights
+
+    # if real resolution is smaller, that is used instead, so group by the resolution each image ends up with
+    image_resolutions = np.minimum(resolution, get_resolutions(widths, heights))
+    for image_resolution in np.unique(image_resolutions):
+        table = get_bucket_table(int(image_resolution), divisibility)
+        group_idx = np.flatnonzero(image_resolutions == image_resolution)
+        for start_idx in range(0, len(group_idx), BUCKET_CHUNK_SIZE):
+            chunk_idx = group_idx[start_idx:start_idx + BUCKET_CHUNK_SIZE]
+            bucket_idx = _closest_buckets(widths[chunk_idx], heights[chunk_idx], table)
+            bucket_widths[chunk_idx] = table[bucket_idx, 0]
+            bucket_heights[chunk_idx] = table[bucket_idx, 1]
+    return bucket_widths, bucket_heights
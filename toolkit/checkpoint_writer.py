@@ -0,0 +1,139 @@
+import os
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+
+import torch
+from safetensors.torch import save_file
+
+from toolkit.print import print_acc
+
+
+def _tmp_path(path: str) -> str:
+    # keep the extension last so nothing globbing for it picks up a half written file
+    root, ext = os.path.splitext(path)
+    return f"{root}.tmp{ext}.partial"
+
+
+def _fsync_and_replace(tmp_path: str, path: str):
+    with open(tmp_path, 'rb') as f:
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def atomic_save_file(state_dict: Dict[str, torch.Tensor], path: str, metadata: Optional[Dict[str, str]] = None):
+    # write to a temp file and rename it in place, a crash never leaves a truncated checkpoint
+    tmp_path = _tmp_path(path)
+    try:
+        save_file(state_dict, tmp_path, metadata=metadata)
+        _fsync_and_replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def atomic_torch_save(obj: Any, path: str):
+    tmp_path = _tmp_path(path)
+    try:
+        torch.save(obj, tmp_path)
+        _fsync_and_replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+class CheckpointWriter:
+    """
+    Writes checkpoints on a background thread so the training loop does not wait on
+    serialization, hashing and disk io.
+
+    snapshot() copies tensors into pinned cpu buffers with non blocking copies queued on the
+    current cuda stream, so it returns as soon as the copies are queued. submit() hands the
+    snapshot and a write function to the worker, which waits for the copies to land before
+    calling it. Only one write is in flight at a time. A new snapshot first waits for the
+    previous write to finish, which lets the pinned buffers be reused between saves instead
+    of allocating them every time.
+
+    An exception raised by a write is raised again on the training thread by the next
+    snapshot(), submit() or wait().
+    """
+
+    def __init__(self):
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='checkpoint_writer')
+        self._pending: Optional[Future] = None
+        self._buffers: Dict[str, torch.Tensor] = {}
+        self._copy_event: Optional[torch.cuda.Event] = None
+
+    def wait(self):
+        # block until the in flight write is on disk
+        if self._pending is None:
+            return
+        future = self._pending
+        self._pending = None
+        wait_start = time.perf_counter()
+        future.result()
+        wait_time = time.perf_counter() - wait_start
+        if wait_time > 1.0:
+            print_acc(f"Waited {wait_time:.1f}s for the previous checkpoint write")
+
+    def _get_buffer(self, key: str, tensor: torch.Tensor, dtype: torch.dtype) -> torch.Tensor:
+        buffer = self._buffers.get(key, None)
+        if buffer is None or buffer.shape != tensor.shape or buffer.dtype != dtype:
+            buffer = torch.empty(
+                tensor.shape,
+                dtype=dtype,
+                device='cpu',
+                pin_memory=torch.cuda.is_available()
+            )
+            self._buffers[key] = buffer
+        return buffer
+
+    def _snapshot(self, value: Any, key: str, dtype: Optional[torch.dtype]) -> Any:
+        if isinstance(value, torch.Tensor):
+            value = value.detach()
+            target_dtype = dtype if dtype is not None and value.is_floating_point() else value.dtype
+            buffer = self._get_buffer(key, value, target_dtype)
+            buffer.copy_(value, non_blocking=value.device.type == 'cuda')
+            return buffer
+        if isinstance(value, dict):
+            snapshot = OrderedDict() if isinstance(value, OrderedDict) else {}
+            for k, v in value.items():
+                snapshot[k] = self._snapshot(v, f"{key}.{k}", dtype)
+            return snapshot
+        if isinstance(value, (list, tuple)):
+            return type(value)(self._snapshot(v, f"{key}.{i}", dtype) for i, v in enumerate(value))
+        return value
+
+    def snapshot(self, value: Any, name: str, dtype: Optional[torch.dtype] = None) -> Any:
+        """
+        Returns a copy of value (a tensor or dicts/lists of them) in pinned cpu memory. Floating
+        point tensors are cast to dtype if it is given. name keys the reused buffers, so it has
+        to be unique for each thing snapshotted for one save.
+        """
+        # the buffers may still be being written from
+        self.wait()
+        snapshot = self._snapshot(value, name, dtype)
+        if torch.cuda.is_available():
+            self._copy_event = torch.cuda.Event()
+            self._copy_event.record()
+        return snapshot
+
+    def _run(self, copy_event: Optional[torch.cuda.Event], write_fn: Callable, args: tuple, kwargs: dict):
+        if copy_event is not None:
+            copy_event.synchronize()
+        write_fn(*args, **kwargs)
+
+    def submit(self, write_fn: Callable, *args, **kwargs):
+        # call write_fn(*args, **kwargs) on the worker once the snapshot copies are done
+        self.wait()
+        copy_event = self._copy_event
+        self._copy_event = None
+        self._pending = self._executor.submit(self._run, copy_event, write_fn, args, kwargs)
+
+    def close(self):
+        try:
+            self.wait()
+        finally:
+            self._executor.shutdown(wait=True)
+            self._buffers = {}
@@ -29,6 +29,8 @@ class SaveConfig:
         self.push_to_hub: bool = kwargs.get("push_to_hub", False)
         self.hf_repo_id: Optional[str] = kwargs.get("hf_repo_id", None)
         self.hf_private: Optional[str] = kwargs.get("hf_private", False)
+        # write LoRA and optimizer checkpoints on a background thread so training is not blocked
+        self.async_save: bool = kwargs.get("async_save", False)
 
 class LoggingConfig:
     def __init__(self, **kwargs):
@@ -36,6 +38,8 @@ class LoggingConfig:
         self.verbose: bool = kwargs.get('verbose', False)
         self.use_wandb: bool = kwargs.get('use_wandb', False)
         self.use_ui_logger: bool = kwargs.get('use_ui_logger', False)
+        # write the ui logger database on a background thread so sqlite commits never stall a step
+        self.ui_logger_async: bool = kwargs.get('ui_logger_async', False)
         self.project_name: str = kwargs.get('project_name', 'ai-toolkit')
         self.run_name: str = kwargs.get('run_name', None)
 
@@ -94,6 +98,14 @@ class SampleConfig:
         self.extra_values = kwargs.get('extra_values', [])
         self.num_frames = kwargs.get('num_frames', 1)
         self.fps: int = kwargs.get('fps', 16)
+        # samples that share size, steps, guidance and multiplier are generated this many at a time.
+        # seeds are per sample, so they match generating them one at a time
+        self.batch_size: int = kwargs.get('batch_size', 1)
+        # merge the network into the model at every sample's multiplier instead of only when they all match.
+        # a multiplier change adds the lora delta in place. To restore exactly, the original weights of the
+        # merged layers are copied to pinned cpu ram once and kept for the run, about the size of the lora
+        # targeted weights in host memory, no extra vram. Offloaded layers are not merged, they run the lora
+        self.cached_merge: bool = kwargs.get('cached_merge', False)
         if self.num_frames > 1 and self.ext not in ['webp']:
             print("Changing sample extention to animated webp")
             self.ext = 'webp'
@@ -219,6 +231,12 @@ class NetworkConfig:
         # start from a pretrained lora
         self.pretrained_lora_path = kwargs.get('pretrained_lora_path', None)
 
+        # run plain lora linear/conv modules through ToolkitModuleMixin._fused_forward
+        self.fused_forward = kwargs.get('fused_forward', False)
+        # run the loras of sibling projections that share an input, like to_q/to_k/to_v, as one group when
+        # sampling. Not bit identical to running them one by one, see scripts/benchmark_grouped_lora.py
+        self.grouped_forward = kwargs.get('grouped_forward', False)
+
 
 AdapterTypes = Literal['t2i', 'ip', 'ip+', 'clip', 'ilora', 'photo_maker', 'control_net', 'control_lora', 'i2v']
 
@@ -523,6 +541,12 @@ class TrainConfig:
         self.unload_text_encoder = kwargs.get('unload_text_encoder', False)
         # will toggle all datasets to cache text embeddings
         self.cache_text_embeddings: bool = kwargs.get('cache_text_embeddings', False)
+        # encode prompts for text embedding caching and cached sample prompts through a content addressed
+        # cache shared by every dataset and job. memory tier is an lru of text_embedding_cache_memory_mb
+        self.text_embedding_cache: bool = kwargs.get('text_embedding_cache', False)
+        # defaults to TEXT_EMBEDDING_CACHE_PATH
+        self.text_embedding_cache_dir: Optional[str] = kwargs.get('text_embedding_cache_dir', None)
+        self.text_embedding_cache_memory_mb: float = kwargs.get('text_embedding_cache_memory_mb', 1024)
         # for swapping which parameters are trained during training
         self.do_paramiter_swapping = kwargs.get('do_paramiter_swapping', False)
         # 0.1 is 10% of the parameters active at a time lower is less vram, higher is more
@@ -671,6 +695,24 @@ class ModelConfig:
         # 0 is off and 1.0 is 100% of the layers
         self.layer_offloading_transformer_percent = kwargs.get("layer_offloading_transformer_percent", 1.0)
         self.layer_offloading_text_encoder_percent = kwargs.get("layer_offloading_text_encoder_percent", 1.0)
+        # vram in GB the layer weights may keep resident instead of a percent. The layers holding the most
+        # bytes that fit are kept and the rest is offloaded. Takes priority over the percent
+        self.layer_offloading_transformer_vram_gb: Optional[float] = kwargs.get("layer_offloading_transformer_vram_gb", None)
+        self.layer_offloading_text_encoder_vram_gb: Optional[float] = kwargs.get("layer_offloading_text_encoder_vram_gb", None)
+        # number of offloaded layers to copy to the gpu ahead of the one running. 0 copies each layer
+        # when it is called. The execution order is recorded on the first step
+        self.layer_offloading_prefetch: int = int(kwargs.get("layer_offloading_prefetch", 0))
+        # gpu buffers in the prefetch ring, each the size of the largest offloaded layer. defaults to prefetch + 1
+        self.layer_offloading_prefetch_buffers: Optional[int] = kwargs.get("layer_offloading_prefetch_buffers", None)
+        # pinned host ram in GB the offloaded layer weights may use. The rest is memory mapped from a file in
+        # layer_offloading_disk_path and read through a small pinned staging pool when needed. None pins all of them
+        self.layer_offloading_transformer_pinned_ram_gb: Optional[float] = kwargs.get("layer_offloading_transformer_pinned_ram_gb", None)
+        self.layer_offloading_text_encoder_pinned_ram_gb: Optional[float] = kwargs.get("layer_offloading_text_encoder_pinned_ram_gb", None)
+        # place groups of layers by hand, fnmatch pattern of the module name -> "gpu", "pinned" or "disk".
+        # ex {"single_transformer_blocks.*": "disk"}. First match wins, they count against the budget of their tier
+        self.layer_offloading_tiers: Dict[str, str] = kwargs.get("layer_offloading_tiers", {})
+        # local directory for the disk tier, ideally nvme. Defaults to cache/offload in the toolkit root
+        self.layer_offloading_disk_path: Optional[str] = kwargs.get("layer_offloading_disk_path", None)
 
         # can be used to load the extras like text encoder or vae from here
         # only setup for some models but will prevent having to download the te for
@@ -922,12 +964,26 @@ class DatasetConfig:
                                                 None)  # if one is set and in json data, will be used as auto crop scale point of interes
         self.use_short_captions: bool = kwargs.get('use_short_captions', False)  # if true, will use 'caption_short' from json
         self.num_repeats: int = kwargs.get('num_repeats', 1)  # number of times to repeat dataset
+        # relative number of samples drawn from this dataset per epoch, used by global_buckets
+        self.sampling_weight: float = float(kwargs.get('sampling_weight', 1.0))
         # cache latents will store them in memory
         self.cache_latents: bool = kwargs.get('cache_latents', False)
         # cache latents to disk will store them on disk. If both are true, it will save to disk, but keep in memory
         self.cache_latents_to_disk: bool = kwargs.get('cache_latents_to_disk', False)
         self.cache_clip_vision_to_disk: bool = kwargs.get('cache_clip_vision_to_disk', False)
         self.cache_text_embeddings: bool = kwargs.get('cache_text_embeddings', False)
+        # number of captions to encode per text encoder call when caching text embeddings. Identical captions
+        # are only encoded once. Captions encoded with control images are still encoded one at a time, and all
+        # of them are when a probe batch does not reproduce the one at a time embeddings exactly
+        self.cache_text_embeddings_batch_size: int = int(kwargs.get('cache_text_embeddings_batch_size', 1))
+        # number of images to encode per vae call when caching latents. Images are grouped by bucket
+        # resolution so a batch is always the same size. 1 encodes one at a time like before
+        self.cache_latents_batch_size: int = int(kwargs.get('cache_latents_batch_size', 1))
+        # how latents cached to disk are stored. 'file' is one safetensors file per image in _latent_cache.
+        # 'sharded' packs them into a few large shard files with an index, see toolkit/latent_shards.py
+        self.latent_cache_format: str = kwargs.get('latent_cache_format', 'file')
+        if self.latent_cache_format not in ['file', 'sharded']:
+            raise ValueError(f"invalid latent_cache_format: {self.latent_cache_format}, must be 'file' or 'sharded'")
 
         self.standardize_images: bool = kwargs.get('standardize_images', False)
 
@@ -960,6 +1016,14 @@ class DatasetConfig:
         self.loss_multiplier: float = kwargs.get('loss_multiplier', 1.0)
 
         self.num_workers: int = kwargs.get('num_workers', 2)
+        # processes used to probe image and video sizes when indexing the dataset. 0 does it in the main process
+        self.index_num_workers: int = kwargs.get('index_num_workers', min(8, os.cpu_count() or 1))
+        # pack the file items into a columnar table after setup, see toolkit/file_table.py. Dataloader workers
+        # then hold a few numpy arrays instead of a python object per item. For datasets with millions of files
+        self.compact_file_table: bool = kwargs.get('compact_file_table', False)
+        # batch buckets across all datasets instead of per dataset, so every batch is full.
+        # read from the first dataset, like num_workers. See toolkit/bucket_sampler.py
+        self.global_buckets: bool = kwargs.get('global_buckets', False)
         self.prefetch_factor: int = kwargs.get('prefetch_factor', 2)
         self.extra_values: List[float] = kwargs.get('extra_values', [])
         self.square_crop: bool = kwargs.get('square_crop', False)
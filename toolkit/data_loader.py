@@ -1,4 +1,3 @@
-import copy
 import json
 import os
 import random
@@ -18,9 +17,12 @@ import albumentations as A
 
 from toolkit import image_utils
 from toolkit.buckets import get_bucket_for_image_size, BucketResolution
+from toolkit.bucket_sampler import BucketItemDataset, GlobalBucketBatchSampler
 from toolkit.config_modules import DatasetConfig, preprocess_dataset_raw_config
 from toolkit.dataloader_mixins import CaptionMixin, BucketsMixin, LatentCachingMixin, Augments, CLIPCachingMixin, ControlCachingMixin, TextEmbeddingCachingMixin
 from toolkit.data_transfer_object.data_loader import FileItemDTO, DataLoaderBatchDTO
+from toolkit.dataset_index import DatasetIndexStore, get_size_database_key, index_dataset_files
+from toolkit.file_table import FileTable
 from toolkit.print import print_acc
 from toolkit.accelerator import get_accelerator
 
@@ -467,25 +469,11 @@ class AiToolkitDataset(LatentCachingMixin, ControlCachingMixin, CLIPCachingMixin
         if not os.path.isdir(self.dataset_path):
             dataset_folder = os.path.dirname(dataset_folder)
         
-        dataset_size_file = os.path.join(dataset_folder, '.aitk_size.json')
-        dataloader_version = "0.1.2"
-        if os.path.exists(dataset_size_file):
-            try:
-                with open(dataset_size_file, 'r') as f:
-                    self.size_database = json.load(f)
-                
-                if "__version__" not in self.size_database or self.size_database["__version__"] != dataloader_version:
-                    print_acc("Upgrading size database to new version")
-                    # old version, delete and recreate
-                    self.size_database = {}
-            except Exception as e:
-                print_acc(f"Error loading size database: {dataset_size_file}")
-                print_acc(e)
-                self.size_database = {}
-        else:
-            self.size_database = {}
-        
-        self.size_database["__version__"] = dataloader_version
+        # per file metadata lives in a sqlite index in the dataset folder. Only load the entries we need
+        self.dataset_index = DatasetIndexStore(dataset_folder)
+        self.size_database = self.dataset_index.load_size_database(
+            [get_size_database_key(x, dataset_folder) for x in file_list]
+        )
 
         # set latent space version
         latent_space_version = "sd1"
@@ -504,12 +492,23 @@ class AiToolkitDataset(LatentCachingMixin, ControlCachingMixin, CLIPCachingMixin
         else:
             latent_space_version = self.sd.model_config.arch if self.sd is not None else "sd1"
         
+        # probe sizes of new and changed files in parallel. File items then read them from the size database
+        file_signatures = index_dataset_files(
+            file_list,
+            dataset_root=dataset_folder,
+            size_database=self.size_database,
+            is_video=self.is_video,
+            fast_image_size=self.dataset_config.fast_image_size,
+            num_workers=0 if is_native_windows() else self.dataset_config.index_num_workers,
+        )
+
         bad_count = 0
         for file in tqdm(file_list):
             try:
                 file_item = FileItemDTO(
                     sd=self.sd,
                     path=file,
+                    file_signature=file_signatures.get(file, None),
                     dataset_config=dataset_config,
                     dataloader_transforms=self.transform,
                     size_database=self.size_database,
@@ -529,9 +528,10 @@ class AiToolkitDataset(LatentCachingMixin, ControlCachingMixin, CLIPCachingMixin
                 print_acc(e)
                 bad_count += 1
 
-        # save the size database
-        with open(dataset_size_file, 'w') as f:
-            json.dump(self.size_database, f)
+        # save new and changed entries
+        self.dataset_index.save_size_database(self.size_database)
+        # no need to keep it around
+        self.size_database = None
         
         if self.is_video:
             print_acc(f"  -  Found {len(self.file_list)} videos")
@@ -546,7 +546,7 @@ class AiToolkitDataset(LatentCachingMixin, ControlCachingMixin, CLIPCachingMixin
             current_file_list = [x for x in self.file_list]
             for file_item in current_file_list:
                 # create a copy that is flipped on the x axis
-                new_file_item = copy.deepcopy(file_item)
+                new_file_item = file_item.clone()
                 new_file_item.flip_x = True
                 self.file_list.append(new_file_item)
 
@@ -556,7 +556,7 @@ class AiToolkitDataset(LatentCachingMixin, ControlCachingMixin, CLIPCachingMixin
             current_file_list = [x for x in self.file_list]
             for file_item in current_file_list:
                 # create a copy that is flipped on the y axis
-                new_file_item = copy.deepcopy(file_item)
+                new_file_item = file_item.clone()
                 new_file_item.flip_y = True
                 self.file_list.append(new_file_item)
 
@@ -566,8 +566,26 @@ class AiToolkitDataset(LatentCachingMixin, ControlCachingMixin, CLIPCachingMixin
             else:
                 print_acc(f"  -  Found {len(self.file_list)} images after adding flips")
 
+        # sizes, crops, flips and buckets live in numpy columns
+        self.file_table = FileTable(self.file_list)
+
         self.setup_epoch()
 
+        if self.dataset_config.compact_file_table:
+            self.pack_file_table()
+
+    def pack_file_table(self):
+        # move the file items into the table so workers do not hold a python object per item
+        num_items = len(self.file_list)
+        if not self.file_table.pack_file_items(self.file_list):
+            print_acc(f"  -  Could not pack file items into a compact table, keeping the file list")
+            return
+        self.file_list = None
+        print_acc(
+            f"  -  Packed {num_items} file items into a {self.file_table.nbytes / 1024 / 1024:.1f} MB table, "
+            f"{self.file_table.paths.num_unique} paths, {self.file_table.num_rows} unique rows"
+        )
+
     def setup_epoch(self):
         if self.epoch_num == 0:
             # initial setup
@@ -594,10 +612,14 @@ class AiToolkitDataset(LatentCachingMixin, ControlCachingMixin, CLIPCachingMixin
     def __len__(self):
         if self.dataset_config.buckets:
             return len(self.batch_indices)
-        return len(self.file_list)
+        return len(self.file_table)
 
     def _get_single_item(self, index) -> 'FileItemDTO':
-        file_item: 'FileItemDTO' = copy.deepcopy(self.file_list[index])
+        if self.file_list is None:
+            # packed into the table
+            file_item: 'FileItemDTO' = self.file_table.get_file_item(index)
+        else:
+            file_item: 'FileItemDTO' = self.file_list[index].clone()
         file_item.load_and_process_image(self.transform)
         file_item.load_caption(self.caption_dict)
         return file_item
@@ -679,6 +701,17 @@ def get_dataloader_from_datasets(
         for dataset in datasets:
             assert dataset.dataset_config.buckets, f"buckets not found on dataset {dataset.dataset_config.folder_path}, you either need all buckets or none"
 
+        if dataset_config_list[0].global_buckets:
+            # batch same size items from all datasets together
+            item_dataset = BucketItemDataset(datasets)
+            data_loader = DataLoader(
+                item_dataset,
+                batch_sampler=GlobalBucketBatchSampler(item_dataset, batch_size=batch_size),
+                collate_fn=dto_collation,
+                **dataloader_kwargs
+            )
+            return data_loader
+
         data_loader = DataLoader(
             concatenated_dataset,
             batch_size=None,  # we batch in the datasets for now
@@ -1,13 +1,10 @@
-import os
+import copy
 from typing import TYPE_CHECKING, List, Union
-import cv2
 import torch
+from torch.utils.data import get_worker_info
 
-from PIL import Image
-from PIL.ImageOps import exif_transpose
-
-from toolkit import image_utils
 from toolkit.basic import get_quick_signature_string
+from toolkit.dataset_index import get_size_database_key, probe_file_info
 from toolkit.dataloader_mixins import (
     CaptionProcessingDTOMixin,
     ImageProcessingDTOMixin,
@@ -37,6 +34,31 @@ def print_once(msg):
         printed_messages.append(msg)
 
 
+def stack_into_batch(tensors: List[Union[torch.Tensor, None]]) -> torch.Tensor:
+    """
+    Stacks tensors into one preallocated batch tensor, missing items are zeros. Replaces
+    torch.cat of unsqueezed items, which copies every item twice. The batch is pinned when
+    cuda is available and we are not in a dataloader worker, which cannot touch cuda.
+    """
+    base_tensor = None
+    for x in tensors:
+        if x is not None:
+            base_tensor = x
+            break
+    pin_memory = torch.cuda.is_available() and get_worker_info() is None
+    batch = torch.empty(
+        (len(tensors),) + tuple(base_tensor.shape),
+        dtype=base_tensor.dtype,
+        pin_memory=pin_memory,
+    )
+    for i, x in enumerate(tensors):
+        if x is None:
+            batch[i].zero_()
+        else:
+            batch[i].copy_(x)
+    return batch
+
+
 class FileItemDTO(
     LatentCachingFileItemDTOMixin,
     TextEmbeddingFileItemDTOMixin,
@@ -63,13 +85,12 @@ class FileItemDTO(
         self.te_padding_side = kwargs.get("te_padding_side", "right")
         self.latent_space_version = kwargs.get("latent_space_version", "sd1")
         self.text_embedding_space_version = kwargs.get("text_embedding_space_version", "sd1")
-        if dataset_root is not None:
-            # remove dataset root from path
-            file_key = self.path.replace(dataset_root, "")
-        else:
-            file_key = os.path.basename(self.path)
+        file_key = get_size_database_key(self.path, dataset_root)
 
-        file_signature = get_quick_signature_string(self.path)
+        # the dataset indexes files up front and passes the signature in
+        file_signature = kwargs.get("file_signature", None)
+        if file_signature is None:
+            file_signature = get_quick_signature_string(self.path)
         if file_signature is None:
             raise Exception("Error: Could not get file signature for {self.path}")
 
@@ -84,39 +105,14 @@ class FileItemDTO(
                 use_db_entry = True
 
         if use_db_entry:
-            w, h, _ = size_database[file_key]
-        elif self.is_video:
-            # Open the video file
-            video = cv2.VideoCapture(self.path)
-
-            # Check if video opened successfully
-            if not video.isOpened():
-                raise Exception(f"Error: Could not open video file {self.path}")
-
-            # Get width and height
-            width = int(video.get(cv2.CAP_PROP_FRAME_WIDTH))
-            height = int(video.get(cv2.CAP_PROP_FRAME_HEIGHT))
-            w, h = width, height
-
-            # Release the video capture object immediately
-            video.release()
-            size_database[file_key] = (width, height, file_signature)
+            w, h = size_database[file_key][:2]
         else:
-            if self.dataset_config.fast_image_size:
-                # original method is significantly faster, but some images are read sideways. Not sure why. Do slow method by default.
-                try:
-                    w, h = image_utils.get_image_size(self.path)
-                except image_utils.UnknownImageFormat:
-                    print_once(
-                        f"Warning: Some images in the dataset cannot be fast read. "
-                        + f"This process is faster for png, jpeg"
-                    )
-                    img = exif_transpose(Image.open(self.path))
-                    w, h = img.size
-            else:
-                img = exif_transpose(Image.open(self.path))
-                w, h = img.size
-            size_database[file_key] = (w, h, file_signature)
+            w, h, frame_count, fps = probe_file_info(
+                self.path,
+                is_video=self.is_video,
+                fast_image_size=self.dataset_config.fast_image_size,
+            )
+            size_database[file_key] = (w, h, file_signature, frame_count, fps)
         self.width: int = w
         self.height: int = h
         self.dataloader_transforms = kwargs.get("dataloader_transforms", None)
@@ -148,6 +144,19 @@ class FileItemDTO(
         self.audio_data = None
         self.audio_tensor = None
 
+    def clone(self) -> "FileItemDTO":
+        """
+        Cheap copy for per sample items and flipped copies, replaces copy.deepcopy. The dataset config,
+        paths, captions and cached latents are shared with the original. Lists and dicts are copied one
+        level so they can be changed on the copy. Per step tensors are always rebound when loaded,
+        never changed in place, so sharing them is safe.
+        """
+        new_item = copy.copy(self)
+        for key, value in self.__dict__.items():
+            if isinstance(value, (list, dict, set)):
+                new_item.__dict__[key] = copy.copy(value)
+        return new_item
+
     def cleanup(self):
         self.tensor = None
         self.audio_data = None
@@ -206,33 +215,18 @@ class DataLoaderBatchDTO:
             # if we have encoded latents, we concatenate them
             self.latents: Union[torch.Tensor, None] = None
             if is_latents_cached:
-                # this get_latent call with trigger loading all cached items from the disk
-                self.latents = torch.cat(
-                    [x.get_latent().unsqueeze(0) for x in self.file_items]
-                )
+                # this get_latent call with trigger loading all cached items from the disk.
+                # they are memory mapped, so each is copied once, straight into the batch
+                self.latents = stack_into_batch([x.get_latent() for x in self.file_items])
                 if any(
                     [x._cached_first_frame_latent is not None for x in self.file_items]
                 ):
-                    self.first_frame_latents = torch.cat(
-                        [
-                            x._cached_first_frame_latent.unsqueeze(0)
-                            if x._cached_first_frame_latent is not None
-                            else torch.zeros_like(
-                                self.file_items[0]._cached_first_frame_latent
-                            ).unsqueeze(0)
-                            for x in self.file_items
-                        ]
+                    self.first_frame_latents = stack_into_batch(
+                        [x._cached_first_frame_latent for x in self.file_items]
                     )
                 if any([x._cached_audio_latent is not None for x in self.file_items]):
-                    self.audio_latents = torch.cat(
-                        [
-                            x._cached_audio_latent.unsqueeze(0)
-                            if x._cached_audio_latent is not None
-                            else torch.zeros_like(
-                                self.file_items[0]._cached_audio_latent
-                            ).unsqueeze(0)
-                            for x in self.file_items
-                        ]
+                    self.audio_latents = stack_into_batch(
+                        [x._cached_audio_latent for x in self.file_items]
                     )
 
             self.prompt_embeds: Union[PromptEmbeds, None] = None
@@ -6,7 +6,7 @@ import math
 import os
 import random
 from collections import OrderedDict
-from typing import TYPE_CHECKING, List, Dict, Union
+from typing import TYPE_CHECKING, List, Dict, Optional, Union
 import traceback
 
 import cv2
@@ -18,10 +18,14 @@ from transformers import CLIPImageProcessor, CLIPVisionModelWithProjection, Sigl
 
 from toolkit.audio.preserve_pitch import time_stretch_preserve_pitch
 from toolkit.basic import flush, value_map
-from toolkit.buckets import get_bucket_for_image_size, get_resolution
+from toolkit.buckets import get_bucket_for_image_size, get_buckets_for_image_sizes, get_resolution
 from toolkit.config_modules import ControlTypes
 from toolkit.control_generator import ControlGenerator
+from toolkit.file_table import BatchIndices
+from toolkit.latent_shards import flush_latent_shard_stores, get_latent_shard_store, load_latent_file_mmap
 from toolkit.metadata import get_meta_for_safetensors
+from toolkit.prefetch import PrefetchPool
+from toolkit.text_embedding_cache import BatchedPromptEncoder, TextEmbeddingCache, hash_control_images
 from toolkit.models.pixtral_vision import PixtralVisionImagePreprocessorCompatible
 from toolkit.prompt_utils import inject_trigger_into_prompt
 from torchvision import transforms
@@ -38,6 +42,7 @@ from toolkit.train_tools import get_torch_dtype
 if TYPE_CHECKING:
     from toolkit.data_loader import AiToolkitDataset
     from toolkit.data_transfer_object.data_loader import FileItemDTO
+    from toolkit.file_table import FileTable
     from toolkit.stable_diffusion_model import StableDiffusion
 
 accelerator = get_accelerator()
@@ -181,23 +186,36 @@ class Bucket:
 class BucketsMixin:
     def __init__(self):
         self.buckets: Dict[str, Bucket] = {}
-        self.batch_indices: List[List[int]] = []
+        self.batch_indices: Union[List[List[int]], BatchIndices] = []
 
     def build_batch_indices(self: 'AiToolkitDataset'):
-        self.batch_indices = []
+        # one flat array of file indexes in batch order, each bucket split into batches
+        flat_indices = []
+        batch_sizes = []
         for key, bucket in self.buckets.items():
-            for start_idx in range(0, len(bucket.file_list_idx), self.batch_size):
-                end_idx = min(start_idx + self.batch_size, len(bucket.file_list_idx))
-                batch = bucket.file_list_idx[start_idx:end_idx]
-                self.batch_indices.append(batch)
+            bucket_len = len(bucket.file_list_idx)
+            if bucket_len == 0:
+                continue
+            flat_indices.append(np.asarray(bucket.file_list_idx, dtype=np.int64))
+            num_full = bucket_len // self.batch_size
+            batch_sizes.append(np.full(num_full, self.batch_size, dtype=np.int64))
+            if bucket_len % self.batch_size != 0:
+                batch_sizes.append(np.array([bucket_len % self.batch_size], dtype=np.int64))
+        if len(flat_indices) == 0:
+            self.batch_indices = BatchIndices(np.zeros(0, dtype=np.int64), np.zeros(1, dtype=np.int64))
+            return
+        batch_sizes = np.concatenate(batch_sizes)
+        offsets = np.zeros(len(batch_sizes) + 1, dtype=np.int64)
+        np.cumsum(batch_sizes, out=offsets[1:])
+        self.batch_indices = BatchIndices(np.concatenate(flat_indices), offsets)
 
     def shuffle_buckets(self: 'AiToolkitDataset'):
         for key, bucket in self.buckets.items():
             random.shuffle(bucket.file_list_idx)
 
     def setup_buckets(self: 'AiToolkitDataset', quiet=False):
-        if not hasattr(self, 'file_list'):
-            raise Exception(f'file_list not found on class instance {self.__class__.__name__}')
+        if not hasattr(self, 'file_table'):
+            raise Exception(f'file_table not found on class instance {self.__class__.__name__}')
         if not hasattr(self, 'dataset_config'):
             raise Exception(f'dataset_config not found on class instance {self.__class__.__name__}')
 
@@ -210,76 +228,97 @@ class BucketsMixin:
         config: 'DatasetConfig' = self.dataset_config
         resolution = config.resolution
         bucket_tolerance = config.bucket_tolerance
-        file_list: List['FileItemDTO'] = self.file_list
-
-        # for file_item in enumerate(file_list):
-        for idx, file_item in enumerate(file_list):
-            file_item: 'FileItemDTO' = file_item
-            width = int(file_item.width * file_item.dataset_config.scale)
-            height = int(file_item.height * file_item.dataset_config.scale)
-
-            did_process_poi = False
-            if file_item.has_point_of_interest:
-                # Attempt to process the poi if we can. It wont process if the image is smaller than the resolution
-                did_process_poi = file_item.setup_poi_bucket()
-            if self.dataset_config.square_crop:
-                # we scale first so smallest size matches resolution
-                scale_factor_x = resolution / width
-                scale_factor_y = resolution / height
-                scale_factor = max(scale_factor_x, scale_factor_y)
-                file_item.scale_to_width = math.ceil(width * scale_factor)
-                file_item.scale_to_height = math.ceil(height * scale_factor)
-                file_item.crop_width = resolution
-                file_item.crop_height = resolution
-                if width > height:
-                    file_item.crop_x = int(file_item.scale_to_width / 2 - resolution / 2)
-                    file_item.crop_y = 0
-                else:
-                    file_item.crop_x = 0
-                    file_item.crop_y = int(file_item.scale_to_height / 2 - resolution / 2)
-            elif not did_process_poi:
-                bucket_resolution = get_bucket_for_image_size(
-                    width, height,
-                    resolution=resolution,
-                    divisibility=bucket_tolerance
-                )
-
-                # Calculate scale factors for width and height
-                width_scale_factor = bucket_resolution["width"] / width
-                height_scale_factor = bucket_resolution["height"] / height
-
-                # Use the maximum of the scale factors to ensure both dimensions are scaled above the bucket resolution
-                max_scale_factor = max(width_scale_factor, height_scale_factor)
-
-                # round up
-                file_item.scale_to_width = int(math.ceil(width * max_scale_factor))
-                file_item.scale_to_height = int(math.ceil(height * max_scale_factor))
+        file_table: 'FileTable' = self.file_table
+        # the list is gone once the items are packed into the table
+        file_list: Union[List['FileItemDTO'], None] = self.file_list
 
-                file_item.crop_height = bucket_resolution["height"]
-                file_item.crop_width = bucket_resolution["width"]
+        # work on the table columns, every item is bucketed at once
+        widths = (file_table.width * config.scale).astype(np.int64)
+        heights = (file_table.height * config.scale).astype(np.int64)
 
-                new_width = bucket_resolution["width"]
-                new_height = bucket_resolution["height"]
-
-                if self.dataset_config.random_crop:
-                    # random crop
-                    crop_x = random.randint(0, file_item.scale_to_width - new_width)
-                    crop_y = random.randint(0, file_item.scale_to_height - new_height)
-                    file_item.crop_x = crop_x
-                    file_item.crop_y = crop_y
-                else:
-                    # do central crop
-                    file_item.crop_x = int((file_item.scale_to_width - new_width) / 2)
-                    file_item.crop_y = int((file_item.scale_to_height - new_height) / 2)
-
-                if file_item.crop_y < 0 or file_item.crop_x < 0:
-                    print_acc('debug')
-
-            # check if bucket exists, if not, create it
-            bucket_key = f'{file_item.crop_width}x{file_item.crop_height}'
-            if bucket_key not in self.buckets:
-                self.buckets[bucket_key] = Bucket(file_item.crop_width, file_item.crop_height)
-            self.buckets[bucket_key].file_list_idx.append(idx)
+        bucket_widths, bucket_heights = get_buckets_for_image_sizes(
+            widths, heights,
+            resolution=resolution,
+            divisibility=bucket_tolerance
+        )
+        # Use the maximum of the scale factors to ensure both dimensions are scaled above the bucket resolution
+        max_scale_factor = np.maximum(bucket_widths / widths, bucket_heights / heights)
+        # round up
+        scale_to_width = np.ceil(widths * max_scale_factor).astype(np.int64)
+        scale_to_height = np.ceil(heights * max_scale_factor).astype(np.int64)
+        crop_width = bucket_widths.copy()
+        crop_height = bucket_heights.copy()
+        # do central crop
+        crop_x = ((scale_to_width - crop_width) / 2).astype(np.int64)
+        crop_y = ((scale_to_height - crop_height) / 2).astype(np.int64)
+
+        # poi and random crops use the global random state, so they go in file order to keep the same sequence
+        has_point_of_interest = config.poi is not None
+        do_random_crop = self.dataset_config.random_crop and not self.dataset_config.square_crop
+        if has_point_of_interest or do_random_crop:
+            for idx in range(len(file_table)):
+                did_process_poi = False
+                if has_point_of_interest:
+                    # Attempt to process the poi if we can. It wont process if the image is smaller than the resolution
+                    file_item = file_list[idx] if file_list is not None else file_table.get_file_item(idx)
+                    did_process_poi = file_item.setup_poi_bucket()
+                    if did_process_poi:
+                        scale_to_width[idx] = file_item.scale_to_width
+                        scale_to_height[idx] = file_item.scale_to_height
+                        crop_x[idx] = file_item.crop_x
+                        crop_y[idx] = file_item.crop_y
+                        crop_width[idx] = file_item.crop_width
+                        crop_height[idx] = file_item.crop_height
+                if do_random_crop and not did_process_poi:
+                    crop_x[idx] = random.randint(0, int(scale_to_width[idx] - crop_width[idx]))
+                    crop_y[idx] = random.randint(0, int(scale_to_height[idx] - crop_height[idx]))
+
+        if self.dataset_config.square_crop:
+            # we scale first so smallest size matches resolution
+            scale_factor = np.maximum(resolution / widths, resolution / heights)
+            scale_to_width = np.ceil(widths * scale_factor).astype(np.int64)
+            scale_to_height = np.ceil(heights * scale_factor).astype(np.int64)
+            crop_width = np.full_like(widths, resolution)
+            crop_height = np.full_like(heights, resolution)
+            is_wide = widths > heights
+            crop_x = np.where(is_wide, (scale_to_width / 2 - resolution / 2).astype(np.int64), 0)
+            crop_y = np.where(is_wide, 0, (scale_to_height / 2 - resolution / 2).astype(np.int64))
+        elif np.any((crop_x < 0) | (crop_y < 0)):
+            print_acc('debug')
+
+        file_table.scale_to_width[:] = scale_to_width
+        file_table.scale_to_height[:] = scale_to_height
+        file_table.crop_x[:] = crop_x
+        file_table.crop_y[:] = crop_y
+        file_table.crop_width[:] = crop_width
+        file_table.crop_height[:] = crop_height
+
+        # group into buckets by crop size, numbered in order of first appearance
+        bucket_keys = (crop_width << 32) | crop_height
+        unique_keys, first_idx, bucket_id = np.unique(bucket_keys, return_index=True, return_inverse=True)
+        order = np.argsort(first_idx)
+        rank = np.empty_like(order)
+        rank[order] = np.arange(len(order))
+        bucket_id = rank[bucket_id.reshape(-1)]
+        # stable sort keeps the file order within each bucket
+        sorted_idx = np.argsort(bucket_id, kind='stable')
+        bucket_counts = np.bincount(bucket_id, minlength=len(order))
+        bucket_sizes = []
+        start_idx = 0
+        for b_id in range(len(order)):
+            bucket_width = int(unique_keys[order[b_id]] >> 32)
+            bucket_height = int(unique_keys[order[b_id]] & 0xFFFFFFFF)
+            bucket = Bucket(bucket_width, bucket_height)
+            bucket.file_list_idx = sorted_idx[start_idx:start_idx + bucket_counts[b_id]].tolist()
+            start_idx += bucket_counts[b_id]
+            self.buckets[f'{bucket_width}x{bucket_height}'] = bucket
+            bucket_sizes.append((bucket_width, bucket_height))
+        file_table.set_buckets(bucket_id, bucket_sizes)
+
+        if file_list is not None:
+            # items are still in use, caching reads the crop from them
+            for idx, file_item in enumerate(file_list):
+                file_table.apply_geometry(idx, file_item)
 
         # print the buckets
         self.shuffle_buckets()
@@ -1770,6 +1809,31 @@ class LatentCachingFileItemDTOMixin:
 
         return self._latent_path
 
+    def is_latent_saved(self: 'FileItemDTO') -> bool:
+        latent_path = self.get_latent_path()
+        if self.dataset_config.latent_cache_format == 'sharded':
+            store = get_latent_shard_store(os.path.dirname(latent_path))
+            return os.path.splitext(os.path.basename(latent_path))[0] in store
+        return os.path.exists(latent_path)
+
+    def load_latent_state_dict(self: 'FileItemDTO') -> Dict[str, torch.Tensor]:
+        latent_path = self.get_latent_path()
+        if self.dataset_config.latent_cache_format == 'sharded':
+            # memory mapped, the tensors point into the shard
+            store = get_latent_shard_store(os.path.dirname(latent_path))
+            return store.load(os.path.splitext(os.path.basename(latent_path))[0])
+        # memory mapped, the batch copies straight out of the mapping
+        return load_latent_file_mmap(latent_path)
+
+    def save_latent_state_dict(self: 'FileItemDTO', state_dict: Dict[str, torch.Tensor], metadata: Dict[str, str]):
+        latent_path = self.get_latent_path()
+        if self.dataset_config.latent_cache_format == 'sharded':
+            store = get_latent_shard_store(os.path.dirname(latent_path))
+            store.save(os.path.splitext(os.path.basename(latent_path))[0], state_dict, metadata=metadata)
+        else:
+            os.makedirs(os.path.dirname(latent_path), exist_ok=True)
+            save_file(state_dict, latent_path, metadata=metadata)
+
     def cleanup_latent(self):
         if self._encoded_latent is not None:
             if not self.is_caching_to_memory:
@@ -1790,11 +1854,10 @@ class LatentCachingFileItemDTOMixin:
             return None
         if self._encoded_latent is None:
             # load it from disk
-            state_dict = load_file(
-                self.get_latent_path(),
-                # device=device if device is not None else self.latent_load_device
-                device='cpu'
-            )
+            state_dict = self.load_latent_state_dict()
+            if self.is_caching_to_memory:
+                # kept for good, copy out of the memory mapping so it can be closed
+                state_dict = {k: v.clone() for k, v in state_dict.items()}
             self._encoded_latent = state_dict['latent']
             if 'first_frame_latent' in state_dict:
                 self._cached_first_frame_latent = state_dict['first_frame_latent']
@@ -1816,96 +1879,163 @@ class LatentCachingMixin:
             # cache all latents to disk
             to_disk = self.is_caching_latents_to_disk
             to_memory = self.is_caching_latents_to_memory
+            batch_size = max(1, self.dataset_config.cache_latents_batch_size)
 
             if to_disk:
                 print_acc(" - Saving latents to disk")
             if to_memory:
                 print_acc(" - Keeping latents in memory")
+            if batch_size > 1:
+                print_acc(f" - Encoding in batches of {batch_size}")
             # move sd items to cpu except for vae
             self.sd.set_device_state_preset('cache_latents')
 
-            # use tqdm to show progress
-            i = 0
-            for file_item in tqdm(self.file_list, desc=f'Caching latents{" to disk" if to_disk else ""}'):
+            progress_bar = tqdm(total=len(self.file_list), desc=f'Caching latents{" to disk" if to_disk else ""}')
+
+            # items that still need to be encoded, grouped by bucket so every batch is the same size.
+            # keyed by latent path so repeated items are only encoded once
+            bucket_items: Dict[str, OrderedDict] = OrderedDict()
+            for file_item in self.file_list:
                 file_item.is_caching_to_disk = to_disk
                 file_item.is_caching_to_memory = to_memory
                 file_item.latent_load_device = self.sd.device
 
                 latent_path = file_item.get_latent_path(recalculate=True)
                 # check if it is saved to disk already
-                if os.path.exists(latent_path):
+                if file_item.is_latent_saved():
                     if to_memory:
-                        # load it into memory
-                        state_dict = load_file(latent_path, device='cpu')
-                        file_item._encoded_latent = state_dict['latent'].to('cpu', dtype=self.sd.torch_dtype)
+                        # load it into memory. clone, the loaded tensors are views of a memory mapping and
+                        # would keep it and its file descriptor open for as long as the item lives
+                        state_dict = file_item.load_latent_state_dict()
+                        file_item._encoded_latent = state_dict['latent'].to('cpu', dtype=self.sd.torch_dtype).clone()
                         if 'first_frame_latent' in state_dict:
-                            file_item._cached_first_frame_latent = state_dict['first_frame_latent'].to('cpu', dtype=self.sd.torch_dtype)
+                            file_item._cached_first_frame_latent = state_dict['first_frame_latent'].to('cpu', dtype=self.sd.torch_dtype).clone()
                         if 'audio_latent' in state_dict:
-                            file_item._cached_audio_latent = state_dict['audio_latent'].to('cpu', dtype=self.sd.torch_dtype)
+                            file_item._cached_audio_latent = state_dict['audio_latent'].to('cpu', dtype=self.sd.torch_dtype).clone()
+                    file_item.is_latent_cached = True
+                    progress_bar.update(1)
                 else:
-                    # not saved to disk, calculate
-                    # load the image first
-                    file_item.load_and_process_image(self.transform, only_load_latents=True)
-                    dtype = self.sd.torch_dtype
-                    device = self.sd.device_torch
-                    state_dict = OrderedDict()
-                    first_frame_latent = None
-                    audio_latent = None
-                    # add batch dimension
-                    try:
-                        imgs = file_item.tensor.unsqueeze(0).to(device, dtype=dtype)
-                        latent = self.sd.encode_images(imgs).squeeze(0)
-                        if to_disk:
-                            state_dict['latent'] = latent.clone().detach().cpu()
-                    except Exception as e:
-                        print_acc(f"Error processing image: {file_item.path}")
-                        print_acc(f"Error: {str(e)}")
-                        raise e
-                    # do first frame
-                    if self.dataset_config.num_frames > 1 and self.dataset_config.do_i2v:
-                        frames = file_item.tensor.unsqueeze(0).to(device, dtype=dtype)
-                        if len(frames.shape) == 4:
-                            first_frames = frames
-                        elif len(frames.shape) == 5:
-                            first_frames = frames[:, 0]
-                        else:
-                            raise ValueError(f"Unknown frame shape {frames.shape}")
-                        first_frame_latent = self.sd.encode_images(first_frames).squeeze(0)
-                        if to_disk:
-                            state_dict['first_frame_latent'] = first_frame_latent.clone().detach().cpu()
-                    
-                    # audio
-                    if file_item.audio_data is not None:
-                        audio_latent = self.sd.encode_audio([file_item.audio_data]).squeeze(0)
-                        if to_disk:
-                            state_dict['audio_latent'] = audio_latent.clone().detach().cpu()
-                    
-                    # save_latent
-                    if to_disk:
-                        # metadata
-                        meta = get_meta_for_safetensors(file_item.get_latent_info_dict())
-                        os.makedirs(os.path.dirname(latent_path), exist_ok=True)
-                        save_file(state_dict, latent_path, metadata=meta)
-
-                    if to_memory:
-                        # keep it in memory
-                        file_item._encoded_latent = latent.to('cpu', dtype=self.sd.torch_dtype)
-                        if first_frame_latent is not None:
-                            file_item._cached_first_frame_latent = first_frame_latent.to('cpu', dtype=self.sd.torch_dtype)
-                        if audio_latent is not None:
-                            file_item._cached_audio_latent = audio_latent.to('cpu', dtype=self.sd.torch_dtype)
+                    bucket_key = f'{file_item.crop_width}x{file_item.crop_height}'
+                    if bucket_key not in bucket_items:
+                        bucket_items[bucket_key] = OrderedDict()
+                    if latent_path not in bucket_items[bucket_key]:
+                        bucket_items[bucket_key][latent_path] = []
+                    bucket_items[bucket_key][latent_path].append(file_item)
+
+            batches: List[List[List['FileItemDTO']]] = []
+            for items in bucket_items.values():
+                items = list(items.values())
+                for start_idx in range(0, len(items), batch_size):
+                    batches.append(items[start_idx:start_idx + batch_size])
+
+            if len(batches) > 0:
+                prefetch = PrefetchPool(
+                    self._load_latent_cache_item,
+                    [items[0] for batch in batches for items in batch],
+                    num_workers=self.dataset_config.num_workers,
+                    # enough to decode the next batch while this one is being encoded
+                    max_prefetch=max(batch_size * 2, self.dataset_config.num_workers * self.dataset_config.prefetch_factor),
+                    name='Latent caching',
+                )
+                prefetch_iter = iter(prefetch)
+                for batch in batches:
+                    for _ in batch:
+                        next(prefetch_iter)
+
+                    # images in a bucket should match, but split on the actual tensor shape to be safe
+                    shape_groups: Dict[tuple, List[List['FileItemDTO']]] = OrderedDict()
+                    for items in batch:
+                        shape = tuple(items[0].tensor.shape)
+                        if shape not in shape_groups:
+                            shape_groups[shape] = []
+                        shape_groups[shape].append(items)
+                    for group in shape_groups.values():
+                        self._encode_latent_cache_batch(group, to_disk=to_disk, to_memory=to_memory)
+                        progress_bar.update(sum([len(items) for items in group]))
+                # let it finish timing
+                for _ in prefetch_iter:
+                    pass
+                prefetch.print_stats()
 
-                    del imgs
-                    del latent
-                    del file_item.tensor
-                    file_item.cleanup()
+            progress_bar.close()
 
-                file_item.is_latent_cached = True
-                i += 1
+            if to_disk and self.dataset_config.latent_cache_format == 'sharded':
+                # the other processes read the index once we are done
+                flush_latent_shard_stores()
 
             # restore device state
             self.sd.restore_device_state()
 
+    def _load_latent_cache_item(self: 'AiToolkitDataset', file_item: 'FileItemDTO'):
+        # runs on the caching worker pool
+        file_item.load_and_process_image(self.transform, only_load_latents=True)
+        return file_item
+
+    def _encode_latent_cache_batch(
+            self: 'AiToolkitDataset',
+            batch: List[List['FileItemDTO']],
+            to_disk: bool,
+            to_memory: bool
+    ):
+        # batch is a list of file items sharing a latent path. The first one of each has been loaded
+        dtype = self.sd.torch_dtype
+        device = self.sd.device_torch
+        file_items = [items[0] for items in batch]
+        first_frame_latents = None
+        try:
+            imgs = torch.stack([x.tensor for x in file_items]).to(device, dtype=dtype)
+            latents = self.sd.encode_images(imgs)
+        except Exception as e:
+            print_acc(f"Error processing images: {', '.join([x.path for x in file_items])}")
+            print_acc(f"Error: {str(e)}")
+            raise e
+        # do first frame
+        if self.dataset_config.num_frames > 1 and self.dataset_config.do_i2v:
+            if len(imgs.shape) == 4:
+                first_frames = imgs
+            elif len(imgs.shape) == 5:
+                first_frames = imgs[:, 0]
+            else:
+                raise ValueError(f"Unknown frame shape {imgs.shape}")
+            first_frame_latents = self.sd.encode_images(first_frames)
+
+        for idx, items in enumerate(batch):
+            file_item = items[0]
+            state_dict = OrderedDict()
+            latent = latents[idx]
+            first_frame_latent = first_frame_latents[idx] if first_frame_latents is not None else None
+            audio_latent = None
+            if to_disk:
+                state_dict['latent'] = latent.clone().detach().cpu()
+                if first_frame_latent is not None:
+                    state_dict['first_frame_latent'] = first_frame_latent.clone().detach().cpu()
+
+            # audio
+            if file_item.audio_data is not None:
+                audio_latent = self.sd.encode_audio([file_item.audio_data]).squeeze(0)
+                if to_disk:
+                    state_dict['audio_latent'] = audio_latent.clone().detach().cpu()
+
+            # save_latent
+            if to_disk:
+                # metadata
+                meta = get_meta_for_safetensors(file_item.get_latent_info_dict())
+                file_item.save_latent_state_dict(state_dict, meta)
+
+            for item in items:
+                if to_memory:
+                    # keep it in memory. clone so we do not hold a view of the whole batch
+                    item._encoded_latent = latent.to('cpu', dtype=self.sd.torch_dtype).clone()
+                    if first_frame_latent is not None:
+                        item._cached_first_frame_latent = first_frame_latent.to('cpu', dtype=self.sd.torch_dtype).clone()
+                    if audio_latent is not None:
+                        item._cached_audio_latent = audio_latent.to('cpu', dtype=self.sd.torch_dtype).clone()
+                item.is_latent_cached = True
+            file_item.cleanup()
+
+        del imgs
+        del latents
+
 
 class TextEmbeddingFileItemDTOMixin:
     def __init__(self, *args, **kwargs):
@@ -1975,60 +2105,117 @@ class TextEmbeddingCachingMixin:
             print_acc(" - Saving text embeddings to disk")
             
             did_move = False
-
+            # shared content addressed cache, identical captions are only encoded once across datasets and jobs
+            text_embedding_cache = getattr(self.sd, 'text_embedding_cache', None)
+            batch_size = max(1, self.dataset_config.cache_text_embeddings_batch_size)
+            if batch_size > 1:
+                print_acc(f" - Encoding in batches of {batch_size}")
+
+            prefetch = PrefetchPool(
+                self._load_text_embedding_cache_item,
+                self.file_list,
+                num_workers=self.dataset_config.num_workers,
+                max_prefetch=self.dataset_config.num_workers * self.dataset_config.prefetch_factor,
+                name='Text embedding caching',
+            )
+            batch_encoder = BatchedPromptEncoder(self.sd, batch_size=batch_size)
+            # captions waiting to be encoded together, each with the embedding paths to save it to
+            pending_captions: OrderedDict = OrderedDict()
             # use tqdm to show progress
-            i = 0
-            for file_item in tqdm(self.file_list, desc='Caching text embeddings to disk'):
-                file_item.latent_load_device = self.sd.device
-
-                text_embedding_path = file_item.get_text_embedding_path(recalculate=True)
+            for file_item, text_embedding_path, ctrl_img_list, control_hash in tqdm(prefetch, desc='Caching text embeddings to disk'):
                 # only process if not saved to disk
-                if not os.path.exists(text_embedding_path):
+                if text_embedding_path is not None:
                     # load if not loaded
                     if not did_move:
                         self.sd.set_device_state_preset('cache_text_encoder')
                         did_move = True
                         
                     if file_item.encode_control_in_text_embeddings:
-                        if file_item.control_path is None:
-                            raise Exception(f"Could not find a control image for {file_item.path} which is needed for this model")
-                        ctrl_img_list = []
-                        control_path_list = file_item.control_path
-                        if not isinstance(file_item.control_path, list):
-                            control_path_list = [control_path_list]
-                        for i in range(len(control_path_list)):
-                            try:
-                                img = Image.open(control_path_list[i]).convert("RGB")
-                                img = exif_transpose(img)
-                                # convert to 0 to 1 tensor
-                                img = (
-                                    TF.to_tensor(img)
-                                    .unsqueeze(0)
-                                    .to(self.sd.device_torch, dtype=self.sd.torch_dtype)
-                                )
-                                ctrl_img_list.append(img)
-                            except Exception as e:
-                                print_acc(f"Error: {e}")
-                                print_acc(f"Error loading control image: {control_path_list[i]}")
-                        
+                        ctrl_img_list = [
+                            img.to(self.sd.device_torch, dtype=self.sd.torch_dtype) for img in ctrl_img_list
+                        ]
                         if len(ctrl_img_list) == 0:
                             ctrl_img = None
                         elif not self.sd.has_multiple_control_images:
                             ctrl_img = ctrl_img_list[0]
                         else:
                             ctrl_img = ctrl_img_list
-                        prompt_embeds: PromptEmbeds = self.sd.encode_prompt(file_item.caption, control_images=ctrl_img)
+                        if text_embedding_cache is not None:
+                            prompt_embeds: PromptEmbeds = text_embedding_cache.encode_prompt(
+                                self.sd,
+                                file_item.caption,
+                                control_images=ctrl_img,
+                                control_hash=control_hash
+                            )
+                        else:
+                            prompt_embeds: PromptEmbeds = self.sd.encode_prompt(file_item.caption, control_images=ctrl_img)
+                        # save it
+                        prompt_embeds.save(text_embedding_path)
+                        del prompt_embeds
                     else:
-                        prompt_embeds: PromptEmbeds = self.sd.encode_prompt(file_item.caption)
-                    # save it
-                    prompt_embeds.save(text_embedding_path)
-                    del prompt_embeds
+                        if file_item.caption not in pending_captions:
+                            pending_captions[file_item.caption] = []
+                        pending_captions[file_item.caption].append(text_embedding_path)
+                        if len(pending_captions) >= batch_size:
+                            self._encode_text_embedding_batch(pending_captions, batch_encoder, text_embedding_cache)
+                            pending_captions = OrderedDict()
                 file_item.is_text_embedding_cached = True
-                i += 1
+            if len(pending_captions) > 0:
+                self._encode_text_embedding_batch(pending_captions, batch_encoder, text_embedding_cache)
+            prefetch.print_stats()
+            if text_embedding_cache is not None:
+                text_embedding_cache.print_stats()
             # restore device state
             # if did_move:
             #     self.sd.restore_device_state()
 
+    def _encode_text_embedding_batch(
+            self: 'AiToolkitDataset',
+            pending_captions: OrderedDict,
+            batch_encoder: BatchedPromptEncoder,
+            text_embedding_cache: Optional[TextEmbeddingCache]
+    ):
+        # pending_captions maps each unique caption to the embedding paths that need it
+        captions = list(pending_captions.keys())
+        if text_embedding_cache is not None:
+            prompt_embeds_list = text_embedding_cache.encode_prompts(self.sd, captions, batch_encoder=batch_encoder)
+        else:
+            prompt_embeds_list = batch_encoder.encode(captions)
+        for caption, prompt_embeds in zip(captions, prompt_embeds_list):
+            for text_embedding_path in pending_captions[caption]:
+                prompt_embeds.save(text_embedding_path)
+        del prompt_embeds_list
+
+    def _load_text_embedding_cache_item(self: 'AiToolkitDataset', file_item: 'FileItemDTO'):
+        # runs on the caching worker pool. Loads the caption and any control images on the cpu.
+        # returns a None path if the embedding is already cached
+        file_item.latent_load_device = self.sd.device
+
+        text_embedding_path = file_item.get_text_embedding_path(recalculate=True)
+        if os.path.exists(text_embedding_path):
+            return file_item, None, None, None
+
+        ctrl_img_list = []
+        if file_item.encode_control_in_text_embeddings:
+            if file_item.control_path is None:
+                raise Exception(f"Could not find a control image for {file_item.path} which is needed for this model")
+            control_path_list = file_item.control_path
+            if not isinstance(file_item.control_path, list):
+                control_path_list = [control_path_list]
+            for control_path in control_path_list:
+                try:
+                    img = Image.open(control_path).convert("RGB")
+                    img = exif_transpose(img)
+                    # convert to 0 to 1 tensor
+                    ctrl_img_list.append(TF.to_tensor(img).unsqueeze(0))
+                except Exception as e:
+                    print_acc(f"Error: {e}")
+                    print_acc(f"Error loading control image: {control_path}")
+        control_hash = None
+        if file_item.encode_control_in_text_embeddings and getattr(self.sd, 'text_embedding_cache', None) is not None:
+            control_hash = hash_control_images(control_path_list)
+        return file_item, text_embedding_path, ctrl_img_list, control_hash
+
 
 class CLIPCachingMixin:
     def __init__(self: 'AiToolkitDataset', **kwargs):
@@ -2146,9 +2333,7 @@ class CLIPCachingMixin:
 
             self.clip_vision_unconditional_cache = unconditional_paths
 
-            # use tqdm to show progress
-            i = 0
-            for file_item in tqdm(self.file_list, desc=f'Caching clip vision to disk'):
+            for file_item in self.file_list:
                 file_item.is_caching_clip_vision_to_disk = True
                 file_item.clip_vision_load_device = self.sd.device
                 file_item.clip_vision_is_quad = is_quad
@@ -2157,11 +2342,17 @@ class CLIPCachingMixin:
                 if file_item.has_clip_augmentations:
                     raise Exception("Error: clip vision caching is not supported with clip augmentations")
 
-                embedding_path = file_item.get_clip_vision_embeddings_path(recalculate=True)
-                # check if it is saved to disk already
-                if not os.path.exists(embedding_path):
-                    # load the image first
-                    file_item.load_clip_image()
+            prefetch = PrefetchPool(
+                self._load_clip_vision_cache_item,
+                self.file_list,
+                num_workers=self.dataset_config.num_workers,
+                max_prefetch=self.dataset_config.num_workers * self.dataset_config.prefetch_factor,
+                name='Clip vision caching',
+            )
+            # use tqdm to show progress
+            for file_item, embedding_path in tqdm(prefetch, desc=f'Caching clip vision to disk'):
+                # path is only returned if it is not saved to disk already
+                if embedding_path is not None:
                     # add batch dimension
                     clip_image = file_item.clip_image_tensor.unsqueeze(0).to(device, dtype=dtype)
 
@@ -2194,14 +2385,20 @@ class CLIPCachingMixin:
 
                     # flush(garbage_collect=False)
                 file_item.is_vision_clip_cached = True
-                i += 1
-            # flush every 100
-            # if i % 100 == 0:
-            #     flush()
+            prefetch.print_stats()
 
         # restore device state
         self.sd.restore_device_state()
 
+    def _load_clip_vision_cache_item(self: 'AiToolkitDataset', file_item: 'FileItemDTO'):
+        # runs on the caching worker pool. Returns a None path if the embedding is already cached
+        embedding_path = file_item.get_clip_vision_embeddings_path(recalculate=True)
+        if os.path.exists(embedding_path):
+            return file_item, None
+        # load the image
+        file_item.load_clip_image()
+        return file_item, embedding_path
+
 
 
 class ControlCachingMixin:
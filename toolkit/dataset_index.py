@@ -0,0 +1,264 @@
+import json
+import multiprocessing
+import os
+import sqlite3
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterable, List, Tuple, Union
+
+import cv2
+from PIL import Image
+from PIL.ImageOps import exif_transpose
+from tqdm import tqdm
+
+from toolkit import image_utils
+from toolkit.basic import get_quick_signature_string
+from toolkit.print import print_acc
+
+# below this many files to probe, a process pool costs more than it saves
+MIN_FILES_FOR_POOL = 64
+
+DATASET_INDEX_NAME = '.aitk_index.db'
+# old json size database, imported once when the index is created
+LEGACY_SIZE_DATABASE_NAME = '.aitk_size.json'
+LEGACY_SIZE_DATABASE_VERSION = "0.1.2"
+# sqlite has a limit on bound parameters per query
+SQLITE_CHUNK_SIZE = 500
+
+
+class SizeDatabase(dict):
+    """
+    File key -> (width, height, signature, frame_count, fps). frame_count and fps are None for images.
+    Remembers which keys were set so only those are written back to the index.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.dirty = set()
+
+    def __setitem__(self, key, value):
+        value = tuple(value)
+        if len(value) < 5:
+            value = value + (None,) * (5 - len(value))
+        super().__setitem__(key, value)
+        self.dirty.add(key)
+
+
+class DatasetIndexStore:
+    """
+    Per dataset folder sqlite index of file metadata (size, signature, frames), stored in .aitk_index.db.
+    It uses WAL like the UILogger so several jobs can read it while one writes, and writes are upserts only.
+    A connection is opened per call so the store can be pickled into dataloader workers.
+    """
+
+    def __init__(self, dataset_folder: str):
+        self.dataset_folder = dataset_folder
+        self.db_path = os.path.join(dataset_folder, DATASET_INDEX_NAME)
+
+    def _connect(self) -> sqlite3.Connection:
+        is_new = not os.path.exists(self.db_path)
+        con = sqlite3.connect(self.db_path, timeout=30.0, isolation_level=None)
+        con.execute("PRAGMA journal_mode=WAL;")
+        con.execute("PRAGMA synchronous=NORMAL;")
+        con.execute("PRAGMA temp_store=MEMORY;")
+        con.execute("PRAGMA busy_timeout=30000;")
+        self._init_schema(con)
+        if is_new:
+            self._import_legacy_size_database(con)
+        return con
+
+    def _init_schema(self, con: sqlite3.Connection) -> None:
+        con.execute("BEGIN;")
+
+        con.execute("""
+            CREATE TABLE IF NOT EXISTS files (
+                path        TEXT PRIMARY KEY,
+                width       INTEGER NOT NULL,
+                height      INTEGER NOT NULL,
+                signature   TEXT NOT NULL,
+                frame_count INTEGER,
+                fps         REAL,
+                updated_at  REAL NOT NULL
+            );
+        """)
+
+        con.execute("COMMIT;")
+
+    def _import_legacy_size_database(self, con: sqlite3.Connection) -> None:
+        legacy_path = os.path.join(self.dataset_folder, LEGACY_SIZE_DATABASE_NAME)
+        if not os.path.exists(legacy_path):
+            return
+        try:
+            with open(legacy_path, 'r') as f:
+                legacy = json.load(f)
+        except Exception as e:
+            print_acc(f"Error loading size database: {legacy_path}")
+            print_acc(e)
+            return
+        if legacy.get("__version__", None) != LEGACY_SIZE_DATABASE_VERSION:
+            return
+        size_database = SizeDatabase()
+        for key, entry in legacy.items():
+            if key == "__version__" or entry is None or len(entry) < 3:
+                continue
+            size_database[key] = entry
+        print_acc(f"  -  Importing {len(size_database)} entries from {LEGACY_SIZE_DATABASE_NAME}")
+        self._upsert_files(con, size_database, size_database.keys())
+
+    def _upsert_files(self, con: sqlite3.Connection, size_database: SizeDatabase, keys: Iterable[str]) -> None:
+        now = time.time()
+        rows = []
+        for key in keys:
+            w, h, signature, frame_count, fps = size_database[key]
+            rows.append((key, int(w), int(h), signature, frame_count, fps, now))
+        if len(rows) == 0:
+            return
+        con.execute("BEGIN;")
+        con.executemany(
+            "INSERT INTO files(path, width, height, signature, frame_count, fps, updated_at) "
+            "VALUES(?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(path) DO UPDATE SET "
+            "width=excluded.width, height=excluded.height, signature=excluded.signature, "
+            "frame_count=excluded.frame_count, fps=excluded.fps, updated_at=excluded.updated_at;",
+            rows,
+        )
+        con.execute("COMMIT;")
+
+    def load_size_database(self, keys: Iterable[str]) -> SizeDatabase:
+        # only loads the entries we need, looked up by primary key
+        keys = list(dict.fromkeys(keys))
+        size_database = SizeDatabase()
+        con = self._connect()
+        try:
+            for start_idx in range(0, len(keys), SQLITE_CHUNK_SIZE):
+                chunk = keys[start_idx:start_idx + SQLITE_CHUNK_SIZE]
+                placeholders = ','.join(['?'] * len(chunk))
+                rows = con.execute(
+                    f"SELECT path, width, height, signature, frame_count, fps FROM files WHERE path IN ({placeholders});",
+                    chunk,
+                ).fetchall()
+                for path, w, h, signature, frame_count, fps in rows:
+                    dict.__setitem__(size_database, path, (w, h, signature, frame_count, fps))
+        finally:
+            con.close()
+        return size_database
+
+    def save_size_database(self, size_database: SizeDatabase) -> None:
+        # write back only what changed
+        if len(size_database.dirty) == 0:
+            return
+        con = self._connect()
+        try:
+            self._upsert_files(con, size_database, size_database.dirty)
+        finally:
+            con.close()
+        size_database.dirty.clear()
+
+
+def get_size_database_key(path: str, dataset_root: Union[str, None]) -> str:
+    if dataset_root is not None:
+        # remove dataset root from path
+        return path.replace(dataset_root, "")
+    return os.path.basename(path)
+
+
+def probe_file_info(path: str, is_video: bool, fast_image_size: bool) -> Tuple[int, int, Union[int, None], Union[float, None]]:
+    # returns width, height, frame_count, fps. frame_count and fps are None for images
+    if is_video:
+        # Open the video file
+        video = cv2.VideoCapture(path)
+
+        # Check if video opened successfully
+        if not video.isOpened():
+            raise Exception(f"Error: Could not open video file {path}")
+
+        # Get width and height
+        width = int(video.get(cv2.CAP_PROP_FRAME_WIDTH))
+        height = int(video.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        frame_count = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
+        fps = float(video.get(cv2.CAP_PROP_FPS))
+
+        # Release the video capture object immediately
+        video.release()
+        return width, height, frame_count, fps
+    if fast_image_size:
+        # original method is significantly faster, but some images are read sideways. Not sure why. Do slow method by default.
+        try:
+            w, h = image_utils.get_image_size(path)
+            return w, h, None, None
+        except image_utils.UnknownImageFormat:
+            pass
+    img = exif_transpose(Image.open(path))
+    w, h = img.size
+    return w, h, None, None
+
+
+def _index_file(args) -> Tuple[str, Union[str, None], Union[tuple, None]]:
+    # runs in the index pool. Only probes the file if its signature changed
+    path, db_entry, is_video, fast_image_size = args
+    file_signature = get_quick_signature_string(path)
+    if file_signature is None:
+        return path, None, None
+    if db_entry is not None and len(db_entry) >= 3 and db_entry[2] == file_signature:
+        return path, file_signature, None
+    try:
+        w, h, frame_count, fps = probe_file_info(path, is_video, fast_image_size)
+    except Exception:
+        # leave it out, building the file item will try again and report the error
+        return path, file_signature, None
+    return path, file_signature, (w, h, file_signature, frame_count, fps)
+
+
+def index_dataset_files(
+        file_list: List[str],
+        dataset_root: Union[str, None],
+        size_database: SizeDatabase,
+        is_video: bool = False,
+        fast_image_size: bool = False,
+        num_workers: int = 0,
+) -> Dict[str, str]:
+    """
+    Checks the signature of every file and probes the size of new or changed ones, fanning out
+    over a process pool. New entries are merged into size_database. Returns the signature for
+    each path so file items do not need to stat the file again.
+    """
+    unique_paths = list(dict.fromkeys(file_list))
+    jobs = [
+        (path, size_database.get(get_size_database_key(path, dataset_root), None), is_video, fast_image_size)
+        for path in unique_paths
+    ]
+
+    start_time = time.time()
+    signatures: Dict[str, str] = {}
+    num_probed = 0
+    # the bar shows files/s while indexing
+    progress_bar = tqdm(total=len(jobs), desc='Indexing files', unit='file')
+    if num_workers > 0 and len(jobs) >= MIN_FILES_FOR_POOL:
+        # spawn, forking would copy the threads already running (ui logger, checkpoint writer, prefetch)
+        # without them and can deadlock on a lock one of them held
+        with ProcessPoolExecutor(max_workers=num_workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+            results = []
+            for result in executor.map(_index_file, jobs, chunksize=max(1, min(256, len(jobs) // (num_workers * 4)))):
+                results.append(result)
+                progress_bar.update(1)
+    else:
+        results = []
+        for job in jobs:
+            results.append(_index_file(job))
+            progress_bar.update(1)
+    progress_bar.close()
+
+    for path, file_signature, db_entry in results:
+        if file_signature is not None:
+            signatures[path] = file_signature
+        if db_entry is not None:
+            size_database[get_size_database_key(path, dataset_root)] = db_entry
+            num_probed += 1
+
+    elapsed = time.time() - start_time
+    files_per_second = len(jobs) / elapsed if elapsed > 0 else 0
+    print_acc(
+        f"  -  Indexed {len(jobs)} files in {elapsed:.1f}s ({files_per_second:.0f} files/s), "
+        f"{num_probed} new or changed"
+    )
+    return signatures
@@ -0,0 +1,226 @@
+import copy
+import pickle
+from typing import TYPE_CHECKING, Dict, List, Sequence, Union
+
+import numpy as np
+import torch
+
+if TYPE_CHECKING:
+    from toolkit.data_transfer_object.data_loader import FileItemDTO
+
+# file item attributes that live in numpy columns instead of the per item rows
+GEOMETRY_COLUMNS = [
+    'width',
+    'height',
+    'scale_to_width',
+    'scale_to_height',
+    'crop_x',
+    'crop_y',
+    'crop_width',
+    'crop_height',
+]
+FLAG_COLUMNS = ['flip_x', 'flip_y']
+
+
+class StringTable:
+    """
+    Interned strings packed into one utf-8 buffer with offsets. Each unique string is stored once,
+    so repeats and flipped copies of a file share their path. Two numpy arrays instead of a python
+    str per item, which keeps dataloader workers from touching millions of objects.
+    """
+
+    def __init__(self, strings: Sequence[str]):
+        self._lookup: Union[Dict[str, int], None] = {}
+        self.ids = np.empty(len(strings), dtype=np.int32)
+        unique_strings: List[bytes] = []
+        for idx, value in enumerate(strings):
+            string_id = self._lookup.get(value, None)
+            if string_id is None:
+                string_id = len(unique_strings)
+                self._lookup[value] = string_id
+                unique_strings.append(value.encode('utf-8'))
+            self.ids[idx] = string_id
+        # only needed while building
+        self._lookup = None
+        lengths = np.fromiter((len(x) for x in unique_strings), dtype=np.int64, count=len(unique_strings))
+        self.offsets = np.zeros(len(unique_strings) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=self.offsets[1:])
+        self.buffer = np.frombuffer(b''.join(unique_strings), dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def num_unique(self) -> int:
+        return len(self.offsets) - 1
+
+    def get_unique(self, string_id: int) -> str:
+        return self.buffer[self.offsets[string_id]:self.offsets[string_id + 1]].tobytes().decode('utf-8')
+
+    def __getitem__(self, idx: int) -> str:
+        return self.get_unique(int(self.ids[idx]))
+
+    @property
+    def nbytes(self) -> int:
+        return self.ids.nbytes + self.offsets.nbytes + self.buffer.nbytes
+
+
+class FileTable:
+    """
+    Columnar table of a dataset's file items. Sizes, scale, crop, flips and bucket id are numpy columns
+    that bucketing works on directly. Paths are interned in a StringTable.
+
+    Calling pack_file_items moves everything else on the items into the table as well. Attributes that are
+    the same object on every item (the dataset config, transforms) are kept once, the rest of each item is
+    pickled into a shared buffer, deduplicated so repeats and flips share a row. get_file_item then builds
+    a fresh file item for an index, which replaces keeping a list of FileItemDTO around.
+    """
+
+    def __init__(self, file_items: List['FileItemDTO']):
+        num_items = len(file_items)
+        self.paths = StringTable([x.path for x in file_items])
+        for name in GEOMETRY_COLUMNS:
+            setattr(self, name, np.fromiter((getattr(x, name) for x in file_items), dtype=np.int32, count=num_items))
+        for name in FLAG_COLUMNS:
+            setattr(self, name, np.fromiter((bool(getattr(x, name)) for x in file_items), dtype=np.bool_, count=num_items))
+        # -1 until buckets are set up
+        self.bucket_id = np.full(num_items, -1, dtype=np.int32)
+        self.bucket_sizes: List[tuple] = []
+
+        # set by pack_file_items
+        self.is_packed = False
+        self._item_class = None
+        self._shared_state: Dict[str, object] = {}
+        self.row_ids: Union[np.ndarray, None] = None
+        self._row_offsets: Union[np.ndarray, None] = None
+        self._row_buffer: Union[np.ndarray, None] = None
+
+    def __len__(self):
+        return len(self.bucket_id)
+
+    def set_geometry(self, idx: int, file_item: 'FileItemDTO'):
+        # copy geometry from a file item back into the columns
+        for name in GEOMETRY_COLUMNS:
+            getattr(self, name)[idx] = getattr(file_item, name)
+
+    def apply_geometry(self, idx: int, file_item: 'FileItemDTO'):
+        # copy geometry from the columns onto a file item
+        for name in GEOMETRY_COLUMNS:
+            setattr(file_item, name, int(getattr(self, name)[idx]))
+        for name in FLAG_COLUMNS:
+            setattr(file_item, name, bool(getattr(self, name)[idx]))
+
+    def set_buckets(self, bucket_id: np.ndarray, bucket_sizes: List[tuple]):
+        # bucket_sizes is (width, height) per bucket id
+        self.bucket_id = bucket_id.astype(np.int32, copy=False)
+        self.bucket_sizes = bucket_sizes
+
+    def pack_file_items(self, file_items: List['FileItemDTO']) -> bool:
+        """
+        Packs the file items into the table. Returns False and leaves the table unpacked if an item
+        cannot be packed, tensors cached in memory for instance, the caller should keep the list then.
+        """
+        if len(file_items) != len(self):
+            raise ValueError(f"expected {len(self)} file items, got {len(file_items)}")
+        column_names = set(GEOMETRY_COLUMNS + FLAG_COLUMNS + ['path'])
+
+        # attributes that are the same object on every item are stored once
+        shared_state = {
+            key: value for key, value in file_items[0].__dict__.items() if key not in column_names
+        }
+        for file_item in file_items[1:]:
+            for key in list(shared_state.keys()):
+                if key not in file_item.__dict__ or file_item.__dict__[key] is not shared_state[key]:
+                    del shared_state[key]
+            if len(shared_state) == 0:
+                break
+
+        row_lookup: Dict[bytes, int] = {}
+        rows: List[bytes] = []
+        row_ids = np.empty(len(file_items), dtype=np.int32)
+        for idx, file_item in enumerate(file_items):
+            if type(file_item) is not type(file_items[0]):
+                return False
+            row_state = {}
+            for key, value in file_item.__dict__.items():
+                if key in column_names or key in shared_state:
+                    continue
+                if isinstance(value, torch.Tensor):
+                    return False
+                row_state[key] = value
+            try:
+                row = pickle.dumps(row_state, protocol=pickle.HIGHEST_PROTOCOL)
+            except Exception:
+                return False
+            row_id = row_lookup.get(row, None)
+            if row_id is None:
+                row_id = len(rows)
+                row_lookup[row] = row_id
+                rows.append(row)
+            row_ids[idx] = row_id
+
+        lengths = np.fromiter((len(x) for x in rows), dtype=np.int64, count=len(rows))
+        self._row_offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=self._row_offsets[1:])
+        self._row_buffer = np.frombuffer(b''.join(rows), dtype=np.uint8)
+        self.row_ids = row_ids
+        self._shared_state = shared_state
+        self._item_class = type(file_items[0])
+        self.is_packed = True
+        return True
+
+    def get_file_item(self, idx: int) -> 'FileItemDTO':
+        # builds a new file item, so like FileItemDTO.clone it can be changed freely
+        if not self.is_packed:
+            raise RuntimeError("file items have not been packed into the table")
+        row_id = int(self.row_ids[idx])
+        row = self._row_buffer[self._row_offsets[row_id]:self._row_offsets[row_id + 1]].tobytes()
+        file_item = self._item_class.__new__(self._item_class)
+        for key, value in self._shared_state.items():
+            if isinstance(value, (list, dict, set)):
+                value = copy.copy(value)
+            file_item.__dict__[key] = value
+        file_item.__dict__.update(pickle.loads(row))
+        file_item.path = self.paths[idx]
+        self.apply_geometry(idx, file_item)
+        return file_item
+
+    @property
+    def num_rows(self) -> int:
+        if not self.is_packed:
+            return 0
+        return len(self._row_offsets) - 1
+
+    @property
+    def nbytes(self) -> int:
+        total = self.paths.nbytes + self.bucket_id.nbytes
+        for name in GEOMETRY_COLUMNS + FLAG_COLUMNS:
+            total += getattr(self, name).nbytes
+        if self.is_packed:
+            total += self.row_ids.nbytes + self._row_offsets.nbytes + self._row_buffer.nbytes
+        return total
+
+
+class BatchIndices:
+    """
+    Ragged list of batches of file indexes, stored as one flat array with offsets. Indexing returns
+    a list of ints like the list of lists it replaces.
+    """
+
+    def __init__(self, flat_indices: np.ndarray, offsets: np.ndarray):
+        self.flat_indices = flat_indices
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx: int) -> List[int]:
+        if idx < 0:
+            idx += len(self)
+        if idx < 0 or idx >= len(self):
+            raise IndexError(f"batch index {idx} out of range")
+        return self.flat_indices[self.offsets[idx]:self.offsets[idx + 1]].tolist()
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
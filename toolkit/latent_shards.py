@@ -0,0 +1,292 @@
+import atexit
+import json
+import mmap
+import os
+import struct
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple, Union
+
+try:
+    import fcntl
+except ImportError:
+    # windows, appends are only serialized within the process
+    fcntl = None
+
+import torch
+from safetensors.torch import save as safetensors_save
+
+# Packed latent cache. Instead of one safetensors file per image in _latent_cache, records are appended
+# to large shard files and an append only index maps the record key to (shard, offset, length).
+# Every record is a complete safetensors blob, so packing existing files is a plain byte copy and a record
+# can always be written back out as a normal .safetensors file.
+#
+# _latent_cache/
+#   latents.index          one json line per record
+#   latents.lock           held by a process while it appends
+#   latents_00000.shard    records, each padded to RECORD_ALIGNMENT
+#   latents_00001.shard
+
+SHARD_INDEX_NAME = 'latents.index'
+SHARD_LOCK_NAME = 'latents.lock'
+SHARD_FILE_FORMAT = 'latents_{:05d}.shard'
+# start a new shard once the current one would go over this
+SHARD_MAX_BYTES = 1024 ** 3
+# keep records aligned so tensors can be viewed in place without unaligned access
+RECORD_ALIGNMENT = 64
+# index lines are written, after an fsync of the shard data, once this many records are pending,
+# when a shard is full, and on flush
+INDEX_FLUSH_RECORDS = 1024
+
+_SAFETENSORS_DTYPES = {
+    'F64': torch.float64,
+    'F32': torch.float32,
+    'F16': torch.float16,
+    'BF16': torch.bfloat16,
+    'I64': torch.int64,
+    'I32': torch.int32,
+    'I16': torch.int16,
+    'I8': torch.int8,
+    'U8': torch.uint8,
+    'BOOL': torch.bool,
+}
+
+
+def load_safetensors_from_buffer(
+        buffer: Union[mmap.mmap, bytearray],
+        offset: int = 0
+) -> Tuple[Dict[str, torch.Tensor], Dict[str, str]]:
+    """
+    Parses a safetensors blob that starts at offset in buffer. The returned tensors are views into
+    the buffer, no data is copied. The tensors keep the buffer alive.
+    """
+    header_size = struct.unpack('<Q', buffer[offset:offset + 8])[0]
+    header = json.loads(bytes(buffer[offset + 8:offset + 8 + header_size]))
+    metadata = header.pop('__metadata__', None) or {}
+    data_start = offset + 8 + header_size
+
+    tensors = OrderedDict()
+    for name, info in header.items():
+        dtype = _SAFETENSORS_DTYPES[info['dtype']]
+        start, end = info['data_offsets']
+        item_size = torch.empty((), dtype=dtype).element_size()
+        count = (end - start) // item_size
+        if count == 0:
+            tensors[name] = torch.empty(info['shape'], dtype=dtype)
+        else:
+            tensors[name] = torch.frombuffer(
+                buffer,
+                dtype=dtype,
+                count=count,
+                offset=data_start + start
+            ).reshape(info['shape'])
+    return tensors, metadata
+
+
+class LatentShardStore:
+    """
+    One store per _latent_cache folder. Reads memory map the shards and return tensors that
+    point straight into the mapping. Appends hold a file lock on the folder, so processes sharing
+    a dataset can write to the same store. Offsets come from the size of the shard file under the
+    lock, never from what this process has seen of the index.
+
+    Records are visible to this process as soon as they are appended, and to other processes once
+    their index lines are written, see INDEX_FLUSH_RECORDS. Call flush when done writing.
+    """
+
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+        self.index_path = os.path.join(cache_dir, SHARD_INDEX_NAME)
+        # key -> (shard number, offset, length)
+        self.index: Dict[str, Tuple[int, int, int]] = {}
+        self._index_read_pos = 0
+        self._maps: Dict[int, mmap.mmap] = {}
+        self._lock = threading.Lock()
+        # highest shard number in the index
+        self._max_shard = -1
+        # shard this process appends to, kept open
+        self._shard_num: Optional[int] = None
+        self._shard_file = None
+        self._lock_file = None
+        # index lines of appended records that are not written yet
+        self._pending_lines: List[bytes] = []
+
+    def _shard_path(self, shard_num: int) -> str:
+        return os.path.join(self.cache_dir, SHARD_FILE_FORMAT.format(shard_num))
+
+    def _refresh_index(self):
+        # read any records appended since we last looked. Another process may be writing
+        if not os.path.exists(self.index_path):
+            return
+        with open(self.index_path, 'rb') as f:
+            f.seek(self._index_read_pos)
+            data = f.read()
+        # ignore a partially written last line
+        end = data.rfind(b'\n') + 1
+        for line in data[:end].splitlines():
+            if len(line.strip()) == 0:
+                continue
+            record = json.loads(line)
+            self.index[record['key']] = (record['shard'], record['offset'], record['length'])
+            self._max_shard = max(self._max_shard, record['shard'])
+        self._index_read_pos += end
+
+    def _refresh_index_if_changed(self):
+        try:
+            index_size = os.path.getsize(self.index_path)
+        except OSError:
+            return
+        if index_size != self._index_read_pos:
+            self._refresh_index()
+
+    @contextmanager
+    def _file_lock(self):
+        # serializes appends between processes
+        if fcntl is None:
+            yield
+            return
+        if self._lock_file is None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            self._lock_file = open(os.path.join(self.cache_dir, SHARD_LOCK_NAME), 'ab')
+        fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_UN)
+
+    def _open_shard(self, shard_num: int):
+        if self._shard_file is not None:
+            self._shard_file.close()
+        self._shard_file = open(self._shard_path(shard_num), 'ab')
+        self._shard_num = shard_num
+
+    def _flush_locked(self):
+        if len(self._pending_lines) == 0:
+            return
+        # data is on disk before the index points at it
+        os.fsync(self._shard_file.fileno())
+        with open(self.index_path, 'ab') as f:
+            f.write(b''.join(self._pending_lines))
+            f.flush()
+            os.fsync(f.fileno())
+        self._pending_lines = []
+
+    def flush(self):
+        """Makes appended records durable and visible to other processes."""
+        with self._lock, self._file_lock():
+            self._flush_locked()
+
+    def __contains__(self, key: str) -> bool:
+        with self._lock:
+            if key not in self.index:
+                self._refresh_index()
+            return key in self.index
+
+    def __len__(self):
+        with self._lock:
+            self._refresh_index()
+            return len(self.index)
+
+    def _get_map(self, shard_num: int, min_size: int) -> mmap.mmap:
+        shard_map = self._maps.get(shard_num, None)
+        if shard_map is None or len(shard_map) < min_size:
+            # shard has grown since we mapped it. Tensors from the old map keep it alive, so just replace it
+            with open(self._shard_path(shard_num), 'rb') as f:
+                # copy on write so torch gets a writable buffer. Nothing is ever written back
+                shard_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+            self._maps[shard_num] = shard_map
+        return shard_map
+
+    def load(self, key: str) -> Dict[str, torch.Tensor]:
+        return self.load_with_metadata(key)[0]
+
+    def load_with_metadata(self, key: str) -> Tuple[Dict[str, torch.Tensor], Dict[str, str]]:
+        with self._lock:
+            if key not in self.index:
+                self._refresh_index()
+            if key not in self.index:
+                raise KeyError(f"{key} not found in latent shards at {self.cache_dir}")
+            shard_num, offset, length = self.index[key]
+            shard_map = self._get_map(shard_num, offset + length)
+        return load_safetensors_from_buffer(shard_map, offset)
+
+    def append_bytes(self, key: str, data: bytes):
+        with self._lock, self._file_lock():
+            # only picks up shards other processes started, appends go at the end of the file either way
+            self._refresh_index_if_changed()
+            if self._shard_file is None:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                self._open_shard(max(self._max_shard, 0))
+            shard_size = os.fstat(self._shard_file.fileno()).st_size
+            if shard_size > 0 and shard_size + len(data) > SHARD_MAX_BYTES:
+                self._flush_locked()
+                self._open_shard(max(self._shard_num, self._max_shard) + 1)
+                shard_size = os.fstat(self._shard_file.fileno()).st_size
+
+            padding = (RECORD_ALIGNMENT - shard_size % RECORD_ALIGNMENT) % RECORD_ALIGNMENT
+            offset = shard_size + padding
+            if padding > 0:
+                self._shard_file.write(b'\0' * padding)
+            self._shard_file.write(data)
+            # to the os so maps of the shard see it, fsynced before the index lines are written
+            self._shard_file.flush()
+
+            self.index[key] = (self._shard_num, offset, len(data))
+            self._max_shard = max(self._max_shard, self._shard_num)
+            record = {'key': key, 'shard': self._shard_num, 'offset': offset, 'length': len(data)}
+            self._pending_lines.append((json.dumps(record) + '\n').encode('utf-8'))
+            if len(self._pending_lines) >= INDEX_FLUSH_RECORDS:
+                self._flush_locked()
+
+    def save(self, key: str, state_dict: Dict[str, torch.Tensor], metadata: Dict[str, str] = None):
+        self.append_bytes(key, safetensors_save(state_dict, metadata=metadata))
+
+
+# per process lru of memory mapped latent files for the one file per image format. Tensors keep their
+# mapping alive, so evicting only drops our handle
+LATENT_FILE_MMAP_CACHE_SIZE = 64
+_latent_file_maps: 'OrderedDict[str, mmap.mmap]' = OrderedDict()
+_latent_file_maps_lock = threading.Lock()
+
+
+def load_latent_file_mmap(path: str) -> Dict[str, torch.Tensor]:
+    """
+    Loads a latent safetensors file as views into a memory mapping of it. The file is mapped
+    once per process and kept in a small lru.
+    """
+    with _latent_file_maps_lock:
+        file_map = _latent_file_maps.get(path, None)
+        if file_map is None:
+            with open(path, 'rb') as f:
+                file_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+            _latent_file_maps[path] = file_map
+            while len(_latent_file_maps) > LATENT_FILE_MMAP_CACHE_SIZE:
+                _latent_file_maps.popitem(last=False)
+        else:
+            _latent_file_maps.move_to_end(path)
+    return load_safetensors_from_buffer(file_map)[0]
+
+
+_stores: Dict[str, LatentShardStore] = {}
+_stores_lock = threading.Lock()
+
+
+def flush_latent_shard_stores():
+    with _stores_lock:
+        stores = list(_stores.values())
+    for store in stores:
+        store.flush()
+
+
+# write out index lines still pending
+atexit.register(flush_latent_shard_stores)
+
+
+def get_latent_shard_store(cache_dir: str) -> LatentShardStore:
+    # one store per folder per process. File items are pickled into workers, so they look it up by path
+    cache_dir = os.path.abspath(cache_dir)
+    with _stores_lock:
+        if cache_dir not in _stores:
+            _stores[cache_dir] = LatentShardStore(cache_dir)
+        return _stores[cache_dir]
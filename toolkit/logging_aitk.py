@@ -3,10 +3,23 @@ from PIL import Image
 
 from toolkit.config_modules import LoggingConfig
 import os
+import queue
 import sqlite3
+import threading
 import time
 from typing import Any, Dict, Tuple, List
 
+# step resolutions of the metric_rollups table. Each level is built from the one below it, so keeping
+# them up to date only ever reads 10 rows per touched bucket per level
+ROLLUP_RESOLUTIONS = (10, 100, 1000, 10000)
+
+# one flush worth of rows: steps, metrics, key min/max
+_PendingRows = Tuple[
+    List[Tuple[int, float]],
+    List[Tuple[int, str, Optional[float], Optional[str]]],
+    Dict[str, Tuple[int, int]],
+]
+
 
 # Base logger class
 # This class does nothing, it's just a placeholder
@@ -89,6 +102,8 @@ class UILogger:
         log_file: str,
         flush_every_n: int = 256,
         flush_every_secs: float = 0.25,
+        async_write: bool = False,
+        max_queued_flushes: int = 64,
     ) -> None:
         self.log_file = log_file
         self._log_to_commit: Dict[str, Any] = {}
@@ -109,6 +124,14 @@ class UILogger:
         self._flush_every_secs = float(flush_every_secs)
         self._last_flush = time.time()
 
+        # with async_write, flushes are handed to a writer thread that owns the connection.
+        # the queue is bounded, if the disk falls that far behind commit blocks until it catches up
+        self._async_write = bool(async_write)
+        self._queue: Optional[queue.Queue] = None
+        self._writer: Optional[threading.Thread] = None
+        self._writer_error: Optional[BaseException] = None
+        self._max_queued_flushes = max(1, int(max_queued_flushes))
+
     # start logging the training
     def start(self):
         if self._started:
@@ -118,14 +141,20 @@ class UILogger:
         if parent and not os.path.exists(parent):
             os.makedirs(parent, exist_ok=True)
 
-        self._con = sqlite3.connect(self.log_file, timeout=30.0, isolation_level=None)
-        self._con.execute("PRAGMA journal_mode=WAL;")
-        self._con.execute("PRAGMA synchronous=NORMAL;")
-        self._con.execute("PRAGMA temp_store=MEMORY;")
-        self._con.execute("PRAGMA foreign_keys=ON;")
-        self._con.execute("PRAGMA busy_timeout=30000;")
-
-        self._init_schema(self._con)
+        if self._async_write:
+            self._queue = queue.Queue(maxsize=self._max_queued_flushes)
+            ready = threading.Event()
+            self._writer = threading.Thread(
+                target=self._writer_loop,
+                args=(ready,),
+                name="ui_logger_writer",
+                daemon=True,
+            )
+            self._writer.start()
+            ready.wait()
+            self._raise_writer_error()
+        else:
+            self._con = self._connect()
 
         self._started = True
         self._last_flush = time.time()
@@ -195,6 +224,24 @@ class UILogger:
         if not self._started:
             return
 
+        if self._async_write:
+            assert self._queue is not None and self._writer is not None
+            try:
+                self._flush()
+            finally:
+                # drain everything queued, then stop the writer
+                while self._writer.is_alive():
+                    try:
+                        self._queue.put(None, timeout=1.0)
+                        self._writer.join()
+                    except queue.Full:
+                        continue
+                self._queue = None
+                self._writer = None
+                self._started = False
+            self._raise_writer_error()
+            return
+
         self._flush()
 
         assert self._con is not None
@@ -206,6 +253,86 @@ class UILogger:
     # internal
     # -------------------------
 
+    def _connect(self) -> sqlite3.Connection:
+        con = sqlite3.connect(self.log_file, timeout=30.0, isolation_level=None)
+        con.execute("PRAGMA journal_mode=WAL;")
+        con.execute("PRAGMA synchronous=NORMAL;")
+        con.execute("PRAGMA temp_store=MEMORY;")
+        con.execute("PRAGMA foreign_keys=ON;")
+        con.execute("PRAGMA busy_timeout=30000;")
+
+        self._init_schema(con)
+        return con
+
+    def _raise_writer_error(self) -> None:
+        if self._writer_error is not None:
+            error = self._writer_error
+            self._writer_error = None
+            raise RuntimeError(f"UILogger writer failed: {error}") from error
+
+    def _writer_loop(self, ready: threading.Event) -> None:
+        # runs on the writer thread, sqlite connections stay on the thread that made them
+        try:
+            con = self._connect()
+        except BaseException as e:
+            self._writer_error = e
+            ready.set()
+            return
+        ready.set()
+
+        assert self._queue is not None
+        q = self._queue
+        try:
+            stop = False
+            while not stop:
+                rows = q.get()
+                if rows is None:
+                    break
+                try:
+                    # whatever queued up while the last transaction was writing goes in one transaction
+                    steps, metrics, key_minmax = rows
+                    while True:
+                        try:
+                            more = q.get_nowait()
+                        except queue.Empty:
+                            break
+                        if more is None:
+                            stop = True
+                            break
+                        steps.extend(more[0])
+                        metrics.extend(more[1])
+                        for k, (lo, hi) in more[2].items():
+                            if k in key_minmax:
+                                cur_lo, cur_hi = key_minmax[k]
+                                key_minmax[k] = (min(lo, cur_lo), max(hi, cur_hi))
+                            else:
+                                key_minmax[k] = (lo, hi)
+                    self._write(con, steps, metrics, key_minmax)
+                except BaseException as e:
+                    # keep the first error for the training thread and keep draining the queue
+                    if self._writer_error is None:
+                        self._writer_error = e
+                    try:
+                        if con.in_transaction:
+                            con.execute("ROLLBACK;")
+                    except BaseException:
+                        pass
+        finally:
+            con.close()
+
+    def _put(self, rows: Optional[_PendingRows]) -> None:
+        # put on the writer queue without blocking forever if the writer thread is gone
+        assert self._queue is not None and self._writer is not None
+        while True:
+            self._raise_writer_error()
+            if not self._writer.is_alive():
+                raise RuntimeError("UILogger writer thread stopped")
+            try:
+                self._queue.put(rows, timeout=1.0)
+                return
+            except queue.Full:
+                continue
+
     def _init_schema(self, con: sqlite3.Connection) -> None:
         con.execute("BEGIN;")
 
@@ -239,8 +366,85 @@ class UILogger:
             "CREATE INDEX IF NOT EXISTS idx_metrics_key_step ON metrics (key, step);"
         )
 
+        # numeric metrics downsampled to buckets of step // resolution, so charts of long runs
+        # read a few thousand rows at a coarser resolution instead of every step
+        con.execute("""
+            CREATE TABLE IF NOT EXISTS metric_rollups (
+                key        TEXT NOT NULL,
+                resolution INTEGER NOT NULL,
+                bucket     INTEGER NOT NULL,
+                count      INTEGER NOT NULL,
+                sum        REAL NOT NULL,
+                min        REAL NOT NULL,
+                max        REAL NOT NULL,
+                first_step INTEGER NOT NULL,
+                last_step  INTEGER NOT NULL,
+                PRIMARY KEY (key, resolution, bucket)
+            );
+        """)
+
+        # logs written before rollups existed, build them once from the metrics table
+        has_rollups = con.execute("SELECT 1 FROM metric_rollups LIMIT 1;").fetchone() is not None
+        has_metrics = con.execute("SELECT 1 FROM metrics LIMIT 1;").fetchone() is not None
+        if has_metrics and not has_rollups:
+            self._backfill_rollups(con)
+
         con.execute("COMMIT;")
 
+    def _backfill_rollups(self, con: sqlite3.Connection) -> None:
+        res = ROLLUP_RESOLUTIONS[0]
+        con.execute(
+            "INSERT INTO metric_rollups(key, resolution, bucket, count, sum, min, max, first_step, last_step) "
+            "SELECT key, ?, step / ?, COUNT(value_real), SUM(value_real), MIN(value_real), MAX(value_real), "
+            "MIN(step), MAX(step) "
+            "FROM metrics WHERE value_real IS NOT NULL GROUP BY key, step / ?;",
+            (res, res, res),
+        )
+        for prev_res, res in zip(ROLLUP_RESOLUTIONS[:-1], ROLLUP_RESOLUTIONS[1:]):
+            factor = res // prev_res
+            con.execute(
+                "INSERT INTO metric_rollups(key, resolution, bucket, count, sum, min, max, first_step, last_step) "
+                "SELECT key, ?, bucket / ?, SUM(count), SUM(sum), MIN(min), MAX(max), MIN(first_step), MAX(last_step) "
+                "FROM metric_rollups WHERE resolution = ? GROUP BY key, bucket / ?;",
+                (res, factor, prev_res, factor),
+            )
+
+    def _update_rollups(
+        self,
+        con: sqlite3.Connection,
+        pending_metrics: List[Tuple[int, str, Optional[float], Optional[str]]],
+    ) -> None:
+        # rebuild every bucket the flushed rows fall in. Recomputing instead of adding keeps them
+        # exact when a step is logged again, like after resuming from an earlier checkpoint
+        res = ROLLUP_RESOLUTIONS[0]
+        buckets = {(k, step // res) for step, k, vr, _ in pending_metrics if vr is not None}
+        if not buckets:
+            return
+        con.executemany(
+            "INSERT INTO metric_rollups(key, resolution, bucket, count, sum, min, max, first_step, last_step) "
+            "SELECT key, ?, ?, COUNT(value_real), SUM(value_real), MIN(value_real), MAX(value_real), "
+            "MIN(step), MAX(step) "
+            "FROM metrics WHERE key = ? AND step >= ? AND step < ? AND value_real IS NOT NULL "
+            "GROUP BY key "
+            "ON CONFLICT(key, resolution, bucket) DO UPDATE SET "
+            "count=excluded.count, sum=excluded.sum, min=excluded.min, max=excluded.max, "
+            "first_step=excluded.first_step, last_step=excluded.last_step;",
+            [(res, b, k, b * res, (b + 1) * res) for k, b in buckets],
+        )
+        for prev_res, res in zip(ROLLUP_RESOLUTIONS[:-1], ROLLUP_RESOLUTIONS[1:]):
+            factor = res // prev_res
+            buckets = {(k, b // factor) for k, b in buckets}
+            con.executemany(
+                "INSERT INTO metric_rollups(key, resolution, bucket, count, sum, min, max, first_step, last_step) "
+                "SELECT key, ?, ?, SUM(count), SUM(sum), MIN(min), MAX(max), MIN(first_step), MAX(last_step) "
+                "FROM metric_rollups WHERE key = ? AND resolution = ? AND bucket >= ? AND bucket < ? "
+                "GROUP BY key "
+                "ON CONFLICT(key, resolution, bucket) DO UPDATE SET "
+                "count=excluded.count, sum=excluded.sum, min=excluded.min, max=excluded.max, "
+                "first_step=excluded.first_step, last_step=excluded.last_step;",
+                [(res, b, k, prev_res, b * factor, (b + 1) * factor) for k, b in buckets],
+            )
+
     def _coerce_value(self, v: Any) -> Tuple[Optional[float], Optional[str]]:
         if v is None:
             return None, None
@@ -257,44 +461,75 @@ class UILogger:
         if not self._pending_steps and not self._pending_metrics:
             return
 
+        if self._async_write:
+            self._raise_writer_error()
+            assert self._queue is not None
+            rows: _PendingRows = (
+                self._pending_steps,
+                self._pending_metrics,
+                self._pending_key_minmax,
+            )
+            # blocks when max_queued_flushes are waiting on the writer
+            self._put(rows)
+            # the lists now belong to the writer, start new ones instead of clearing them
+            self._pending_steps = []
+            self._pending_metrics = []
+            self._pending_key_minmax = {}
+            self._last_flush = time.time()
+            return
+
         assert self._con is not None
-        con = self._con
+        self._write(
+            self._con,
+            self._pending_steps,
+            self._pending_metrics,
+            self._pending_key_minmax,
+        )
 
+        self._pending_steps.clear()
+        self._pending_metrics.clear()
+        self._pending_key_minmax.clear()
+        self._last_flush = time.time()
+
+    def _write(
+        self,
+        con: sqlite3.Connection,
+        pending_steps: List[Tuple[int, float]],
+        pending_metrics: List[Tuple[int, str, Optional[float], Optional[str]]],
+        pending_key_minmax: Dict[str, Tuple[int, int]],
+    ) -> None:
         con.execute("BEGIN;")
 
         # steps upsert
-        if self._pending_steps:
+        if pending_steps:
             con.executemany(
                 "INSERT INTO steps(step, wall_time) VALUES(?, ?) "
                 "ON CONFLICT(step) DO UPDATE SET wall_time=excluded.wall_time;",
-                self._pending_steps,
+                pending_steps,
             )
 
         # keys table upsert (maintains list of keys + seen range)
-        if self._pending_key_minmax:
+        if pending_key_minmax:
             con.executemany(
                 "INSERT INTO metric_keys(key, first_seen_step, last_seen_step) VALUES(?, ?, ?) "
                 "ON CONFLICT(key) DO UPDATE SET "
                 "first_seen_step=MIN(metric_keys.first_seen_step, excluded.first_seen_step), "
                 "last_seen_step=MAX(metric_keys.last_seen_step, excluded.last_seen_step);",
-                [(k, lo, hi) for k, (lo, hi) in self._pending_key_minmax.items()],
+                [(k, lo, hi) for k, (lo, hi) in pending_key_minmax.items()],
             )
 
         # metrics upsert
-        if self._pending_metrics:
+        if pending_metrics:
             con.executemany(
                 "INSERT INTO metrics(step, key, value_real, value_text) VALUES(?, ?, ?, ?) "
                 "ON CONFLICT(step, key) DO UPDATE SET "
                 "value_real=excluded.value_real, value_text=excluded.value_text;",
-                self._pending_metrics,
+                pending_metrics,
             )
 
-        con.execute("COMMIT;")
+            self._update_rollups(con, pending_metrics)
 
-        self._pending_steps.clear()
-        self._pending_metrics.clear()
-        self._pending_key_minmax.clear()
-        self._last_flush = time.time()
+        con.execute("COMMIT;")
 
 
 # create logger based on the logging config
@@ -311,6 +546,6 @@ def create_logger(
         if save_root is None:
             raise ValueError("save_root must be provided when using UILogger")
         log_file = os.path.join(save_root, "loss_log.db")
-        return UILogger(log_file=log_file)
+        return UILogger(log_file=log_file, async_write=logging_config.ui_logger_async)
     else:
         return EmptyLogger()
@@ -0,0 +1,175 @@
+"""
+Memory mapped weight tier for layer offloading.
+
+Offloaded weights normally live in pinned host ram, which has to hold every offloaded layer at once.
+Layers planned on the disk tier are written to a safetensors file on local disk instead and their
+weights are replaced with tensors mapped from it, so the page cache decides what stays in ram. Right
+before a layer needs them on the gpu its weights are copied out of the map into a small ring of
+pinned staging buffers and from there to the gpu asynchronously, like pinned weights. The cpu path
+uses the mapped tensors as they are.
+
+The file only lives as long as the process. On linux it is unlinked as soon as it is mapped, so the
+space is given back even if the process is killed.
+"""
+
+import atexit
+import json
+import os
+import shutil
+import struct
+import uuid
+from typing import Dict, List, Optional
+
+import torch
+
+from toolkit.print import print_acc
+
+_SAFETENSORS_DTYPES = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+if hasattr(torch, "float8_e4m3fn"):
+    _SAFETENSORS_DTYPES["F8_E4M3"] = torch.float8_e4m3fn
+if hasattr(torch, "float8_e5m2"):
+    _SAFETENSORS_DTYPES["F8_E5M2"] = torch.float8_e5m2
+
+
+def _remove_file(path: str):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def map_safetensors(path: str) -> Dict[str, torch.Tensor]:
+    """
+    Maps every tensor in a safetensors file without reading it. The tensors share the file, writes
+    to them go to the file.
+    """
+    with open(path, "rb") as f:
+        header_size = struct.unpack("<Q", f.read(8))[0]
+        header = json.loads(f.read(header_size))
+    data_start = 8 + header_size
+    file_size = os.path.getsize(path)
+    storage = torch.from_file(path, shared=True, size=file_size, dtype=torch.uint8)
+
+    tensors = {}
+    for name, info in header.items():
+        if name == "__metadata__":
+            continue
+        dtype = _SAFETENSORS_DTYPES[info["dtype"]]
+        start, end = info["data_offsets"]
+        start += data_start
+        end += data_start
+        element_size = torch.empty(0, dtype=dtype).element_size()
+        if start % element_size != 0:
+            # views need the offset aligned to the element size, read it instead
+            tensors[name] = storage[start:end].clone().view(dtype).view(info["shape"])
+            continue
+        tensors[name] = storage[start:end].view(dtype).view(info["shape"])
+    return tensors
+
+
+class DiskWeightStore:
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.paths: List[str] = []
+
+    def offload(self, tensors: Dict[str, torch.Tensor], prefix: str = "weights") -> Dict[str, torch.Tensor]:
+        """
+        Writes tensors to a new file in the directory and returns them mapped from it, by name.
+        """
+        from safetensors.torch import save_file
+
+        os.makedirs(self.directory, exist_ok=True)
+        to_save = {}
+        nbytes = 0
+        for name, tensor in tensors.items():
+            to_save[name] = tensor.detach().to("cpu").contiguous()
+            nbytes += to_save[name].numel() * to_save[name].element_size()
+        free = shutil.disk_usage(self.directory).free
+        if nbytes > free:
+            raise ValueError(
+                f"Layer offloading disk tier needs {nbytes / (1024 ** 3):.2f}GB in {self.directory} "
+                f"but only {free / (1024 ** 3):.2f}GB is free"
+            )
+
+        path = os.path.join(self.directory, f"{prefix}_{os.getpid()}_{uuid.uuid4().hex[:8]}.safetensors")
+        print_acc(f"Writing {nbytes / (1024 ** 3):.2f}GB of offloaded weights to {path}")
+        save_file(to_save, path)
+        del to_save
+        mapped = map_safetensors(path)
+
+        # the map keeps the data around, unlinking only fails on platforms that lock mapped files
+        try:
+            os.remove(path)
+        except OSError:
+            self.paths.append(path)
+            atexit.register(_remove_file, path)
+        return mapped
+
+
+class PinnedStagingPool:
+    """
+    Ring of pinned host buffers mapped weights are copied through on their way to the gpu. A buffer
+    is reused once the copy out of it finished, so a few are enough to keep copies in flight.
+    """
+
+    def __init__(self, nbytes: int, num_buffers: int = 2):
+        self.nbytes = nbytes
+        self.buffers = [torch.empty(nbytes, dtype=torch.uint8).pin_memory() for _ in range(num_buffers)]
+        # recorded on the stream copying out of the buffer
+        self.events = [torch.cuda.Event() for _ in range(num_buffers)]
+        self._next = 0
+
+    def copy_(self, dst: torch.Tensor, src: torch.Tensor):
+        """
+        Queues the copy of the mapped src into the gpu tensor dst on the current stream.
+        """
+        nbytes = src.numel() * src.element_size()
+        if nbytes > self.nbytes:
+            dst.copy_(src)
+            return
+        idx = self._next
+        self._next = (self._next + 1) % len(self.buffers)
+        # the last copy out of this buffer has to be done before it is overwritten
+        self.events[idx].synchronize()
+        staged = self.buffers[idx][:nbytes].view(src.dtype).view(src.shape)
+        # reads from disk here if the pages are not cached
+        staged.copy_(src.detach())
+        dst.copy_(staged, non_blocking=True)
+        self.events[idx].record()
+
+    def to(self, src: torch.Tensor, device: torch.device) -> torch.Tensor:
+        dst = torch.empty(src.shape, dtype=src.dtype, device=device)
+        self.copy_(dst, src)
+        return dst
+
+
+def can_offload_to_disk(module: torch.nn.Module) -> bool:
+    from .manager_modules import _is_quantized_tensor
+
+    weight = getattr(module, "weight", None)
+    # quantized wrappers cannot be written to safetensors as they are, they stay pinned
+    return isinstance(weight, torch.Tensor) and not _is_quantized_tensor(weight)
+
+
+def get_staging_nbytes(modules: List[torch.nn.Module]) -> int:
+    nbytes = 0
+    for module in modules:
+        nbytes = max(nbytes, module.weight.numel() * module.weight.element_size())
+    return nbytes
+
+
+def get_disk_path(disk_path: Optional[str] = None) -> str:
+    from toolkit.paths import OFFLOAD_CACHE_PATH
+
+    return disk_path if disk_path is not None else OFFLOAD_CACHE_PATH
@@ -1,6 +1,15 @@
 import torch
+from typing import Dict, Optional
 from .manager_modules import LinearLayerMemoryManager, ConvLayerMemoryManager
-import random
+from .prefetch import PrefetchScheduler
+from .planner import TIER_DISK, get_pinned_budget, get_vram_budget, plan_offload
+from .disk_tier import (
+    DiskWeightStore,
+    PinnedStagingPool,
+    can_offload_to_disk,
+    get_disk_path,
+    get_staging_nbytes,
+)
 
 LINEAR_MODULES = [
     "Linear",
@@ -33,16 +42,45 @@ UNMANAGED_MODULES = [
 
 UNMANAGED_MODULES_INCLUDES = ["RotaryEmbedding", "Norm", "RotaryPosEmbed"]
 
+_MANAGED_MODULES_SET = set(LINEAR_MODULES + CONV_MODULES)
+_UNMANAGED_MODULES_SET = set(UNMANAGED_MODULES)
+
 
 class MemoryManager:
     def __init__(
         self,
         module: torch.nn.Module,
         process_device: torch.device = torch.device("cpu"),
+        prefetch_layers: int = 0,
+        prefetch_buffers: Optional[int] = None,
     ):
         self.module: torch.nn.Module = module
         self.process_device: torch.device = process_device
         self.unmanaged_modules: list[torch.nn.Module] = []
+        # copies the weights of the next prefetch_layers layers while the current one runs, see prefetch.py
+        self.prefetch_scheduler: Optional[PrefetchScheduler] = None
+        if prefetch_layers > 0 and torch.device(process_device).type == "cuda":
+            self.prefetch_scheduler = PrefetchScheduler(
+                torch.device(process_device),
+                prefetch_layers,
+                prefetch_buffers=prefetch_buffers,
+            )
+        # weights of disk tier layers are mapped from a file and copied through the staging pool, see disk_tier.py
+        self.disk_store: Optional[DiskWeightStore] = None
+        self.staging_pool: Optional[PinnedStagingPool] = None
+
+    def offload_to_disk(self, layers: list[tuple[str, torch.nn.Module]], disk_path: Optional[str] = None):
+        # replaces the weights of layers with ones mapped from a file on disk
+        self.disk_store = DiskWeightStore(get_disk_path(disk_path))
+        mapped = self.disk_store.offload(
+            {name: child_module.weight.data for name, child_module in layers},
+            prefix=self.module.__class__.__name__,
+        )
+        with torch.no_grad():
+            for name, child_module in layers:
+                child_module.weight.data = mapped[name]
+        if torch.device(self.process_device).type == "cuda":
+            self.staging_pool = PinnedStagingPool(get_staging_nbytes([m for _, m in layers]))
 
     def memory_managed_to(self, *args, **kwargs):
         # first move all the unmanaged modules
@@ -71,13 +109,25 @@ class MemoryManager:
         module: torch.nn.Module, 
         device: torch.device, 
         offload_percent: float = 1.0,
-        ignore_modules: list[torch.nn.Module] = []
+        ignore_modules: list[torch.nn.Module] = [],
+        prefetch_layers: int = 0,
+        prefetch_buffers: Optional[int] = None,
+        vram_budget_gb: Optional[float] = None,
+        pinned_ram_gb: Optional[float] = None,
+        tiers: Optional[Dict[str, str]] = None,
+        disk_path: Optional[str] = None,
+        print_plan: bool = True,
     ):
         if hasattr(module, "_memory_manager"):
             # already attached
             return
 
-        module._memory_manager = cls(module, device)
+        module._memory_manager = cls(
+            module,
+            device,
+            prefetch_layers=prefetch_layers,
+            prefetch_buffers=prefetch_buffers,
+        )
 
         # override the to method to handle memory management
         module._mm_to = module.to
@@ -87,67 +137,62 @@ class MemoryManager:
         for im in ignore_modules:
             module._memory_manager.unmanaged_modules.append(im)
             
-        # count ignore modules as processed
-        modules_processed = [x for x in ignore_modules]
-        # attach to all modules
-        for name, sub_module in module.named_modules():
-            for child_name, child_module in sub_module.named_modules():
-                if (
-                    child_module.__class__.__name__ in LINEAR_MODULES
-                    and child_module not in modules_processed
-                ):
-                    skip = False
-                    if offload_percent < 1.0:
-                        # randomly skip some modules
-                        if random.random() > offload_percent:
-                            skip = True
-                    if skip:
-                        module._memory_manager.unmanaged_modules.append(child_module)
-                    else:
-                        # linear
-                        LinearLayerMemoryManager.attach(
-                            child_module, module._memory_manager
-                        )
-                        # attach to ARA as well
-                        if hasattr(child_module, "ara_lora_ref"):
-                            ara = child_module.ara_lora_ref()
-                            if ara not in modules_processed:
-                                MemoryManager.attach(
-                                    ara, 
-                                    device,
-                                )
-                    modules_processed.append(child_module)
-                elif (
-                    child_module.__class__.__name__ in CONV_MODULES
-                    and child_module not in modules_processed
-                ):
-                    skip = False
-                    if offload_percent < 1.0:
-                        # randomly skip some modules
-                        if random.random() > offload_percent:
-                            skip = True
-                    if skip:
-                        module._memory_manager.unmanaged_modules.append(child_module)
-                    else:
-                        # conv
-                        ConvLayerMemoryManager.attach(
-                            child_module, module._memory_manager
-                        )
-                        # attach to ARA as well
-                        if hasattr(child_module, "ara_lora_ref"):
-                            ara = child_module.ara_lora_ref()
-                            if ara not in modules_processed:
-                                MemoryManager.attach(
-                                    ara, 
-                                    device,
-                                )
-                            modules_processed.append(ara)
-                    modules_processed.append(child_module)
-                elif child_module.__class__.__name__ in UNMANAGED_MODULES or any(
-                    inc in child_module.__class__.__name__
-                    for inc in UNMANAGED_MODULES_INCLUDES
-                ):
-                    # unmanaged
-                    module._memory_manager.unmanaged_modules.append(child_module)
-                else:
-                    continue
+        # count ignore modules as processed. by id, ignore modules can be parameters and
+        # list membership would compare them with ==
+        modules_processed = set(id(x) for x in ignore_modules)
+        # managed layers in registration order, which stay resident is decided once all are known
+        candidates: list[tuple[str, torch.nn.Module]] = []
+        # attach to all modules. named_modules already walks every descendant once
+        for child_name, child_module in module.named_modules():
+            if id(child_module) in modules_processed:
+                continue
+            modules_processed.add(id(child_module))
+            class_name = child_module.__class__.__name__
+            if class_name in _MANAGED_MODULES_SET:
+                candidates.append((child_name, child_module))
+            elif class_name in _UNMANAGED_MODULES_SET or any(
+                inc in class_name for inc in UNMANAGED_MODULES_INCLUDES
+            ):
+                # unmanaged
+                module._memory_manager.unmanaged_modules.append(child_module)
+
+        # deterministic split that keeps the most bytes resident within the budget, then the most pinned
+        plan = plan_offload(
+            candidates,
+            get_vram_budget(candidates, offload_percent=offload_percent, vram_budget_gb=vram_budget_gb),
+            pinned_budget=get_pinned_budget(pinned_ram_gb),
+            tiers=tiers,
+            disk_capable=[can_offload_to_disk(child_module) for _, child_module in candidates],
+        )
+        if print_plan and len(candidates) > 0:
+            plan.print_plan(module.__class__.__name__)
+
+        disk_layers = [layer for idx, layer in enumerate(candidates) if plan.get_tier(idx) == TIER_DISK]
+        if len(disk_layers) > 0:
+            module._memory_manager.offload_to_disk(disk_layers, disk_path)
+
+        for idx, (_, child_module) in enumerate(candidates):
+            if plan.is_resident(idx):
+                module._memory_manager.unmanaged_modules.append(child_module)
+                continue
+            disk_tier = plan.get_tier(idx) == TIER_DISK
+            if child_module.__class__.__name__ in LINEAR_MODULES:
+                # linear
+                LinearLayerMemoryManager.attach(
+                    child_module, module._memory_manager, disk_tier=disk_tier
+                )
+            else:
+                # conv
+                ConvLayerMemoryManager.attach(
+                    child_module, module._memory_manager, disk_tier=disk_tier
+                )
+            # attach to ARA as well
+            if hasattr(child_module, "ara_lora_ref"):
+                ara = child_module.ara_lora_ref()
+                if id(ara) not in modules_processed:
+                    MemoryManager.attach(
+                        ara,
+                        device,
+                        print_plan=False,
+                    )
+                modules_processed.add(id(ara))
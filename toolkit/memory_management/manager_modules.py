@@ -14,6 +14,8 @@ from torch.overrides import has_torch_function_unary  # (ADD) torchao detection
 
 if TYPE_CHECKING:
     from .manager import MemoryManager
+    from .prefetch import PrefetchScheduler
+    from .disk_tier import PinnedStagingPool
 
 # --- Per-device global state registry ---
 _DEVICE_STATE = {}
@@ -114,10 +116,11 @@ def _ensure_cpu_pinned(t: Optional[torch.Tensor]) -> Optional[torch.Tensor]:
     return t
 
 
-def _move_params_to_cpu_and_pin(module: nn.Module):
+def _move_params_to_cpu_and_pin(module: nn.Module, pin_weight: bool = True):
     """Force parameters to CPU (+pinned) so we can 'bounce' them per forward/backward."""
     with torch.no_grad():
-        if hasattr(module, "weight") and isinstance(module.weight, nn.Parameter):
+        # disk tier weights are already memory mapped on the cpu
+        if pin_weight and hasattr(module, "weight") and isinstance(module.weight, nn.Parameter):
             module.weight.data = _ensure_cpu_pinned(module.weight.data).detach()
         if hasattr(module, "bias") and isinstance(module.bias, nn.Parameter):
             if module.bias is not None:
@@ -129,9 +132,22 @@ def _move_params_to_cpu_and_pin(module: nn.Module):
 # ==========================
 
 
+def _weight_to_device(cpu_w: torch.Tensor, dev: torch.device, layer: Optional["BaseLayerMemoryManager"]):
+    # memory mapped weights go through pinned staging so the copy to the gpu stays asynchronous
+    if layer is not None and layer.staging_pool is not None and dev.type == "cuda":
+        return layer.staging_pool.to(cpu_w, dev)
+    return cpu_w.to(dev, non_blocking=True)
+
+
+def _get_prefetch_scheduler(layer: Optional["BaseLayerMemoryManager"]) -> Optional["PrefetchScheduler"]:
+    if layer is None:
+        return None
+    return layer.manager.prefetch_scheduler
+
+
 class _BouncingLinearFn(torch.autograd.Function):
     @staticmethod
-    def forward(ctx, x, weight_cpu, bias_cpu, device: torch.device):
+    def forward(ctx, x, weight_cpu, bias_cpu, device: torch.device, layer=None):
         # choose compute dtype to match activations
         target_dtype = (
             x.dtype
@@ -152,7 +168,7 @@ class _BouncingLinearFn(torch.autograd.Function):
                     w_fp_gpu = w_fp_gpu.to(target_dtype, non_blocking=True)
                 return w_fp_gpu
             # float path (preserve original behavior: NO dtype cast)
-            w_gpu = cpu_w.to(dev, non_blocking=True)
+            w_gpu = _weight_to_device(cpu_w, dev, layer)
             return w_gpu
 
         if device.type != "cuda":
@@ -172,18 +188,30 @@ class _BouncingLinearFn(torch.autograd.Function):
         ev_cu_s = state["compute_forward_start_event"]
         idx = state["forward_clk"]
 
-        with torch.cuda.stream(ts):
-            ts.wait_event(ev_cu_s)
-            w_bufs[idx] = _materialize_linear_weight(weight_cpu, device)
-            b_bufs[idx] = (
-                bias_cpu.to(device, non_blocking=True) if bias_cpu is not None else None
+        ctx.layer = layer
+        scheduler = _get_prefetch_scheduler(layer)
+        slot = None
+        if scheduler is not None:
+            slot = scheduler.acquire(
+                layer, ts, backward=False, lookahead_backward=any(ctx.needs_input_grad[:3])
             )
-            state["forward_clk"] ^= 1
-            ev_tx_f.record()
 
-        torch.cuda.current_stream().wait_event(ev_tx_f)
-        ev_cu_s.record()
-        out = F.linear(x, w_bufs[idx], b_bufs[idx])
+        if slot is not None:
+            out = F.linear(x, slot.weight, slot.bias)
+            scheduler.release(slot)
+        else:
+            with torch.cuda.stream(ts):
+                ts.wait_event(ev_cu_s)
+                w_bufs[idx] = _materialize_linear_weight(weight_cpu, device)
+                b_bufs[idx] = (
+                    bias_cpu.to(device, non_blocking=True) if bias_cpu is not None else None
+                )
+                state["forward_clk"] ^= 1
+                ev_tx_f.record()
+
+            torch.cuda.current_stream().wait_event(ev_tx_f)
+            ev_cu_s.record()
+            out = F.linear(x, w_bufs[idx], b_bufs[idx])
 
         ctx.save_for_backward(x, weight_cpu, bias_cpu)
         ctx.device = device
@@ -222,7 +250,7 @@ class _BouncingLinearFn(torch.autograd.Function):
                 if (bias_cpu is not None and getattr(bias_cpu, "requires_grad", False))
                 else None
             )
-            return grad_input.to(grad_out.device), grad_weight, grad_bias, None
+            return grad_input.to(grad_out.device), grad_weight, grad_bias, None, None
 
         state = _get_device_state(device)
         transfer_stream = state["transfer_stream"]
@@ -251,20 +279,33 @@ class _BouncingLinearFn(torch.autograd.Function):
                     w_fp_gpu = w_fp_gpu.to(target_dtype, non_blocking=True)
                 return w_fp_gpu
             # float path (preserve original behavior: NO dtype cast)
-            w = cpu_w.to(device, non_blocking=True)
+            w = _weight_to_device(cpu_w, device, getattr(ctx, "layer", None))
             return w
 
-        with torch.cuda.stream(transfer_stream):
-            transfer_stream.wait_event(ev_cu_b_start)
-            w_bwd_buffers[idx] = _materialize_for_bwd(weight_cpu)
+        layer = getattr(ctx, "layer", None)
+        scheduler = _get_prefetch_scheduler(layer)
+        slot = None
+        if scheduler is not None:
+            slot = scheduler.acquire(layer, transfer_stream, backward=True)
+
+        if slot is not None:
             state["backward_clk"] ^= 1
-            ev_tx_b.record()
+            w_bwd = slot.weight
+        else:
+            with torch.cuda.stream(transfer_stream):
+                transfer_stream.wait_event(ev_cu_b_start)
+                w_bwd_buffers[idx] = _materialize_for_bwd(weight_cpu)
+                state["backward_clk"] ^= 1
+                ev_tx_b.record()
 
-        torch.cuda.current_stream().wait_event(ev_tx_b)
-        ev_cu_b_start.record()
+            torch.cuda.current_stream().wait_event(ev_tx_b)
+            ev_cu_b_start.record()
+            w_bwd = w_bwd_buffers[idx]
 
         # grad wrt input (GPU)
-        grad_input = grad_out.to(dtype=target_dtype) @ w_bwd_buffers[idx]
+        grad_input = grad_out.to(dtype=target_dtype) @ w_bwd
+        if slot is not None:
+            scheduler.release(slot)
 
         # ensure previous grad-to-CPU transfer that used this slot finished
         torch.cuda.current_stream().wait_event(ev_tx_w_bwd_done)
@@ -294,7 +335,7 @@ class _BouncingLinearFn(torch.autograd.Function):
                 grad_bias = b_grad_buffers[idx].to("cpu", non_blocking=True)
             state["transfer_weight_backward_finished_event"].record()
 
-        return grad_input.to(dtype=grad_out.dtype), grad_weight, grad_bias, None
+        return grad_input.to(dtype=grad_out.dtype), grad_weight, grad_bias, None, None
 
 
 class _BouncingConv2dFn(torch.autograd.Function):
@@ -309,6 +350,7 @@ class _BouncingConv2dFn(torch.autograd.Function):
         padding: Tuple[int, int],
         dilation: Tuple[int, int],
         groups: int,
+        layer=None,
     ):
         target_dtype = (
             x.dtype
@@ -328,7 +370,7 @@ class _BouncingConv2dFn(torch.autograd.Function):
                     w_fp_gpu = w_fp_gpu.to(target_dtype, non_blocking=True)
                 return w_fp_gpu
             # float path (preserve original behavior: NO dtype cast)
-            w_gpu = cpu_w.to(dev, non_blocking=True)
+            w_gpu = _weight_to_device(cpu_w, dev, layer)
             return w_gpu
 
         if device.type != "cuda":
@@ -352,18 +394,30 @@ class _BouncingConv2dFn(torch.autograd.Function):
         ev_cu_s = state["compute_forward_start_event"]
         idx = state["forward_clk"]
 
-        with torch.cuda.stream(ts):
-            ts.wait_event(ev_cu_s)
-            w_bufs[idx] = _materialize_conv_weight(weight_cpu, device)
-            b_bufs[idx] = (
-                bias_cpu.to(device, non_blocking=True) if bias_cpu is not None else None
+        ctx.layer = layer
+        scheduler = _get_prefetch_scheduler(layer)
+        slot = None
+        if scheduler is not None:
+            slot = scheduler.acquire(
+                layer, ts, backward=False, lookahead_backward=any(ctx.needs_input_grad[:3])
             )
-            state["forward_clk"] ^= 1
-            ev_tx_f.record()
 
-        torch.cuda.current_stream().wait_event(ev_tx_f)
-        ev_cu_s.record()
-        out = F.conv2d(x, w_bufs[idx], b_bufs[idx], stride, padding, dilation, groups)
+        if slot is not None:
+            out = F.conv2d(x, slot.weight, slot.bias, stride, padding, dilation, groups)
+            scheduler.release(slot)
+        else:
+            with torch.cuda.stream(ts):
+                ts.wait_event(ev_cu_s)
+                w_bufs[idx] = _materialize_conv_weight(weight_cpu, device)
+                b_bufs[idx] = (
+                    bias_cpu.to(device, non_blocking=True) if bias_cpu is not None else None
+                )
+                state["forward_clk"] ^= 1
+                ev_tx_f.record()
+
+            torch.cuda.current_stream().wait_event(ev_tx_f)
+            ev_cu_s.record()
+            out = F.conv2d(x, w_bufs[idx], b_bufs[idx], stride, padding, dilation, groups)
 
         ctx.save_for_backward(x, weight_cpu, bias_cpu)
         ctx.meta = (device, stride, padding, dilation, groups, target_dtype)
@@ -429,6 +483,7 @@ class _BouncingConv2dFn(torch.autograd.Function):
                 None,
                 None,
                 None,
+                None,
             )
 
         state = _get_device_state(device)
@@ -458,30 +513,43 @@ class _BouncingConv2dFn(torch.autograd.Function):
                     w_fp_gpu = w_fp_gpu.to(target_dtype, non_blocking=True)
                 return w_fp_gpu
             # float path (preserve original behavior: NO dtype cast)
-            w = cpu_w.to(device, non_blocking=True)
+            w = _weight_to_device(cpu_w, device, getattr(ctx, "layer", None))
             return w
 
-        # Stage weights for input-grad compute
-        with torch.cuda.stream(transfer_stream):
-            transfer_stream.wait_event(ev_cu_b_start)
-            w_bwd_buffers[idx] = _materialize_for_bwd(weight_cpu)
+        layer = getattr(ctx, "layer", None)
+        scheduler = _get_prefetch_scheduler(layer)
+        slot = None
+        if scheduler is not None:
+            slot = scheduler.acquire(layer, transfer_stream, backward=True)
+
+        if slot is not None:
             state["backward_clk"] ^= 1
-            ev_tx_b.record()
+            w_bwd = slot.weight
+        else:
+            # Stage weights for input-grad compute
+            with torch.cuda.stream(transfer_stream):
+                transfer_stream.wait_event(ev_cu_b_start)
+                w_bwd_buffers[idx] = _materialize_for_bwd(weight_cpu)
+                state["backward_clk"] ^= 1
+                ev_tx_b.record()
 
-        torch.cuda.current_stream().wait_event(ev_tx_b)
-        ev_cu_b_start.record()
+            torch.cuda.current_stream().wait_event(ev_tx_b)
+            ev_cu_b_start.record()
+            w_bwd = w_bwd_buffers[idx]
 
         from torch.nn.grad import conv2d_input, conv2d_weight  # type: ignore
 
         grad_input = conv2d_input(
             x.shape,
-            w_bwd_buffers[idx],
+            w_bwd,
             grad_out.to(dtype=target_dtype),
             stride=stride,
             padding=padding,
             dilation=dilation,
             groups=groups,
         )
+        if slot is not None:
+            scheduler.release(slot)
 
         # Ensure previous grad transfer that used this slot is done
         torch.cuda.current_stream().wait_event(ev_tx_w_bwd_done)
@@ -528,6 +596,7 @@ class _BouncingConv2dFn(torch.autograd.Function):
             None,
             None,
             None,
+            None,
         )
 
 
@@ -536,15 +605,19 @@ class BaseLayerMemoryManager:
         self,
         module: nn.Module,
         manager: "MemoryManager",
+        disk_tier: bool = False,
     ):
         self.module: nn.Module = module
         self.manager: "MemoryManager" = manager
+        # weight is memory mapped from disk, see disk_tier.py
+        self.disk_tier: bool = disk_tier
+        self.staging_pool: Optional["PinnedStagingPool"] = manager.staging_pool if disk_tier else None
 
     @classmethod
-    def attach(cls, module: nn.Module, manager: "MemoryManager"):
+    def attach(cls, module: nn.Module, manager: "MemoryManager", disk_tier: bool = False):
         if hasattr(module, "_layer_memory_manager"):
             return
-        module._layer_memory_manager = cls(module, manager)
+        module._layer_memory_manager = cls(module, manager, disk_tier=disk_tier)
 
         # mark parameters as memory managed
         for param in module.parameters(recurse=False):
@@ -556,11 +629,12 @@ class LinearLayerMemoryManager(BaseLayerMemoryManager):
         self,
         module: nn.Module,
         manager: "MemoryManager",
+        disk_tier: bool = False,
     ):
-        super().__init__(module, manager)
+        super().__init__(module, manager, disk_tier=disk_tier)
 
         # 1) Move params to CPU + pin memory for fast H2D
-        _move_params_to_cpu_and_pin(self.module)
+        _move_params_to_cpu_and_pin(self.module, pin_weight=not disk_tier)
 
         # 2) Hijack forward
         if hasattr(self.module, "ara_lora_ref"):
@@ -580,7 +654,7 @@ class LinearLayerMemoryManager(BaseLayerMemoryManager):
             device = self.manager.process_device
 
             # NOTE: do NOT move params to device here; autograd fn streams & bounces them
-            return _BouncingLinearFn.apply(x, weight_cpu, bias_cpu, device)
+            return _BouncingLinearFn.apply(x, weight_cpu, bias_cpu, device, self)
 
         if hasattr(self.module, "ara_lora_ref"):
             self.module.ara_lora_ref().org_forward = _mm_forward
@@ -595,11 +669,12 @@ class ConvLayerMemoryManager(BaseLayerMemoryManager):
         self,
         module: nn.Module,
         manager: "MemoryManager",
+        disk_tier: bool = False,
     ):
-        super().__init__(module, manager)
+        super().__init__(module, manager, disk_tier=disk_tier)
 
         # 1) Move params to CPU + pin memory for fast H2D
-        _move_params_to_cpu_and_pin(self.module)
+        _move_params_to_cpu_and_pin(self.module, pin_weight=not disk_tier)
 
         # Cache static conv attributes from the module
         stride = (
@@ -636,7 +711,7 @@ class ConvLayerMemoryManager(BaseLayerMemoryManager):
             device = self.manager.process_device
 
             return _BouncingConv2dFn.apply(
-                x, weight_cpu, bias_cpu, device, stride, padding, dilation, groups
+                x, weight_cpu, bias_cpu, device, stride, padding, dilation, groups, self
             )
 
         if hasattr(self.module, "ara_lora_ref"):
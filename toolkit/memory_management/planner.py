@@ -0,0 +1,257 @@
+"""
+Decides which managed layers stay resident on the gpu and which are offloaded.
+
+Every offloaded layer is copied to the gpu once per forward and once more per backward, so the
+transfer per step is the size of what is offloaded. The plan keeps the most bytes resident that fit in
+the budget, a bounded knapsack over the distinct layer sizes. Layers of the same size are
+interchangeable for traffic, so the resident ones are spread evenly over the module registration
+order, which for the transformer blocks is the order they run in and leaves compute between the
+offloaded layers for their copies to hide behind. The same model and budget always give the same plan.
+
+Offloaded layers are kept in pinned ram the same way until the pinned budget is full, the rest go
+to the disk tier and are memory mapped from a file, see disk_tier.py. Groups of layers can be put
+on a tier by name, those are placed first and count against the budget of their tier.
+"""
+
+import fnmatch
+from typing import Dict, List, Optional, Tuple
+
+import torch
+
+from toolkit.print import print_acc
+
+
+def get_module_nbytes(module: torch.nn.Module) -> int:
+    nbytes = 0
+    for param in module.parameters(recurse=False):
+        nbytes += param.numel() * param.element_size()
+    return nbytes
+
+
+TIER_GPU = "gpu"
+TIER_PINNED = "pinned"
+TIER_DISK = "disk"
+TIERS = (TIER_GPU, TIER_PINNED, TIER_DISK)
+
+
+def _spread(count: int, num_picked: int) -> List[int]:
+    # num_picked indexes out of count, evenly spaced
+    if num_picked <= 0:
+        return []
+    if num_picked >= count:
+        return list(range(count))
+    return [int((i + 0.5) * count / num_picked) for i in range(num_picked)]
+
+
+def _format_bytes(nbytes: float) -> str:
+    return f"{nbytes / (1024 ** 3):.2f}GB"
+
+
+# budget cells of the knapsack. Sizes are rounded up to budget / KNAPSACK_CELLS, so the pick always
+# fits and is at most one cell per picked layer short of the exact optimum
+KNAPSACK_CELLS = 4096
+
+
+def _greedy_counts(counts: Dict[int, int], budget: int) -> Dict[int, int]:
+    # largest sizes first
+    picked = {}
+    remaining = budget
+    for size in sorted(counts.keys(), reverse=True):
+        picked[size] = min(counts[size], remaining // size)
+        remaining -= picked[size] * size
+    return picked
+
+
+def _knapsack_counts(counts: Dict[int, int], budget: int) -> Dict[int, int]:
+    # bounded knapsack, each size split into 1, 2, 4, ... layer bundles for a 0/1 knapsack
+    unit = max(1, -(-budget // KNAPSACK_CELLS))
+    capacity = budget // unit
+    items = []
+    for size in sorted(counts.keys(), reverse=True):
+        remaining, bundle = counts[size], 1
+        while remaining > 0:
+            num = min(bundle, remaining)
+            items.append((size, num, -(-size * num // unit)))
+            remaining -= num
+            bundle *= 2
+
+    best = [0] * (capacity + 1)
+    taken = []
+    for size, num, cells in items:
+        took = bytearray(capacity + 1)
+        value = size * num
+        for c in range(capacity, cells - 1, -1):
+            if best[c - cells] + value > best[c]:
+                best[c] = best[c - cells] + value
+                took[c] = 1
+        taken.append(took)
+
+    picked = {size: 0 for size in counts}
+    c = capacity
+    for (size, num, cells), took in zip(reversed(items), reversed(taken)):
+        if took[c]:
+            picked[size] += num
+            c -= cells
+    return picked
+
+
+def _pick(sizes: List[int], idxs: List[int], budget: int) -> List[int]:
+    # the most bytes out of idxs that fit in budget, spread out within a size
+    groups = {}
+    for idx in idxs:
+        groups.setdefault(sizes[idx], []).append(idx)
+
+    # nothing to transfer, always resident
+    picked = list(groups.pop(0, []))
+    budget = max(0, budget)
+    counts = {size: len(group) for size, group in groups.items()}
+    greedy = _greedy_counts(counts, budget)
+    num_picked = _knapsack_counts(counts, budget)
+    # the knapsack rounds sizes up, greedy can still fit more when the cells are coarse
+    if sum(s * n for s, n in greedy.items()) > sum(s * n for s, n in num_picked.items()):
+        num_picked = greedy
+    for size in sorted(groups.keys(), reverse=True):
+        group = groups[size]
+        for i in _spread(len(group), num_picked[size]):
+            picked.append(group[i])
+    return picked
+
+
+def get_forced_tier(name: str, tiers: Optional[Dict[str, str]]) -> Optional[str]:
+    # first fnmatch pattern matching the module name wins
+    if tiers is None:
+        return None
+    for pattern, tier in tiers.items():
+        if fnmatch.fnmatchcase(name, pattern):
+            return tier
+    return None
+
+
+class OffloadPlan:
+    def __init__(
+        self,
+        layers: List[Tuple[str, torch.nn.Module]],
+        tiers: List[str],
+        budget: int,
+        pinned_budget: Optional[int] = None,
+    ):
+        # layers in registration order, tiers[i] is where the weights of layers[i] live
+        self.layers = layers
+        self.tiers = tiers
+        self.budget = budget
+        self.pinned_budget = pinned_budget
+        self.sizes = [get_module_nbytes(module) for _, module in layers]
+
+    def get_tier(self, idx: int) -> str:
+        return self.tiers[idx]
+
+    def is_resident(self, idx: int) -> bool:
+        return self.tiers[idx] == TIER_GPU
+
+    @property
+    def resident(self) -> List[bool]:
+        return [tier == TIER_GPU for tier in self.tiers]
+
+    def get_tier_bytes(self, tier: str) -> int:
+        return sum(size for size, t in zip(self.sizes, self.tiers) if t == tier)
+
+    @property
+    def resident_bytes(self) -> int:
+        return self.get_tier_bytes(TIER_GPU)
+
+    @property
+    def offloaded_bytes(self) -> int:
+        return self.get_tier_bytes(TIER_PINNED) + self.get_tier_bytes(TIER_DISK)
+
+    def print_plan(self, name: str = "model", training: bool = True):
+        num_resident = self.tiers.count(TIER_GPU)
+        num_offloaded = len(self.layers) - num_resident
+        print_acc(f"Layer offloading plan for {name}:")
+        print_acc(f" - budget: {_format_bytes(self.budget)}")
+        print_acc(f" - resident: {num_resident} layers, {_format_bytes(self.resident_bytes)}")
+        print_acc(f" - offloaded: {num_offloaded} layers, {_format_bytes(self.offloaded_bytes)}")
+        num_disk = self.tiers.count(TIER_DISK)
+        if self.pinned_budget is not None or num_disk > 0:
+            pinned_budget = "unlimited" if self.pinned_budget is None else _format_bytes(self.pinned_budget)
+            print_acc(f"   pinned ram: {num_offloaded - num_disk} layers, "
+                      f"{_format_bytes(self.get_tier_bytes(TIER_PINNED))} of {pinned_budget}")
+            print_acc(f"   disk: {num_disk} layers, {_format_bytes(self.get_tier_bytes(TIER_DISK))}, "
+                      f"read again per forward when not in the page cache")
+        # weights go up for forward and again for backward
+        print_acc(f" - expected pcie traffic: {_format_bytes(self.offloaded_bytes)} per forward")
+        if training:
+            print_acc(f"   {_format_bytes(self.offloaded_bytes * 2)} per training step, plus grads of trained offloaded weights")
+
+
+def plan_offload(
+    layers: List[Tuple[str, torch.nn.Module]],
+    vram_budget: int,
+    pinned_budget: Optional[int] = None,
+    tiers: Optional[Dict[str, str]] = None,
+    disk_capable: Optional[List[bool]] = None,
+) -> OffloadPlan:
+    """
+    layers are (name, module) in registration order. vram_budget is the bytes of layer weights that may
+    stay resident on the gpu and pinned_budget the bytes of offloaded weights that may be pinned in
+    ram, None for no limit. tiers maps fnmatch patterns of layer names to a tier to force it.
+    disk_capable[i] is False for layers that can not go to the disk tier, they stay pinned.
+    """
+    vram_budget = max(0, int(vram_budget))
+    if pinned_budget is not None:
+        pinned_budget = max(0, int(pinned_budget))
+    sizes = [get_module_nbytes(module) for _, module in layers]
+    if disk_capable is None:
+        disk_capable = [True] * len(layers)
+
+    plan_tiers: List[Optional[str]] = [None] * len(layers)
+    for idx, (name, _) in enumerate(layers):
+        tier = get_forced_tier(name, tiers)
+        if tier is None:
+            continue
+        if tier not in TIERS:
+            raise ValueError(f"Unknown layer offloading tier {tier} for {name}, expected one of {TIERS}")
+        if tier == TIER_DISK and not disk_capable[idx]:
+            tier = TIER_PINNED
+        plan_tiers[idx] = tier
+
+    def _remaining(budget: int, tier: str) -> int:
+        return budget - sum(size for size, t in zip(sizes, plan_tiers) if t == tier)
+
+    # the most bytes resident, then the most bytes pinned, the rest on disk
+    free = [idx for idx, tier in enumerate(plan_tiers) if tier is None]
+    for idx in _pick(sizes, free, _remaining(vram_budget, TIER_GPU)):
+        plan_tiers[idx] = TIER_GPU
+
+    free = [idx for idx, tier in enumerate(plan_tiers) if tier is None]
+    if pinned_budget is None:
+        pinned = free
+    else:
+        pinned = _pick(sizes, [idx for idx in free if disk_capable[idx]], _remaining(pinned_budget, TIER_PINNED))
+        pinned += [idx for idx in free if not disk_capable[idx]]
+    for idx in pinned:
+        plan_tiers[idx] = TIER_PINNED
+
+    plan_tiers = [TIER_DISK if tier is None else tier for tier in plan_tiers]
+    return OffloadPlan(layers, plan_tiers, vram_budget, pinned_budget=pinned_budget)
+
+
+def get_percent_budget(layers: List[Tuple[str, torch.nn.Module]], offload_percent: float) -> int:
+    # offload_percent of the layer bytes are offloaded, the rest is the budget
+    total = sum(get_module_nbytes(module) for _, module in layers)
+    return int(total * (1.0 - min(max(offload_percent, 0.0), 1.0)))
+
+
+def get_vram_budget(
+    layers: List[Tuple[str, torch.nn.Module]],
+    offload_percent: float = 1.0,
+    vram_budget_gb: Optional[float] = None,
+) -> int:
+    if vram_budget_gb is not None:
+        return int(vram_budget_gb * (1024 ** 3))
+    return get_percent_budget(layers, offload_percent)
+
+
+def get_pinned_budget(pinned_ram_gb: Optional[float] = None) -> Optional[int]:
+    if pinned_ram_gb is None:
+        return None
+    return int(pinned_ram_gb * (1024 ** 3))
@@ -0,0 +1,269 @@
+"""
+Lookahead weight prefetching for layer offloading.
+
+Without it a managed layer starts copying its weights to the gpu when its own forward is called, so
+the copy for layer N can only overlap with whatever is left of layer N-1. The scheduler records the
+order the layers run in on the first pass and from then on copies the weights of the next
+prefetch_layers layers into a ring of gpu buffers on the transfer stream while the current layer
+computes. Backward uses the same order reversed, and the end of a forward pass that needs grads
+already starts on the first layers of backward.
+
+A layer only uses a prefetched buffer if it is the one the buffer was filled for and its weights
+did not change since, so a wrong guess costs a copy, never a wrong result. Anything else goes
+through the regular per layer bounce.
+"""
+
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
+
+import torch
+
+if TYPE_CHECKING:
+    from .manager_modules import BaseLayerMemoryManager
+
+# keep the bias behind the weight aligned like the caching allocator does
+_ALIGNMENT = 512
+
+
+def _align(nbytes: int) -> int:
+    return (nbytes + _ALIGNMENT - 1) // _ALIGNMENT * _ALIGNMENT
+
+
+def _can_prefetch_tensor(t: Optional[torch.Tensor]) -> bool:
+    from .manager_modules import _is_quantized_tensor
+
+    if t is None:
+        return True
+    # quantized weights are dequantized on the fly, they keep using the regular path
+    return t.device.type == "cpu" and t.dtype.is_floating_point and not _is_quantized_tensor(t)
+
+
+class _Slot:
+    def __init__(self, nbytes: int, device: torch.device):
+        self.buffer = torch.empty(nbytes, dtype=torch.uint8, device=device)
+        # recorded on the transfer stream once the copy landed
+        self.ready_event = torch.cuda.Event()
+        # recorded on the compute stream once the layer using it is done with it
+        self.free_event = torch.cuda.Event()
+        self.key: Optional[Tuple[int, bool]] = None
+        # handed out by acquire and not released yet
+        self.in_use = False
+        self.version: Optional[Tuple[int, int, int, int]] = None
+        self.weight: Optional[torch.Tensor] = None
+        self.bias: Optional[torch.Tensor] = None
+
+
+def _get_nbytes(layer: "BaseLayerMemoryManager") -> int:
+    weight = layer.module.weight
+    bias = getattr(layer.module, "bias", None)
+    nbytes = _align(weight.numel() * weight.element_size())
+    if bias is not None:
+        nbytes += _align(bias.numel() * bias.element_size())
+    return nbytes
+
+
+def can_prefetch(layer: "BaseLayerMemoryManager") -> bool:
+    return _can_prefetch_tensor(layer.module.weight) and _can_prefetch_tensor(getattr(layer.module, "bias", None))
+
+
+def _get_version(layer: "BaseLayerMemoryManager") -> Tuple[int, int, int, int]:
+    # changes if the weights are replaced or updated in place, like by an optimizer step
+    weight = layer.module.weight
+    bias = getattr(layer.module, "bias", None)
+    return (
+        weight.data_ptr(),
+        weight._version,
+        bias.data_ptr() if bias is not None else 0,
+        bias._version if bias is not None else 0,
+    )
+
+
+class PrefetchScheduler:
+    def __init__(
+        self,
+        device: torch.device,
+        prefetch_layers: int,
+        prefetch_buffers: Optional[int] = None,
+    ):
+        self.device = device
+        self.prefetch_layers = max(1, int(prefetch_layers))
+        # one buffer is always being computed with, the rest hold the layers ahead
+        if prefetch_buffers is None:
+            prefetch_buffers = self.prefetch_layers + 1
+        self.prefetch_buffers = max(int(prefetch_buffers), self.prefetch_layers + 1)
+
+        self.recording = True
+        self.order: List["BaseLayerMemoryManager"] = []
+        self._positions: Dict[int, List[int]] = {}
+
+        self._slots: List[_Slot] = []
+        self._next_slot = 0
+        # (id(layer), backward) -> slot holding its weights
+        self._prefetched: Dict[Tuple[int, bool], _Slot] = {}
+        self._forward_cursor = 0
+        self._backward_cursor = -1
+
+        self.hits = 0
+        self.misses = 0
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+
+    def _finish_recording(self):
+        self.recording = False
+        self._positions = {}
+        for pos, layer in enumerate(self.order):
+            self._positions.setdefault(id(layer), []).append(pos)
+
+        slot_bytes = 0
+        for layer in self.order:
+            if can_prefetch(layer):
+                slot_bytes = max(slot_bytes, _get_nbytes(layer))
+        if slot_bytes == 0:
+            return
+        self._slots = [_Slot(slot_bytes, self.device) for _ in range(self.prefetch_buffers)]
+        self._forward_cursor = 0
+        self._backward_cursor = len(self.order) - 1
+
+    def _find_position(self, layer: "BaseLayerMemoryManager", backward: bool) -> Optional[int]:
+        positions = self._positions.get(id(layer), None)
+        if positions is None:
+            return None
+        cursor = self._backward_cursor if backward else self._forward_cursor
+        if 0 <= cursor < len(self.order) and self.order[cursor] is layer:
+            return cursor
+        # off the recorded order, like a layer that is skipped or rerun for checkpointing.
+        # pick the closest place this layer runs at in the direction we are going
+        if backward:
+            before = [pos for pos in positions if pos <= cursor]
+            return before[-1] if len(before) > 0 else positions[-1]
+        after = [pos for pos in positions if pos >= cursor]
+        return after[0] if len(after) > 0 else positions[0]
+
+    def _issue(self, layer: "BaseLayerMemoryManager", backward: bool, transfer_stream: torch.cuda.Stream):
+        key = (id(layer), backward)
+        if key in self._prefetched or not can_prefetch(layer):
+            return
+        if _get_nbytes(layer) > self._slots[0].buffer.numel():
+            return
+        slot = None
+        for _ in range(len(self._slots)):
+            candidate = self._slots[self._next_slot]
+            self._next_slot = (self._next_slot + 1) % len(self._slots)
+            if not candidate.in_use:
+                slot = candidate
+                break
+        if slot is None:
+            return
+        if slot.key is not None:
+            # drop whatever it held, it was never used
+            self._prefetched.pop(slot.key, None)
+
+        weight = layer.module.weight.detach()
+        bias = getattr(layer.module, "bias", None)
+        weight_nbytes = weight.numel() * weight.element_size()
+        slot.weight = slot.buffer[:weight_nbytes].view(weight.dtype).view(weight.shape)
+        slot.bias = None
+        if bias is not None:
+            bias = bias.detach()
+            bias_start = _align(weight_nbytes)
+            bias_nbytes = bias.numel() * bias.element_size()
+            slot.bias = slot.buffer[bias_start:bias_start + bias_nbytes].view(bias.dtype).view(bias.shape)
+
+        with torch.cuda.stream(transfer_stream):
+            # the last layer to use this slot has to be done with it
+            transfer_stream.wait_event(slot.free_event)
+            if layer.staging_pool is not None:
+                # memory mapped, staged through pinned ram
+                layer.staging_pool.copy_(slot.weight, weight)
+            else:
+                slot.weight.copy_(weight, non_blocking=True)
+            if bias is not None:
+                slot.bias.copy_(bias, non_blocking=True)
+            slot.ready_event.record(transfer_stream)
+        slot.key = key
+        slot.version = _get_version(layer)
+        self._prefetched[key] = slot
+
+    def _issue_ahead(self, pos: int, backward: bool, lookahead_backward: bool, transfer_stream: torch.cuda.Stream):
+        num_layers = len(self.order)
+        for i in range(1, self.prefetch_layers + 1):
+            if backward:
+                ahead = pos - i
+                if ahead < 0:
+                    break
+                self._issue(self.order[ahead], True, transfer_stream)
+            else:
+                ahead = pos + i
+                if ahead < num_layers:
+                    self._issue(self.order[ahead], False, transfer_stream)
+                elif lookahead_backward:
+                    # backward starts with the last layers of forward
+                    ahead = 2 * num_layers - 1 - ahead
+                    if ahead < 0:
+                        break
+                    self._issue(self.order[ahead], True, transfer_stream)
+                else:
+                    break
+
+    def acquire(
+        self,
+        layer: "BaseLayerMemoryManager",
+        transfer_stream: torch.cuda.Stream,
+        backward: bool = False,
+        lookahead_backward: bool = False,
+    ) -> Optional[_Slot]:
+        """
+        Called when layer is about to run. Queues the copies for the layers ahead of it and returns
+        the slot holding its own weights, ready to use on the current stream, or None if they were
+        not prefetched and the caller has to load them. A returned slot has to be released once the
+        ops using it are queued.
+        """
+        if self.recording:
+            if not backward and id(layer) not in self._positions:
+                self._positions[id(layer)] = [len(self.order)]
+                self.order.append(layer)
+                return None
+            # a layer came around again or backward started, the order is complete
+            self._finish_recording()
+        if len(self._slots) == 0:
+            return None
+
+        pos = self._find_position(layer, backward)
+        if pos is None:
+            self.misses += 1
+            return None
+        if backward:
+            self._backward_cursor = pos - 1
+            if pos == 0:
+                # next backward starts at the end again
+                self._backward_cursor = len(self.order) - 1
+        else:
+            self._forward_cursor = pos + 1
+            if pos == len(self.order) - 1:
+                self._forward_cursor = 0
+                self._backward_cursor = len(self.order) - 1
+
+        key = (id(layer), backward)
+        slot = self._prefetched.pop(key, None)
+        if slot is not None:
+            slot.key = None
+            if slot.version != _get_version(layer):
+                slot = None
+            else:
+                # keep the copies queued below from refilling it
+                slot.in_use = True
+
+        self._issue_ahead(pos, backward, lookahead_backward, transfer_stream)
+
+        if slot is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        torch.cuda.current_stream().wait_event(slot.ready_event)
+        return slot
+
+    def release(self, slot: _Slot):
+        # the ops using the slot are queued, it can be refilled once they ran
+        slot.free_event.record(torch.cuda.current_stream())
+        slot.in_use = False
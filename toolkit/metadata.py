@@ -1,8 +1,12 @@
+import hashlib
 import json
 from collections import OrderedDict
 from io import BytesIO
+from typing import Tuple, Union
 
 import safetensors
+import safetensors.torch
+import torch
 from safetensors import safe_open
 
 from info import software_meta
@@ -28,6 +32,88 @@ def get_meta_for_safetensors(meta: OrderedDict, name=None, add_software_info=Tru
     return save_meta
 
 
+# the legacy hash reads this window of the serialized file
+LEGACY_HASH_OFFSET = 0x100000
+LEGACY_HASH_LENGTH = 0x10000
+
+
+def _get_safetensors_header(state_dict, metadata) -> Union[bytes, None]:
+    """
+    Builds the header safetensors would write for state_dict and metadata, without serializing
+    the tensors. Returns None if it cannot be reproduced exactly.
+
+    The tensor order and json format come from serializing the same keys and dtypes as empty
+    tensors. That header is rebuilt from its parsed json and must match byte for byte before
+    the real shapes and offsets are filled in, so a different safetensors version falls back
+    to a full serialization instead of writing a wrong hash.
+    """
+    skeleton = OrderedDict((k, torch.empty(0, dtype=v.dtype)) for k, v in state_dict.items())
+    skeleton_bytes = safetensors.torch.save(skeleton, metadata)
+    skeleton_size = int.from_bytes(skeleton_bytes[:8], "little")
+    skeleton_header = skeleton_bytes[8:8 + skeleton_size]
+    header = json.loads(skeleton_header, object_pairs_hook=OrderedDict)
+    pad_to_8 = skeleton_size % 8 == 0
+
+    def to_bytes(header_dict):
+        header_bytes = json.dumps(header_dict, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+        if pad_to_8:
+            header_bytes += b" " * ((8 - len(header_bytes) % 8) % 8)
+        return header_bytes
+
+    if to_bytes(header) != skeleton_header:
+        return None
+
+    offset = 0
+    for key, info in header.items():
+        if key == "__metadata__":
+            continue
+        tensor = state_dict[key]
+        num_bytes = tensor.numel() * tensor.element_size()
+        info["shape"] = list(tensor.shape)
+        info["data_offsets"] = [offset, offset + num_bytes]
+        offset += num_bytes
+    return to_bytes(header)
+
+
+def _tensor_bytes(tensor: torch.Tensor):
+    # raw little endian bytes, viewed not copied for contiguous cpu tensors
+    tensor = tensor.detach().to("cpu").contiguous().reshape(-1)
+    return tensor.view(torch.uint8).numpy()
+
+
+def _get_model_hashes_streaming(state_dict, metadata) -> Union[Tuple[str, str], None]:
+    header = _get_safetensors_header(state_dict, metadata)
+    if header is None:
+        return None
+    header_json = json.loads(header, object_pairs_hook=OrderedDict)
+
+    model_hash = hashlib.sha256()
+    legacy_hash = hashlib.sha256()
+    legacy_end = LEGACY_HASH_OFFSET + LEGACY_HASH_LENGTH
+
+    def legacy_update(position, chunk):
+        # feed the part of chunk, which starts at position in the file, inside the legacy window
+        start = max(LEGACY_HASH_OFFSET - position, 0)
+        end = min(legacy_end - position, len(chunk))
+        if start < end:
+            legacy_hash.update(chunk[start:end])
+
+    prefix = len(header).to_bytes(8, "little") + header
+    legacy_update(0, prefix)
+    position = len(prefix)
+    # tensors are laid out in header order
+    for key in header_json.keys():
+        if key == "__metadata__":
+            continue
+        chunk = _tensor_bytes(state_dict[key])
+        model_hash.update(chunk)
+        if position < legacy_end:
+            legacy_update(position, memoryview(chunk))
+        position += chunk.nbytes
+
+    return model_hash.hexdigest(), legacy_hash.hexdigest()[0:8]
+
+
 def add_model_hash_to_meta(state_dict, meta: OrderedDict) -> OrderedDict:
     """Precalculate the model hashes needed by sd-webui-additional-networks to
     save time on indexing the model later."""
@@ -37,11 +123,17 @@ def add_model_hash_to_meta(state_dict, meta: OrderedDict) -> OrderedDict:
     # calculating the hash, as they are meant to be immutable
     metadata = {k: v for k, v in meta.items() if k.startswith("ss_")}
 
-    bytes = safetensors.torch.save(state_dict, metadata)
-    b = BytesIO(bytes)
+    # hash the tensors one at a time as they would be laid out in the file,
+    # instead of serializing a full copy of the model in memory
+    hashes = _get_model_hashes_streaming(state_dict, metadata)
+    if hashes is not None:
+        model_hash, legacy_hash = hashes
+    else:
+        bytes = safetensors.torch.save(state_dict, metadata)
+        b = BytesIO(bytes)
 
-    model_hash = addnet_hash_safetensors(b)
-    legacy_hash = addnet_hash_legacy(b)
+        model_hash = addnet_hash_safetensors(b)
+        legacy_hash = addnet_hash_legacy(b)
     meta["sshs_model_hash"] = model_hash
     meta["sshs_legacy_hash"] = legacy_hash
     return meta
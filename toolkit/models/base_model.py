@@ -24,6 +24,8 @@ from toolkit.models.decorator import Decorator
 from toolkit.paths import KEYMAPS_ROOT
 from toolkit.prompt_utils import inject_trigger_into_prompt, PromptEmbeds, concat_prompt_embeds
 from toolkit.reference_adapter import ReferenceAdapter
+from toolkit.sample_batching import concat_sample_embeds, get_sample_batches, get_sample_generators, \
+    sort_sample_batches_by_multiplier
 from toolkit.sd_device_states_presets import empty_preset
 from toolkit.train_tools import get_torch_dtype, apply_noise_offset
 import torch
@@ -45,6 +47,7 @@ from toolkit.print import print_acc
 if TYPE_CHECKING:
     from toolkit.lora_special import LoRASpecialNetwork
     from toolkit.data_transfer_object.data_loader import DataLoaderBatchDTO
+    from toolkit.text_embedding_cache import TextEmbeddingCache
 
 # tell it to shut up
 diffusers.logging.set_verbosity(diffusers.logging.ERROR)
@@ -171,6 +174,8 @@ class BaseModel:
         self.is_transformer = False
 
         self.sample_prompts_cache = None
+        # shared TextEmbeddingCache, set by the trainer when train.text_embedding_cache is on
+        self.text_embedding_cache: Optional['TextEmbeddingCache'] = None
         
         self.accuracy_recovery_adapter: Union[None, 'LoRASpecialNetwork'] = None
         self.is_multistage = False
@@ -295,6 +300,57 @@ class BaseModel:
         raise NotImplementedError(
             "generate_single_image must be implemented in child classes")
 
+    def generate_batched_images(
+        self,
+        pipeline,
+        gen_configs: List[GenerateImageConfig],
+        conditional_embeds: PromptEmbeds,
+        unconditional_embeds: PromptEmbeds,
+        generators: List[torch.Generator],
+        extra: dict,
+    ) -> list:
+        # optional, override in child classes whose pipeline can denoise several samples in one call.
+        # the embeds are batched and there is one generator per sample. Returns one image per config
+        raise NotImplementedError(
+            "generate_batched_images is not implemented for this model")
+
+    def can_generate_batched_images(self) -> bool:
+        return type(self).generate_batched_images is not BaseModel.generate_batched_images
+
+    def _generate_sample_batch(self, pipeline, samples: list, extra: dict, total_imgs: int):
+        # samples is a list of (index, gen_config, conditional_embeds, unconditional_embeds) sharing a batch key
+        gen_configs = [x[1] for x in samples]
+        conditional_embeds = concat_sample_embeds([x[2] for x in samples])
+        unconditional_embeds = concat_sample_embeds([x[3] for x in samples])
+        if conditional_embeds is None or unconditional_embeds is None:
+            # prompts encoded to different lengths, padding would change them. Do them one at a time
+            images = []
+            for _, gen_config, single_conditional_embeds, single_unconditional_embeds in samples:
+                torch.manual_seed(gen_config.seed)
+                torch.cuda.manual_seed(gen_config.seed)
+                generator = torch.manual_seed(gen_config.seed)
+                images.append(self.generate_single_image(
+                    pipeline,
+                    gen_config,
+                    single_conditional_embeds,
+                    single_unconditional_embeds,
+                    generator,
+                    dict(extra),
+                ))
+        else:
+            images = self.generate_batched_images(
+                pipeline,
+                gen_configs,
+                conditional_embeds,
+                unconditional_embeds,
+                get_sample_generators(gen_configs),
+                dict(extra),
+            )
+        for (i, gen_config, _, _), img in zip(samples, images):
+            gen_config.save_image(img, i)
+            gen_config.log_image(img, i)
+            self._after_sample_image(i, total_imgs)
+
     def get_noise_prediction(
         latent_model_input: torch.Tensor,
         timestep: torch.Tensor,  # 0 to 1000 scale
@@ -368,9 +424,12 @@ class BaseModel:
             sampler=None,
             pipeline: Union[None, StableDiffusionPipeline,
                             StableDiffusionXLPipeline] = None,
+            batch_size: int = 1,
+            cached_merge: bool = False,
     ):
         network = self.network
         merge_multiplier = 1.0
+        use_cached_merge = False
         flush()
         # if using assistant, unfuse it
         if self.model_config.assistant_lora_path is not None:
@@ -396,7 +455,10 @@ class BaseModel:
             # the network to drastically speed up inference
             unique_network_weights = set(
                 [x.network_multiplier for x in image_configs])
-            if len(unique_network_weights) == 1 and network.can_merge_in:
+            if cached_merge and network.can_merge_in:
+                # merged at each sample's multiplier, then restored exactly after sampling
+                use_cached_merge = True
+            elif len(unique_network_weights) == 1 and network.can_merge_in:
                 can_merge_in = True
                 merge_multiplier = unique_network_weights.pop()
                 network.merge_in(merge_weight=merge_multiplier)
@@ -428,7 +490,18 @@ class BaseModel:
                 if network is not None:
                     assert network.is_active
 
-                for i in tqdm(range(len(image_configs)), desc=f"Generating Images", leave=False):
+                # samples with the same size, steps, guidance and multiplier are denoised together.
+                # adapters and the refiner are set up per sample, so those go one at a time
+                if not self.can_generate_batched_images() or self.adapter is not None or self.refiner_unet is not None:
+                    batch_size = 1
+                sample_batches = get_sample_batches(image_configs, batch_size)
+                if use_cached_merge:
+                    # each multiplier change rewrites the merged weights, so do them one multiplier at a time
+                    sample_batches = sort_sample_batches_by_multiplier(image_configs, sample_batches)
+                sample_batch_sizes = {i: len(batch) for batch in sample_batches for i in batch}
+                pending_samples = []
+
+                for i in tqdm([i for batch in sample_batches for i in batch], desc=f"Generating Images", leave=False):
                     gen_config = image_configs[i]
 
                     extra = {}
@@ -477,6 +550,8 @@ class BaseModel:
 
                     if network is not None:
                         network.multiplier = gen_config.network_multiplier
+                        if use_cached_merge:
+                            network.set_merged_multiplier(gen_config.network_multiplier)
                     torch.manual_seed(gen_config.seed)
                     torch.cuda.manual_seed(gen_config.seed)
 
@@ -651,6 +726,15 @@ class BaseModel:
                     unconditional_embeds = unconditional_embeds.to(
                         self.device_torch, dtype=self.unet.dtype)
 
+                    if sample_batch_sizes[i] > 1:
+                        # generate once the rest of the batch is encoded
+                        pending_samples.append((i, gen_config, conditional_embeds, unconditional_embeds))
+                        if len(pending_samples) == sample_batch_sizes[i]:
+                            self._generate_sample_batch(pipeline, pending_samples, extra, len(image_configs))
+                            pending_samples = []
+                        flush()
+                        continue
+
                     img = self.generate_single_image(
                         pipeline,
                         gen_config,
@@ -1,7 +1,7 @@
 import json
 import os
 from collections import OrderedDict
-from typing import Optional, Union, List, Type, TYPE_CHECKING, Dict, Any, Literal
+from typing import Optional, Union, List, Type, TYPE_CHECKING, Dict, Any, Literal, Tuple
 
 import torch
 from optimum.quanto import QTensor
@@ -108,6 +108,116 @@ def add_bias(tensor, bias):
     return result
 
 
+# sibling projections that are called with the same input tensor
+LORA_INPUT_GROUPS = [
+    ['to_q', 'to_k', 'to_v'],
+    ['add_q_proj', 'add_k_proj', 'add_v_proj'],
+    ['q_proj', 'k_proj', 'v_proj'],
+]
+
+
+class LoRAModuleGroup:
+    """
+    Runs the loras of modules that get the same input as one concatenated down projection and
+    one batched up projection, instead of two small matmuls per module. Members with different
+    up shapes use a block diagonal up projection instead.
+
+    Opt in with grouped_forward. Results are not bit identical to the per module path, the fused
+    matmuls accumulate in a different order, see scripts/benchmark_grouped_lora.py for the
+    difference and timings. It only runs without grad, for sampling. The fused weights are built
+    once and reused until a member weight is replaced or updated in place. With grad every member
+    runs on its own, so training is unchanged.
+
+    The first member called with a new input computes the lora output for every member and each
+    member takes its slice when it is called with that same input. If a member that still has a
+    slice waiting is called with a different input, the members do not actually share their input
+    (cross attention to_q vs to_k/to_v) and the group is disabled for good, they go back to running
+    on their own.
+    """
+
+    def __init__(self, modules: List['Module']):
+        self.modules = modules
+        self.enabled = True
+        self._input = None
+        self._outputs: Dict[int, torch.Tensor] = {}
+        # fused (down, up) weights and the member weight versions they were built from
+        self._weights = None
+        self._weights_key = None
+
+    def _get_weights_key(self):
+        # changes when a weight is replaced or updated in place, like by an optimizer step
+        return tuple(
+            (w.data_ptr(), w._version, w.dtype, w.device)
+            for m in self.modules for w in (m.lora_down.weight, m.lora_up.weight)
+        )
+
+    def _needs_grad(self) -> bool:
+        return torch.is_grad_enabled() and any(
+            w.requires_grad for m in self.modules for w in (m.lora_down.weight, m.lora_up.weight)
+        )
+
+    def _get_weights(self) -> Tuple[torch.Tensor, torch.Tensor]:
+        key = self._get_weights_key()
+        if self._weights is not None and self._weights_key == key:
+            return self._weights
+
+        down_weight = torch.cat([m.lora_down.weight for m in self.modules], dim=0)
+        up_weights = [m.lora_up.weight for m in self.modules]
+        if all(w.shape == up_weights[0].shape for w in up_weights):
+            # (members, out, rank), no multiplies with zeros
+            up_weight = torch.stack(up_weights)
+        else:
+            up_weight = torch.block_diag(*up_weights)
+
+        self._weights = (down_weight, up_weight)
+        self._weights_key = key
+        return self._weights
+
+    def _reset(self):
+        self._input = None
+        self._outputs = {}
+
+    def get_output(self, module: 'Module', x: torch.Tensor) -> Union[torch.Tensor, None]:
+        # lora_up(lora_down(x)) for module, or None if it has to run on its own
+        if self._needs_grad():
+            # training keeps the exact per module path
+            self._reset()
+            return None
+        key = id(module)
+        if self._input is not None:
+            if self._input is x and key in self._outputs:
+                output = self._outputs.pop(key)
+                if len(self._outputs) == 0:
+                    self._reset()
+                return output
+            if key in self._outputs:
+                self.enabled = False
+                self._reset()
+                return None
+            # the last pass did not call every member, start over
+            self._reset()
+
+        lora_input = x.to(module.lora_down.weight.dtype)
+        down_weight, up_weight = self._get_weights()
+        lx = torch.nn.functional.linear(lora_input, down_weight)
+        if up_weight.dim() == 3:
+            num_members, out_features, rank = up_weight.shape
+            # (..., members * rank) -> (members, tokens, rank) @ (members, rank, out)
+            lx_batched = lx.reshape(-1, num_members, rank).transpose(0, 1)
+            lx = torch.bmm(lx_batched, up_weight.transpose(1, 2))
+            outputs = [output.view(*x.shape[:-1], out_features) for output in lx.unbind(0)]
+        else:
+            lx = torch.nn.functional.linear(lx, up_weight)
+            outputs = lx.split([m.lora_up.weight.size(0) for m in self.modules], dim=-1)
+
+        self._input = x
+        self._outputs = {id(m): output for m, output in zip(self.modules, outputs)}
+        output = self._outputs.pop(key)
+        if len(self._outputs) == 0:
+            self._reset()
+        return output
+
+
 class ExtractableModuleMixin:
     def extract_weight(
             self: Module,
@@ -177,6 +287,12 @@ class ToolkitModuleMixin:
         self.network_ref: weakref.ref = weakref.ref(network)
         self.is_checkpointing = False
         self._multiplier: Union[float, list, torch.Tensor] = None
+        # cpu copy of the original weight to restore after set_merged_multiplier, kept between sampling
+        # rounds while the weight is unchanged. _merge_base_version is weight._version it matches
+        self._merge_base_weight: Optional[torch.Tensor] = None
+        self._merge_base_version: Optional[int] = None
+        # multiplier merged into the original weight, None when not merged
+        self._merged_multiplier: Optional[float] = None
 
     def _call_forward(self: Module, x):
         # module dropout
@@ -222,6 +338,63 @@ class ToolkitModuleMixin:
 
         return lx * scale
 
+    def _can_fuse_forward(self: Module, x) -> bool:
+        # the fused path only covers a plain linear or conv lora with nothing active between down and up
+        if self.__class__.__name__ != "LoRAModule" or self.full_rank:
+            return False
+        if isinstance(x, QTensor):
+            return False
+        if not isinstance(self.lora_down, (nn.Linear, nn.Conv2d)) or self.lora_up.bias is not None:
+            return False
+        if hasattr(self.lora_down, '_memory_management_device'):
+            # memory manager bounces these weights per forward
+            return False
+        if self.training:
+            if self.module_dropout is not None:
+                return False
+            if self.rank_dropout is not None and self.rank_dropout > 0:
+                return False
+            if isinstance(self.dropout, nn.Dropout):
+                if self.dropout.p > 0:
+                    return False
+            elif self.dropout is not None and not isinstance(self.dropout, nn.Identity) and self.dropout > 0:
+                return False
+        elif isinstance(self.dropout, nn.Dropout) and self.dropout.training and self.dropout.p > 0:
+            return False
+        return True
+
+    def _fused_forward(self: Module, x, org_forwarded):
+        # same result as forward, but the lora scale and the batch multiplier are applied to the
+        # rank sized down projection instead of the full output, and the up projection and the
+        # add to the original output are one addmm when the dtypes allow it
+        network: Network = self.network_ref()
+        down_weight = self.lora_down.weight
+        up_weight = self.lora_up.weight
+        if x.dtype != down_weight.dtype:
+            x = x.to(down_weight.dtype)
+        lx = self.lora_down(x)
+
+        batch_multiplier = network.get_batch_multiplier(lx.size(0))
+        scale = batch_multiplier * (self.scale * self.scalar)
+        lx = broadcast_and_multiply(lx, scale.to(lx.dtype))
+
+        if isinstance(self.lora_up, nn.Conv2d):
+            lora_output = self.lora_up(lx)
+            if lora_output.dtype != org_forwarded.dtype:
+                lora_output = lora_output.to(org_forwarded.dtype)
+            return org_forwarded + lora_output
+
+        if lx.dtype != org_forwarded.dtype:
+            lora_output = self.lora_up(lx).to(org_forwarded.dtype)
+            return org_forwarded + lora_output
+        out_features = org_forwarded.size(-1)
+        x = torch.addmm(
+            org_forwarded.reshape(-1, out_features),
+            lx.reshape(-1, lx.size(-1)),
+            up_weight.t()
+        )
+        return x.view(org_forwarded.shape)
+
     def lorm_forward(self: Network, x, *args, **kwargs):
         network: Network = self.network_ref()
         if not network.is_active:
@@ -270,6 +443,10 @@ class ToolkitModuleMixin:
         if network.is_merged_in:
             skip = True
 
+        # skip if merged in through set_merged_multiplier
+        if self._merged_multiplier is not None:
+            skip = True
+
         # skip if multiplier is 0
         if network._multiplier == 0:
             skip = True
@@ -287,11 +464,24 @@ class ToolkitModuleMixin:
 
         org_forwarded = self.org_forward(x, *args, **kwargs)
 
+        lora_output = None
+        if network.grouped_forward and not getattr(network, '_lora_groups_ready', False):
+            network.setup_lora_groups()
+        lora_group: Union[LoRAModuleGroup, None] = getattr(self, '_lora_group', None)
+        if lora_group is not None and lora_group.enabled and self._can_fuse_forward(x):
+            lora_output = lora_group.get_output(self, x)
+            if lora_output is not None:
+                lora_output = lora_output * (self.scale * self.scalar)
+
+        if lora_output is None and network.fused_forward and self._can_fuse_forward(x):
+            return self._fused_forward(x, org_forwarded)
+
         if isinstance(x, QTensor):
             x = x.dequantize()
-        # always cast to float32
-        lora_input = x.to(self.lora_down.weight.dtype)
-        lora_output = self._call_forward(lora_input)
+        if lora_output is None:
+            # always cast to float32
+            lora_input = x.to(self.lora_down.weight.dtype)
+            lora_output = self._call_forward(lora_input)
         multiplier = self.network_ref().torch_multiplier
 
         lora_output_batch_size = lora_output.size(0)
@@ -345,9 +535,8 @@ class ToolkitModuleMixin:
         self.merge_in(merge_weight=-merge_out_weight)
 
     @torch.no_grad()
-    def merge_in(self: Module, merge_weight=1.0):
-        if not self.can_merge_in:
-            return
+    def get_merge_delta(self: Module, weight_size) -> torch.Tensor:
+        # scaled float32 delta the lora adds to a weight of weight_size, on the lora device
         # get up/down weight
         if self.full_rank:
             up_weight = None
@@ -355,6 +544,32 @@ class ToolkitModuleMixin:
             up_weight = self.lora_up.weight.clone().float()
         down_weight = self.lora_down.weight.clone().float()
 
+        scale = self.scale
+        # handle trainable scaler method locon does
+        if hasattr(self, 'scalar'):
+            scale = scale * self.scalar
+        if isinstance(scale, torch.Tensor) and scale.device != down_weight.device:
+            scale = scale.to(down_weight.device)
+
+        if self.full_rank:
+            return down_weight * scale
+        elif len(weight_size) == 2:
+            # linear
+            return (up_weight @ down_weight) * scale
+        elif down_weight.size()[2:4] == (1, 1):
+            # conv2d 1x1
+            return (up_weight.squeeze(3).squeeze(2) @ down_weight.squeeze(3).squeeze(2)).unsqueeze(2).unsqueeze(3) * scale
+        else:
+            # conv2d 3x3
+            conved = torch.nn.functional.conv2d(down_weight.permute(1, 0, 2, 3), up_weight).permute(1, 0, 2, 3)
+            # print(conved.size(), weight.size(), module.stride, module.padding)
+            return conved * scale
+
+    @torch.no_grad()
+    def merge_in(self: Module, merge_weight=1.0):
+        if not self.can_merge_in:
+            return
+
         # extract weight from org_module
         org_sd = self.org_module[0].state_dict()
         # todo find a way to merge in weights when doing quantized model
@@ -371,40 +586,64 @@ class ToolkitModuleMixin:
         weight = org_sd[weight_key].float()
 
         multiplier = merge_weight
-        scale = self.scale
-        # handle trainable scaler method locon does
-        if hasattr(self, 'scalar'):
-            scale = scale * self.scalar
+        delta = self.get_merge_delta(weight.size())
 
         weight_device = weight.device
-        if weight.device != down_weight.device:
-            weight = weight.to(down_weight.device)
-        if scale.device != down_weight.device:
-            scale = scale.to(down_weight.device)
+        if weight.device != delta.device:
+            weight = weight.to(delta.device)
         # merge weight
-        if self.full_rank:
-            weight = weight + multiplier * down_weight * scale
-        elif len(weight.size()) == 2:
-            # linear
-            weight = weight + multiplier * (up_weight @ down_weight) * scale
-        elif down_weight.size()[2:4] == (1, 1):
-            # conv2d 1x1
-            weight = (
-                    weight
-                    + multiplier
-                    * (up_weight.squeeze(3).squeeze(2) @ down_weight.squeeze(3).squeeze(2)).unsqueeze(2).unsqueeze(3)
-                    * scale
-            )
-        else:
-            # conv2d 3x3
-            conved = torch.nn.functional.conv2d(down_weight.permute(1, 0, 2, 3), up_weight).permute(1, 0, 2, 3)
-            # print(conved.size(), weight.size(), module.stride, module.padding)
-            weight = weight + multiplier * conved * scale
+        weight = weight + multiplier * delta
 
         # set weight to org_module
         org_sd[weight_key] = weight.to(weight_device, orig_dtype)
         self.org_module[0].load_state_dict(org_sd)
 
+    @torch.no_grad()
+    def set_merged_multiplier(self: Module, multiplier: float) -> bool:
+        """
+        Merges the lora into the weight of the original module at multiplier, in place. A change of
+        multiplier adds the delta again at the difference, so no full weight is uploaded. The original
+        weight is copied to (pinned) cpu memory once and reused while it does not change, so
+        restore_merged_weight puts it back exactly, without merge in/out float drift.
+        Returns False for modules that are not merged, those keep running the lora side path.
+        """
+        org_module = self.org_module[0]
+        weight = getattr(org_module, 'weight', None)
+        if self._merged_multiplier is None:
+            if not self.can_merge_in or not hasattr(self, 'lora_down'):
+                return False
+            if not isinstance(weight, torch.Tensor) or isinstance(weight, QTensor):
+                # quantized weight
+                return False
+            if hasattr(org_module, '_layer_memory_manager'):
+                # offloaded, the weight already lives in pinned ram and a second copy would double that
+                return False
+            if self._merge_base_weight is None or self._merge_base_version != weight._version:
+                base_weight = torch.empty(
+                    weight.shape, dtype=weight.dtype, device='cpu', pin_memory=torch.cuda.is_available()
+                )
+                base_weight.copy_(weight.data)
+                self._merge_base_weight = base_weight
+                self._merge_base_version = weight._version
+            previous = 0.0
+        else:
+            previous = self._merged_multiplier
+
+        delta = self.get_merge_delta(weight.size()).to(weight.device)
+        # float32 delta, rounded to the weight dtype once per change
+        weight.data.add_(delta, alpha=multiplier - previous)
+        self._merged_multiplier = multiplier
+        return True
+
+    @torch.no_grad()
+    def restore_merged_weight(self: Module):
+        if self._merged_multiplier is None:
+            return
+        weight = self.org_module[0].weight
+        weight.data.copy_(self._merge_base_weight)
+        # writes through .data leave weight._version alone, so the copy stays valid for the next round
+        self._merged_multiplier = None
+
     def setup_lorm(self: Module, state_dict: Optional[Dict[str, Any]] = None):
         # LoRM (Low Rank Middle) is a method reduce the number of parameters in a module while keeping the inputs and
         # outputs the same. It is basically a LoRA but with the original module removed
@@ -455,6 +694,10 @@ class ToolkitNetworkMixin:
         self.can_merge_in = not is_lorm
         # will prevent optimizer from loading as it will have double states
         self.did_change_weights = False
+        self.fused_forward = network_config is not None and network_config.fused_forward
+        self.grouped_forward = network_config is not None and network_config.grouped_forward
+        # multiplier the modules are merged in at by set_merged_multiplier, None when not merged
+        self.merged_multiplier: Optional[float] = None
 
     def get_keymap(self: Network, force_weight_mapping=False):
         use_weight_mapping = False
@@ -513,7 +756,9 @@ class ToolkitNetworkMixin:
 
         return keymap
     
-    def get_state_dict(self: Network, extra_state_dict=None, dtype=torch.float16):
+    def get_state_dict(self: Network, extra_state_dict=None, dtype=torch.float16, device="cpu"):
+        # device=None leaves the tensors where they are, without a copy when they are already dtype.
+        # only use it if they are copied off right away, like CheckpointWriter.snapshot does
         keymap = self.get_keymap()
 
         save_keymap = {}
@@ -527,7 +772,7 @@ class ToolkitNetworkMixin:
 
         for key in list(state_dict.keys()):
             v = state_dict[key]
-            v = v.detach().clone().to("cpu").to(dtype)
+            v = self._get_save_tensor(v, dtype, device)
             save_key = save_keymap[key] if key in save_keymap else key
             save_dict[save_key] = v
             del state_dict[key]
@@ -536,7 +781,7 @@ class ToolkitNetworkMixin:
             # add extra items to state dict
             for key in list(extra_state_dict.keys()):
                 v = extra_state_dict[key]
-                v = v.detach().clone().to("cpu").to(dtype)
+                v = self._get_save_tensor(v, dtype, device)
                 save_dict[key] = v
 
         if self.peft_format:
@@ -573,6 +818,11 @@ class ToolkitNetworkMixin:
             save_dict = self.base_model_ref().convert_lora_weights_before_save(save_dict)
         return save_dict
 
+    def _get_save_tensor(self: Network, v: torch.Tensor, dtype, device):
+        if device is None:
+            return v.detach().to(dtype)
+        return v.detach().clone().to(device).to(dtype)
+
     def save_weights(
             self: Network,
             file, dtype=torch.float16,
@@ -580,7 +830,10 @@ class ToolkitNetworkMixin:
             extra_state_dict: Optional[OrderedDict] = None
     ):
         save_dict = self.get_state_dict(extra_state_dict=extra_state_dict, dtype=dtype)
-        
+        self.save_state_dict(save_dict, file, metadata=metadata)
+
+    def save_state_dict(self: Network, save_dict, file, metadata=None, atomic=False):
+        # save a state dict from get_state_dict. atomic writes safetensors through a temp file and rename
         if metadata is not None and len(metadata) == 0:
             metadata = None
 
@@ -591,14 +844,22 @@ class ToolkitNetworkMixin:
         
         if self.base_model_ref is not None and hasattr(self.base_model_ref(), 'save_lora'):
             # call the base model save lora method
-            self.base_model_ref().save_lora(save_dict, file, metadata)
+            self.base_model_ref().save_lora(save_dict, file, metadata, atomic=atomic)
             return
         
         if os.path.splitext(file)[1] == ".safetensors":
-            from safetensors.torch import save_file
-            save_file(save_dict, file, metadata)
+            if atomic:
+                from toolkit.checkpoint_writer import atomic_save_file
+                atomic_save_file(save_dict, file, metadata)
+            else:
+                from safetensors.torch import save_file
+                save_file(save_dict, file, metadata)
         else:
-            torch.save(save_dict, file)
+            if atomic:
+                from toolkit.checkpoint_writer import atomic_torch_save
+                atomic_torch_save(save_dict, file)
+            else:
+                torch.save(save_dict, file)
 
     def load_weights(self: Network, file, force_weight_mapping=False):
         # allows us to save and load to and from ldm weights
@@ -756,6 +1017,21 @@ class ToolkitNetworkMixin:
 
             self.torch_multiplier = tensor_multiplier.clone().detach()
 
+    def get_batch_multiplier(self: Network, batch_size: int) -> torch.Tensor:
+        # torch_multiplier repeat interleaved to batch_size, cached until torch_multiplier changes
+        multiplier = self.torch_multiplier
+        cache = getattr(self, '_batch_multiplier_cache', None)
+        if cache is None or cache[0] is not multiplier:
+            cache = (multiplier, {})
+            self._batch_multiplier_cache = cache
+        batch_multiplier = cache[1].get(batch_size, None)
+        if batch_multiplier is None:
+            batch_multiplier = multiplier
+            if batch_size != multiplier.size(0):
+                batch_multiplier = multiplier.repeat_interleave(batch_size // multiplier.size(0))
+            cache[1][batch_size] = batch_multiplier
+        return batch_multiplier
+
     @property
     def multiplier(self) -> Union[float, List[float], List[List[float]]]:
         return self._multiplier
@@ -776,6 +1052,8 @@ class ToolkitNetworkMixin:
 
     def __exit__(self: Network, exc_type, exc_value, tb):
         self.is_active = False
+        # sampling runs inside the network context, put merged weights back even if it raised
+        self.restore_merged_weights()
 
     def force_to(self: Network, device, dtype):
         self.to(device, dtype)
@@ -795,6 +1073,42 @@ class ToolkitNetworkMixin:
             loras += self.text_encoder_loras
         return loras
 
+    def setup_lora_groups(self: Network):
+        # group the loras of sibling projections in LORA_INPUT_GROUPS, by their lora name prefix
+        self._lora_groups_ready = True
+        for module in self.get_all_modules():
+            module._lora_group = None
+        if not self.grouped_forward:
+            return
+        candidates = {}
+        for module in self.get_all_modules():
+            if module.__class__.__name__ != "LoRAModule" or module.full_rank:
+                continue
+            if not isinstance(module.lora_down, nn.Linear) or module.lora_up.bias is not None:
+                continue
+            candidates[module.lora_name] = module
+
+        num_groups = 0
+        for names in LORA_INPUT_GROUPS:
+            suffix = f"_{names[0]}"
+            for lora_name in list(candidates.keys()):
+                if lora_name not in candidates or not lora_name.endswith(suffix):
+                    continue
+                prefix = lora_name[:-len(suffix)]
+                member_names = [f"{prefix}_{name}" for name in names]
+                if not all(name in candidates for name in member_names):
+                    continue
+                members = [candidates.pop(name) for name in member_names]
+                in_features = members[0].lora_down.weight.size(1)
+                if any(m.lora_down.weight.size(1) != in_features for m in members):
+                    candidates.update({m.lora_name: m for m in members})
+                    continue
+                group = LoRAModuleGroup(members)
+                for member in members:
+                    member._lora_group = group
+                num_groups += 1
+        print_once(f"Grouped {num_groups} sets of LoRA modules that share an input")
+
     def _update_checkpointing(self: Network):
         for module in self.get_all_modules():
             if self.is_checkpointing:
@@ -826,6 +1140,25 @@ class ToolkitNetworkMixin:
         for module in self.get_all_modules():
             module.merge_out(merge_weight)
 
+    def set_merged_multiplier(self: Network, multiplier: float):
+        # merges every module that can be at multiplier, keeping the original weights to restore.
+        # modules that cannot be merged run the side path with the network multiplier
+        if self.network_type.lower() == 'dora':
+            return
+        if self.merged_multiplier == multiplier:
+            return
+        for module in self.get_all_modules():
+            module.set_merged_multiplier(multiplier)
+        self.merged_multiplier = multiplier
+
+    def restore_merged_weights(self: Network):
+        # puts the original weights back after set_merged_multiplier
+        if self.merged_multiplier is None:
+            return
+        for module in self.get_all_modules():
+            module.restore_merged_weight()
+        self.merged_multiplier = None
+
     def extract_weight(
             self: Network,
             extract_mode: ExtractMode = "existing",
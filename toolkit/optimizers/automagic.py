@@ -1,9 +1,13 @@
-from typing import List
+from typing import Dict, List, Tuple
 import torch
 from toolkit.optimizers.optimizer_utils import Auto8bitTensor, copy_stochastic, stochastic_grad_accummulation
 from optimum.quanto import QBytesTensor
 import random
 
+# stacked updates are capped at this many elements per bucket so the copies stay small. Bigger
+# params are not launch bound and keep the per param loop
+_FOREACH_MAX_NUMEL = 2 ** 24
+
 
 class Automagic(torch.optim.Optimizer):
     def __init__(
@@ -19,6 +23,7 @@ class Automagic(torch.optim.Optimizer):
         weight_decay=0.0,
         do_paramiter_swapping=False,
         paramiter_swapping_factor=0.1,
+        foreach=False,
     ):
         self.lr = lr
         if self.lr > 1e-3:
@@ -42,6 +47,8 @@ class Automagic(torch.optim.Optimizer):
         ]
 
         self.is_stochastic_rounding_accumulation = False
+        # update params of the same shape and dtype together with stacked tensors instead of one by one
+        self.foreach = foreach
 
         # setup stochastic grad accum hooks
         for group in self.param_groups:
@@ -162,11 +169,13 @@ class Automagic(torch.optim.Optimizer):
         if closure is not None:
             loss = closure()
 
+        # lr mask scales of the stacked updates, read back with a single sync at the end
+        pending_scales = []
         for group in self.param_groups:
-            for p in group["params"]:
-                if p.grad is None or not p.requires_grad:
-                    continue
-
+            params = [p for p in group["params"] if p.grad is not None and p.requires_grad]
+            if self.foreach:
+                params = self._foreach_step(group, params, pending_scales)
+            for p in params:
                 grad = p.grad
                 if grad.dtype != torch.float32:
                     grad = grad.to(torch.float32)
@@ -182,20 +191,7 @@ class Automagic(torch.optim.Optimizer):
                 if len(state) == 0:
                     self.initialize_state(p)
                 else:
-                    # Check if exp_avg_sq_row and exp_avg_sq_col exist for factored case
-                    if factored:
-                        if "exp_avg_sq_row" not in state or "exp_avg_sq_col" not in state:
-                            state["exp_avg_sq_row"] = torch.zeros(p.shape[:-1]).to(grad)
-                            state["exp_avg_sq_col"] = torch.zeros(p.shape[:-2] + p.shape[-1:]).to(grad)
-                        else:
-                            state["exp_avg_sq_row"] = state["exp_avg_sq_row"].to(grad)
-                            state["exp_avg_sq_col"] = state["exp_avg_sq_col"].to(grad)
-                    # Check if exp_avg_sq exists for non-factored case
-                    else:
-                        if "exp_avg_sq" not in state:
-                            state["exp_avg_sq"] = torch.zeros_like(grad)
-                        else:
-                            state["exp_avg_sq"] = state["exp_avg_sq"].to(grad)
+                    self._ensure_second_moment(p, state, grad.dtype, grad.device)
 
                 p_data_fp32 = p
 
@@ -284,7 +280,222 @@ class Automagic(torch.optim.Optimizer):
                     # apply stochastic rounding
                     copy_stochastic(p, p_data_fp32)
 
+        if len(pending_scales) > 0:
+            scales = torch.cat([scale for _, scale in pending_scales]).tolist()
+            idx = 0
+            for lr_masks, scale in pending_scales:
+                for lr_mask in lr_masks:
+                    lr_mask.scale = scales[idx]
+                    idx += 1
+
         return loss
+
+    @staticmethod
+    def _ensure_second_moment(p, state, dtype, device):
+        factored = len(p.shape) >= 2
+        # Check if exp_avg_sq_row and exp_avg_sq_col exist for factored case
+        if factored:
+            if "exp_avg_sq_row" not in state or "exp_avg_sq_col" not in state:
+                state["exp_avg_sq_row"] = torch.zeros(p.shape[:-1]).to(device=device, dtype=dtype)
+                state["exp_avg_sq_col"] = torch.zeros(p.shape[:-2] + p.shape[-1:]).to(device=device, dtype=dtype)
+            else:
+                state["exp_avg_sq_row"] = state["exp_avg_sq_row"].to(device=device, dtype=dtype)
+                state["exp_avg_sq_col"] = state["exp_avg_sq_col"].to(device=device, dtype=dtype)
+        # Check if exp_avg_sq exists for non-factored case
+        else:
+            if "exp_avg_sq" not in state:
+                state["exp_avg_sq"] = torch.zeros(p.shape).to(device=device, dtype=dtype)
+            else:
+                state["exp_avg_sq"] = state["exp_avg_sq"].to(device=device, dtype=dtype)
+
+    @staticmethod
+    def _reduce_stacked(fn, tensor):
+        # fn of every param in a stack, run on each param like the loop so the sums are in the same order.
+        # vectorized reductions depend on the alignment of the data, a misaligned slice is copied first
+        return torch.stack([fn(t if t.data_ptr() % 16 == 0 else t.clone()) for t in tensor.unbind(0)])
+
+    @staticmethod
+    def _approx_sq_grad_stacked(exp_avg_sq_row, exp_avg_sq_col):
+        # _approx_sq_grad with the row means taken per param
+        row_mean = Automagic._reduce_stacked(lambda row: row.mean(dim=-1, keepdim=True), exp_avg_sq_row)
+        r_factor = (exp_avg_sq_row / row_mean).rsqrt_().unsqueeze(-1)
+        c_factor = exp_avg_sq_col.unsqueeze(-2).rsqrt()
+        return torch.mul(r_factor, c_factor)
+
+    @staticmethod
+    def _copy_stacked(targets, stacked):
+        if hasattr(torch, "_foreach_copy_"):
+            torch._foreach_copy_(targets, list(stacked.unbind(0)))
+        else:
+            for target, source in zip(targets, stacked.unbind(0)):
+                target.copy_(source)
+
+    def _foreach_step(self, group, params, pending_scales) -> List[torch.Tensor]:
+        """
+        Updates params with the same shape, dtype and device together on stacked tensors, so the
+        elementwise math runs as one kernel per op instead of one per param. Reductions (rms, clip,
+        means) still run per param in the order the loop sums them, so the state and float32 params
+        match the loop bit for bit. The state is written back per param exactly like the loop does,
+        so state_dict and load_state_dict do not change. Params that are not float32 are rounded
+        with one stochastic rounding draw for the stack, the noise differs from the loop's draws.
+
+        Returns the params it did not update, for the per param loop.
+        """
+        leftover = []
+        buckets: Dict[Tuple, List[torch.Tensor]] = {}
+        for p in params:
+            if p.grad.is_sparse:
+                raise RuntimeError(
+                    "Automagic does not support sparse gradients.")
+            state = self.state[p]
+            if isinstance(p, QBytesTensor) or p.numel() > _FOREACH_MAX_NUMEL:
+                leftover.append(p)
+                continue
+            if len(state) > 0 and ('last_polarity' not in state or 'lr_mask' not in state):
+                # the loop reinitializes these halfway through the update
+                leftover.append(p)
+                continue
+            # fresh second moments are created in the param dtype, the loop keeps them that way for a step
+            fresh = len(state) == 0
+            key = (tuple(p.shape), p.dtype, p.device, fresh)
+            buckets.setdefault(key, []).append(p)
+
+        for bucket in buckets.values():
+            if len(bucket) < 2:
+                leftover += bucket
+                continue
+            # split so a stack stays under the cap
+            per_chunk = max(1, _FOREACH_MAX_NUMEL // max(1, bucket[0].numel()))
+            for start in range(0, len(bucket), per_chunk):
+                chunk = bucket[start:start + per_chunk]
+                if len(chunk) < 2:
+                    leftover += chunk
+                    continue
+                self._foreach_update(group, chunk, pending_scales)
+        return leftover
+
+    def _foreach_update(self, group, params, pending_scales):
+        # the per param update of step, with every tensor stacked over params
+        grads = torch.stack([p.grad for p in params])
+        if grads.dtype != torch.float32:
+            grads = grads.to(torch.float32)
+        states = [self.state[p] for p in params]
+        for p, state in zip(params, states):
+            if len(state) == 0:
+                self.initialize_state(p)
+            else:
+                self._ensure_second_moment(p, state, grads.dtype, grads.device)
+
+        def _broadcast(t):
+            return t.view(-1, *([1] * (grads.ndim - 1)))
+
+        p_data_fp32 = torch.stack(params)
+        if p_data_fp32.dtype != torch.float32:
+            p_data_fp32 = p_data_fp32.float()
+
+        rms = self._reduce_stacked(self._rms, p_data_fp32).unbind(0)
+        for state, p_rms in zip(states, rms):
+            if "step" not in state:
+                state["step"] = 0
+            state["step"] += 1
+            state["RMS"] = p_rms
+
+        beta2 = group["beta2"]
+        eps = group["eps"]
+        if isinstance(eps, tuple) or isinstance(eps, list):
+            eps = eps[0]
+        update = (grads**2) + eps
+        factored = grads.ndim - 1 >= 2
+        if factored:
+            exp_avg_sq_row = torch.stack([state["exp_avg_sq_row"] for state in states])
+            exp_avg_sq_col = torch.stack([state["exp_avg_sq_col"] for state in states])
+
+            exp_avg_sq_row.mul_(beta2).add_(
+                self._reduce_stacked(lambda u: u.mean(dim=-1), update), alpha=(1.0 - beta2))
+            exp_avg_sq_col.mul_(beta2).add_(
+                self._reduce_stacked(lambda u: u.mean(dim=-2), update), alpha=(1.0 - beta2))
+
+            update = self._approx_sq_grad_stacked(
+                exp_avg_sq_row, exp_avg_sq_col)
+            update.mul_(grads)
+            for state, row, col in zip(states, exp_avg_sq_row.unbind(0), exp_avg_sq_col.unbind(0)):
+                state["exp_avg_sq_row"] = row
+                state["exp_avg_sq_col"] = col
+        else:
+            exp_avg_sq = torch.stack([state["exp_avg_sq"] for state in states])
+
+            exp_avg_sq.mul_(beta2).add_(update, alpha=(1.0 - beta2))
+            update = exp_avg_sq.rsqrt().mul_(grads)
+            for state, sq in zip(states, exp_avg_sq.unbind(0)):
+                state["exp_avg_sq"] = sq
+
+        update.div_(_broadcast(self._reduce_stacked(
+            lambda u: (self._rms(u) / group["clip_threshold"]).clamp_(min=1.0), update)))
+
+        last_polarity = torch.stack([state['last_polarity'] for state in states])
+        current_polarity = (update > 0).to(torch.bool)
+        sign_agreement = torch.where(
+            last_polarity == current_polarity, 1, -1)
+        for state, polarity in zip(states, current_polarity.unbind(0)):
+            state['last_polarity'] = polarity
+
+        # same as Auto8bitTensor.dequantize, the scale is rounded to float32 by the mul there too
+        lr_scale = torch.tensor(
+            [state['lr_mask'].scale for state in states], dtype=torch.float32
+        ).to(grads.device)
+        lr_mask = torch.stack([state['lr_mask'].quantized for state in states]).to(torch.float32)
+        lr_mask = lr_mask * _broadcast(lr_scale)
+
+        new_lr = torch.where(
+            sign_agreement > 0,
+            lr_mask + self.lr_bump,  # Increase lr
+            lr_mask - self.lr_bump  # Decrease lr
+        )
+        new_lr = torch.clamp(
+            new_lr,
+            min=self.min_lr,
+            max=self.max_lr
+        )
+
+        update.mul_(new_lr)
+
+        # Auto8bitTensor(new_lr) for every param. the scale is abs_max / 127.0 in double like python
+        # does it, a tensor divisor keeps cuda from turning it into a multiply by the reciprocal
+        abs_max = new_lr.flatten(1).abs().amax(dim=1).double()
+        scale = torch.where(
+            abs_max > 0,
+            abs_max / torch.full_like(abs_max, 127.0),
+            torch.ones_like(abs_max),
+        )
+        scale_fp32 = _broadcast(scale.float())
+        if new_lr.device.type == "cuda":
+            # cuda divides by a python scalar as a multiply by its float32 reciprocal
+            quantized = new_lr * scale_fp32.reciprocal()
+        else:
+            quantized = new_lr / scale_fp32
+        quantized = quantized.round().clamp(-127, 127).to(torch.int8)
+        avg_lr = [torch.mean(lr) for lr in new_lr.unbind(0)]
+        lr_masks = []
+        for state, q, p_avg_lr in zip(states, quantized.unbind(0), avg_lr):
+            # the scale is filled in at the end of step
+            state['lr_mask'] = Auto8bitTensor({'quantized': q, 'scale': None, 'orig_dtype': torch.float32})
+            state['avg_lr'] = p_avg_lr
+            lr_masks.append(state['lr_mask'])
+        pending_scales.append((lr_masks, scale))
+
+        if group["weight_decay"] != 0:
+            weight_decay_update = p_data_fp32 * (-group["weight_decay"]) * new_lr
+            p_data_fp32.add_(weight_decay_update)
+
+        p_data_fp32.add_(-update)
+
+        if params[0].dtype != torch.float32:
+            # apply stochastic rounding, drawn for the whole stack at once
+            rounded = torch.empty_like(p_data_fp32, dtype=params[0].dtype)
+            copy_stochastic(rounded, p_data_fp32)
+            self._copy_stacked(params, rounded)
+        else:
+            self._copy_stacked(params, p_data_fp32)
     
     def initialize_state(self, p):
         state = self.state[p]
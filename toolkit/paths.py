@@ -16,6 +16,18 @@ if 'MODELS_PATH' in os.environ:
 else:
     MODELS_PATH = os.path.join(TOOLKIT_ROOT, "models")
 
+# shared on disk tier of the text embedding cache, see toolkit/text_embedding_cache.py
+TEXT_EMBEDDING_CACHE_PATH = os.environ.get(
+    'TEXT_EMBEDDING_CACHE_PATH',
+    os.path.join(TOOLKIT_ROOT, "cache", "text_embeddings")
+)
+
+# default directory for the disk tier of layer offloading, see toolkit/memory_management/disk_tier.py
+OFFLOAD_CACHE_PATH = os.environ.get(
+    'OFFLOAD_CACHE_PATH',
+    os.path.join(TOOLKIT_ROOT, "cache", "offload")
+)
+
 
 def get_path(path):
     # we allow absolute paths, but if it is not absolute, we assume it is relative to the toolkit root
@@ -0,0 +1,99 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Iterable, Union
+
+from toolkit.print import print_acc
+
+
+class PrefetchPool:
+    """
+    Runs load_fn over a list of items on a thread pool and yields the results in order.
+    Used by the cache passes so image decoding and transforms for the next items happen
+    while the current ones are being encoded on the gpu.
+
+    At most max_prefetch items are loading or loaded and waiting at once, so memory stays bounded.
+    It keeps track of how long the consumer was blocked waiting on loading (io) versus how long
+    it spent doing its own work between items (gpu).
+    """
+
+    def __init__(
+            self,
+            load_fn: Callable[[Any], Any],
+            items: Iterable[Any],
+            num_workers: int = 2,
+            max_prefetch: Union[int, None] = None,
+            name: str = 'prefetch',
+    ):
+        self.load_fn = load_fn
+        self.items = list(items)
+        self.num_workers = max(1, num_workers)
+        if max_prefetch is None:
+            max_prefetch = self.num_workers * 2
+        self.max_prefetch = max(1, max_prefetch)
+        self.name = name
+
+        # time the consumer spent blocked waiting on a result
+        self.io_wait_time = 0.0
+        # time the consumer spent between results, doing its own work
+        self.compute_time = 0.0
+        # total time spent in load_fn, summed over all workers
+        self.load_time = 0.0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.items)
+
+    def _load(self, item):
+        start = time.perf_counter()
+        result = self.load_fn(item)
+        with self._lock:
+            self.load_time += time.perf_counter() - start
+        return result
+
+    def __iter__(self):
+        if len(self.items) == 0:
+            return
+        with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+            pending = deque()
+            item_iter = iter(self.items)
+
+            def fill():
+                while len(pending) < self.max_prefetch:
+                    try:
+                        item = next(item_iter)
+                    except StopIteration:
+                        return
+                    pending.append(executor.submit(self._load, item))
+
+            fill()
+            last_yield = None
+            try:
+                while len(pending) > 0:
+                    future = pending.popleft()
+                    # keep the workers busy while we wait
+                    fill()
+                    wait_start = time.perf_counter()
+                    if last_yield is not None:
+                        self.compute_time += wait_start - last_yield
+                    result = future.result()
+                    self.io_wait_time += time.perf_counter() - wait_start
+                    last_yield = time.perf_counter()
+                    yield result
+                if last_yield is not None:
+                    self.compute_time += time.perf_counter() - last_yield
+            finally:
+                # consumer stopped early or raised, don't load the rest
+                for future in pending:
+                    future.cancel()
+
+    def print_stats(self):
+        total = self.io_wait_time + self.compute_time
+        if total <= 0:
+            return
+        io_percent = self.io_wait_time / total * 100
+        print_acc(
+            f" - {self.name}: {self.compute_time:.1f}s on gpu, {self.io_wait_time:.1f}s waiting on io "
+            f"({io_percent:.1f}%), {self.load_time:.1f}s loading across {self.num_workers} workers"
+        )
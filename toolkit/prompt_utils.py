@@ -378,6 +378,75 @@ def split_prompt_embeds(concatenated: PromptEmbeds, num_parts=None) -> List[Prom
     return prompt_embeds_list
 
 
+def _slice_batch(value, idx: int, batch_size: int):
+    # returns None if value does not have a batch dim we recognize
+    if isinstance(value, (list, tuple)):
+        if len(value) == batch_size and all(len(t.shape) == 2 for t in value):
+            # list with one unbatched tensor per prompt
+            return [value[idx].clone()]
+        items = [_slice_batch(t, idx, batch_size) for t in value]
+        if any(t is None for t in items):
+            return None
+        return items
+    if len(value.shape) == 0 or value.shape[0] != batch_size:
+        return None
+    return value[idx:idx + 1].clone()
+
+
+def unbatch_prompt_embeds(
+        batched: PromptEmbeds,
+        batch_size: int,
+        trim_padding: bool = False,
+        padding_side: str = "right"
+) -> Optional[List[PromptEmbeds]]:
+    """
+    Splits embeds encoded for a batch of prompts into one PromptEmbeds per prompt. With trim_padding,
+    padding is cut from each prompt using its attention mask, for encoders that only pad to the longest
+    prompt in the batch. Returns None if the layout is not one this knows how to split.
+    """
+    text_embeds = batched.text_embeds
+    attention_mask = batched.attention_mask
+    if trim_padding:
+        # only a single text embed with a matching mask can be trimmed
+        if isinstance(text_embeds, (list, tuple)) or attention_mask is None:
+            return None
+        if isinstance(attention_mask, (list, tuple)) or len(text_embeds.shape) != 3:
+            return None
+        if attention_mask.shape[:2] != text_embeds.shape[:2]:
+            return None
+
+    prompt_embeds_list = []
+    for idx in range(batch_size):
+        text = _slice_batch(text_embeds, idx, batch_size)
+        if text is None:
+            return None
+        pooled = None
+        if batched.pooled_embeds is not None:
+            pooled = _slice_batch(batched.pooled_embeds, idx, batch_size)
+            if pooled is None:
+                return None
+        mask = None
+        if attention_mask is not None:
+            mask = _slice_batch(attention_mask, idx, batch_size)
+            if mask is None:
+                return None
+        if trim_padding:
+            num_tokens = int(mask.sum().item())
+            if padding_side == "right":
+                text = text[:, :num_tokens].clone()
+                mask = mask[:, :num_tokens].clone()
+            else:
+                text = text[:, text.shape[1] - num_tokens:].clone()
+                mask = mask[:, mask.shape[1] - num_tokens:].clone()
+        if isinstance(text, list) or pooled is not None:
+            pe = PromptEmbeds([text, pooled])
+        else:
+            pe = PromptEmbeds(text)
+        pe.attention_mask = mask
+        prompt_embeds_list.append(pe)
+    return prompt_embeds_list
+
+
 def split_prompt_pairs(concatenated: EncodedPromptPair, num_embeds=None) -> List[EncodedPromptPair]:
     target_class_splits = split_prompt_embeds(concatenated.target_class, num_embeds)
     target_class_with_neutral_splits = split_prompt_embeds(concatenated.target_class_with_neutral, num_embeds)
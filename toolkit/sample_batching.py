@@ -0,0 +1,97 @@
+from collections import OrderedDict
+from typing import TYPE_CHECKING, List, Union
+
+import torch
+
+from toolkit.prompt_utils import PromptEmbeds, concat_prompt_embeds
+
+if TYPE_CHECKING:
+    from toolkit.config_modules import GenerateImageConfig
+
+
+def get_sample_batch_key(gen_config: 'GenerateImageConfig') -> tuple:
+    # samples can only share a pipeline call if all of these match
+    return (
+        gen_config.width,
+        gen_config.height,
+        gen_config.num_inference_steps,
+        gen_config.guidance_scale,
+        gen_config.guidance_rescale,
+        gen_config.num_frames,
+        gen_config.network_multiplier,
+    )
+
+
+def can_batch_sample(gen_config: 'GenerateImageConfig') -> bool:
+    # per sample inputs that are passed to the pipeline one at a time
+    return (
+        gen_config.latents is None
+        and gen_config.adapter_image_path is None
+        and gen_config.ctrl_img is None
+        and gen_config.ctrl_img_1 is None
+        and gen_config.ctrl_img_2 is None
+        and gen_config.ctrl_img_3 is None
+        and len(gen_config.extra_kwargs) == 0
+        and len(gen_config.extra_values) == 0
+    )
+
+
+def get_sample_batches(image_configs: List['GenerateImageConfig'], batch_size: int) -> List[List[int]]:
+    """
+    Groups sample indexes into batches of up to batch_size that can be generated in one call,
+    in order of first appearance. Samples that cannot be batched get a batch of their own.
+    """
+    if batch_size <= 1:
+        return [[i] for i in range(len(image_configs))]
+    groups: 'OrderedDict[tuple, List[int]]' = OrderedDict()
+    for i, gen_config in enumerate(image_configs):
+        if can_batch_sample(gen_config):
+            key = get_sample_batch_key(gen_config)
+        else:
+            key = ('single', i)
+        groups.setdefault(key, []).append(i)
+    batches = []
+    for group in groups.values():
+        for start_idx in range(0, len(group), batch_size):
+            batches.append(group[start_idx:start_idx + batch_size])
+    return batches
+
+
+def sort_sample_batches_by_multiplier(
+        image_configs: List['GenerateImageConfig'],
+        batches: List[List[int]]
+) -> List[List[int]]:
+    # groups the batches by network multiplier, in order of first appearance. Seeds are per sample,
+    # so the order samples are generated in does not change them
+    groups: 'OrderedDict[float, List[List[int]]]' = OrderedDict()
+    for batch in batches:
+        groups.setdefault(image_configs[batch[0]].network_multiplier, []).append(batch)
+    return [batch for group in groups.values() for batch in group]
+
+
+def _get_embeds_shapes(prompt_embeds: PromptEmbeds) -> tuple:
+    shapes = []
+    for value in [prompt_embeds.text_embeds, prompt_embeds.pooled_embeds, prompt_embeds.attention_mask]:
+        if isinstance(value, (list, tuple)):
+            shapes.append(tuple(tuple(x.shape) for x in value))
+        elif value is None:
+            shapes.append(None)
+        else:
+            shapes.append(tuple(value.shape))
+    return tuple(shapes)
+
+
+def concat_sample_embeds(prompt_embeds: List[PromptEmbeds]) -> Union[PromptEmbeds, None]:
+    # batches the embeds of several samples. Returns None if they differ in shape, padding would change the output
+    if isinstance(prompt_embeds[0].attention_mask, (list, tuple)):
+        return None
+    shapes = _get_embeds_shapes(prompt_embeds[0])
+    for embeds in prompt_embeds[1:]:
+        if _get_embeds_shapes(embeds) != shapes:
+            return None
+    return concat_prompt_embeds(prompt_embeds)
+
+
+def get_sample_generators(image_configs: List['GenerateImageConfig']) -> List[torch.Generator]:
+    # one generator per sample, seeded like the single sample path so the initial noise matches
+    return [torch.Generator().manual_seed(gen_config.seed) for gen_config in image_configs]
@@ -34,6 +34,8 @@ from toolkit.models.decorator import Decorator
 from toolkit.paths import KEYMAPS_ROOT
 from toolkit.prompt_utils import inject_trigger_into_prompt, PromptEmbeds, concat_prompt_embeds
 from toolkit.reference_adapter import ReferenceAdapter
+from toolkit.sample_batching import concat_sample_embeds, get_sample_batches, get_sample_generators, \
+    sort_sample_batches_by_multiplier
 from toolkit.sampler import get_sampler
 from toolkit.samplers.custom_flowmatch_sampler import CustomFlowMatchEulerDiscreteScheduler
 from toolkit.saving import save_ldm_model_from_diffusers, get_ldm_state_dict_from_diffusers
@@ -74,6 +76,7 @@ from toolkit.bitsandbytes_utils import require_bitsandbytes
 
 if TYPE_CHECKING:
     from toolkit.lora_special import LoRASpecialNetwork
+    from toolkit.text_embedding_cache import TextEmbeddingCache
 
 # tell it to shut up
 diffusers.logging.set_verbosity(diffusers.logging.ERROR)
@@ -211,6 +214,8 @@ class StableDiffusion:
         self.is_transformer = False
         
         self.sample_prompts_cache = None
+        # shared TextEmbeddingCache, set by the trainer when train.text_embedding_cache is on
+        self.text_embedding_cache: Optional['TextEmbeddingCache'] = None
         
         self.is_multistage = False
         # a list of multistage boundaries starting with train step 1000 to first idx
@@ -1139,9 +1144,12 @@ class StableDiffusion:
             image_configs: List[GenerateImageConfig],
             sampler=None,
             pipeline: Union[None, StableDiffusionPipeline, StableDiffusionXLPipeline] = None,
+            batch_size: int = 1,
+            cached_merge: bool = False,
     ):
         network = unwrap_model(self.network)
         merge_multiplier = 1.0
+        use_cached_merge = False
         flush()
         # if using assistant, unfuse it
         if self.model_config.assistant_lora_path is not None:
@@ -1164,7 +1172,10 @@ class StableDiffusion:
             # check if we have the same network weight for all samples. If we do, we can merge in th
             # the network to drastically speed up inference
             unique_network_weights = set([x.network_multiplier for x in image_configs])
-            if len(unique_network_weights) == 1 and network.can_merge_in:
+            if cached_merge and network.can_merge_in:
+                # merged at each sample's multiplier, then restored exactly after sampling
+                use_cached_merge = True
+            elif len(unique_network_weights) == 1 and network.can_merge_in:
                 # make sure it is on device before merging. 
                 self.unet.to(self.device_torch)
                 can_merge_in = True
@@ -1379,7 +1390,18 @@ class StableDiffusion:
                 if network is not None:
                     assert network.is_active
 
-                for i in tqdm(range(len(image_configs)), desc=f"Generating Images", leave=False):
+                # samples with the same size, steps, guidance and multiplier are denoised together.
+                # adapters and the refiner are set up per sample, so those go one at a time
+                if not self.can_generate_batched_images(sampler) or self.adapter is not None or self.refiner_unet is not None:
+                    batch_size = 1
+                sample_batches = get_sample_batches(image_configs, batch_size)
+                if use_cached_merge:
+                    # each multiplier change rewrites the merged weights, so do them one multiplier at a time
+                    sample_batches = sort_sample_batches_by_multiplier(image_configs, sample_batches)
+                sample_batch_sizes = {i: len(batch) for batch in sample_batches for i in batch}
+                pending_samples = []
+
+                for i in tqdm([i for batch in sample_batches for i in batch], desc=f"Generating Images", leave=False):
                     gen_config = image_configs[i]
 
                     extra = {}
@@ -1427,6 +1449,8 @@ class StableDiffusion:
 
                     if network is not None:
                         network.multiplier = gen_config.network_multiplier
+                        if use_cached_merge:
+                            network.set_merged_multiplier(gen_config.network_multiplier)
                     torch.manual_seed(gen_config.seed)
                     torch.cuda.manual_seed(gen_config.seed)
                     
@@ -1532,6 +1556,15 @@ class StableDiffusion:
                     conditional_embeds = conditional_embeds.to(self.device_torch, dtype=self.unet.dtype)
                     unconditional_embeds = unconditional_embeds.to(self.device_torch, dtype=self.unet.dtype)
 
+                    if sample_batch_sizes[i] > 1:
+                        # generate once the rest of the batch is encoded
+                        pending_samples.append((i, gen_config, conditional_embeds, unconditional_embeds))
+                        if len(pending_samples) == sample_batch_sizes[i]:
+                            self._generate_sample_batch(pipeline, pending_samples, extra, len(image_configs))
+                            pending_samples = []
+                        flush()
+                        continue
+
                     if self.is_xl:
                         # fix guidance rescale for sdxl
                         # was trained on 0.7 (I believe)
@@ -1763,6 +1796,94 @@ class StableDiffusion:
 
         flush()
 
+    def can_generate_batched_images(self, sampler: str) -> bool:
+        # the pipelines generate_batched_images knows how to call
+        if self.is_flux or self.is_lumina2 or self.is_pixart or self.is_auraflow:
+            return False
+        # the k-diffusion pipeline does not take a generator per sample
+        return sampler is None or not sampler.startswith("sample_")
+
+    def generate_batched_images(
+            self,
+            pipeline,
+            gen_configs: List[GenerateImageConfig],
+            conditional_embeds: PromptEmbeds,
+            unconditional_embeds: PromptEmbeds,
+            generators: List[torch.Generator],
+            extra: dict,
+    ) -> list:
+        # one pipeline call for samples that share size, steps and guidance, one generator per sample
+        gen_config = gen_configs[0]
+        if self.is_xl:
+            return pipeline(
+                prompt_embeds=conditional_embeds.text_embeds,
+                pooled_prompt_embeds=conditional_embeds.pooled_embeds,
+                negative_prompt_embeds=unconditional_embeds.text_embeds,
+                negative_pooled_prompt_embeds=unconditional_embeds.pooled_embeds,
+                height=gen_config.height,
+                width=gen_config.width,
+                num_inference_steps=gen_config.num_inference_steps,
+                guidance_scale=gen_config.guidance_scale,
+                guidance_rescale=gen_config.guidance_rescale,
+                generator=generators,
+                **extra
+            ).images
+        elif self.is_v3:
+            return pipeline(
+                prompt_embeds=conditional_embeds.text_embeds,
+                pooled_prompt_embeds=conditional_embeds.pooled_embeds,
+                negative_prompt_embeds=unconditional_embeds.text_embeds,
+                negative_pooled_prompt_embeds=unconditional_embeds.pooled_embeds,
+                height=gen_config.height,
+                width=gen_config.width,
+                num_inference_steps=gen_config.num_inference_steps,
+                guidance_scale=gen_config.guidance_scale,
+                generator=generators,
+                **extra
+            ).images
+        else:
+            return pipeline(
+                prompt_embeds=conditional_embeds.text_embeds,
+                negative_prompt_embeds=unconditional_embeds.text_embeds,
+                height=gen_config.height,
+                width=gen_config.width,
+                num_inference_steps=gen_config.num_inference_steps,
+                guidance_scale=gen_config.guidance_scale,
+                generator=generators,
+                **extra
+            ).images
+
+    def _generate_sample_batch(self, pipeline, samples: list, extra: dict, total_imgs: int):
+        # samples is a list of (index, gen_config, conditional_embeds, unconditional_embeds) sharing a batch key
+        gen_configs = [x[1] for x in samples]
+        conditional_embeds = concat_sample_embeds([x[2] for x in samples])
+        unconditional_embeds = concat_sample_embeds([x[3] for x in samples])
+        if conditional_embeds is None or unconditional_embeds is None:
+            # prompts encoded to different lengths, padding would change them. Do them one at a time
+            images = []
+            for _, gen_config, single_conditional_embeds, single_unconditional_embeds in samples:
+                images += self.generate_batched_images(
+                    pipeline,
+                    [gen_config],
+                    single_conditional_embeds,
+                    single_unconditional_embeds,
+                    get_sample_generators([gen_config]),
+                    dict(extra),
+                )
+        else:
+            images = self.generate_batched_images(
+                pipeline,
+                gen_configs,
+                conditional_embeds,
+                unconditional_embeds,
+                get_sample_generators(gen_configs),
+                dict(extra),
+            )
+        for (i, gen_config, _, _), img in zip(samples, images):
+            gen_config.save_image(img, i)
+            gen_config.log_image(img, i)
+            self._after_sample_image(i, total_imgs)
+
     def get_latent_noise(
             self,
             height=None,
@@ -0,0 +1,334 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Dict, List, Optional, Union
+
+import torch
+
+from toolkit.print import print_acc
+from toolkit.prompt_utils import PromptEmbeds, unbatch_prompt_embeds
+
+if TYPE_CHECKING:
+    from toolkit.models.base_model import BaseModel
+    from toolkit.stable_diffusion_model import StableDiffusion
+
+# bump to invalidate every shared cache entry if what encode_prompt returns changes
+TEXT_EMBEDDING_CACHE_VERSION = 3
+
+# model_kwargs entries that pick which text encoder weights a model loads
+TEXT_ENCODER_MODEL_KWARGS = ['llama_model_path']
+
+
+def hash_file(path: str) -> str:
+    # content hash of a control image, so a moved or renamed image still hits the cache
+    hasher = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def hash_control_images(paths: Union[str, List[str], None]) -> Optional[str]:
+    if paths is None:
+        return None
+    if not isinstance(paths, list):
+        paths = [paths]
+    return ','.join(hash_file(path) for path in paths)
+
+
+def get_text_encoder_identity(sd: Union['BaseModel', 'StableDiffusion']) -> OrderedDict:
+    # what decides the embeddings a prompt encodes to, besides the prompt
+    model_config = sd.model_config
+    return OrderedDict([
+        ("version", TEXT_EMBEDDING_CACHE_VERSION),
+        ("arch", model_config.arch),
+        ("name_or_path", model_config.name_or_path),
+        ("extras_name_or_path", getattr(model_config, 'extras_name_or_path', None)),
+        ("te_name_or_path", model_config.te_name_or_path),
+        ("te_model_kwargs", {key: model_config.model_kwargs.get(key, None) for key in TEXT_ENCODER_MODEL_KWARGS}),
+        # a quantized or lower precision text encoder encodes to different embeddings
+        ("te_dtype", str(model_config.te_dtype)),
+        ("text_encoder_bits", model_config.text_encoder_bits),
+        ("quantize_te", model_config.quantize_te),
+        ("qtype_te", model_config.qtype_te if model_config.quantize_te else None),
+        ("te_padding_side", sd.te_padding_side),
+        ("encode_control_in_text_embeddings", sd.encode_control_in_text_embeddings),
+    ])
+
+
+def _get_embeds_nbytes(prompt_embeds: PromptEmbeds) -> int:
+    total = 0
+    for value in [prompt_embeds.text_embeds, prompt_embeds.pooled_embeds, prompt_embeds.attention_mask]:
+        if value is None:
+            continue
+        if not isinstance(value, (list, tuple)):
+            value = [value]
+        total += sum(t.numel() * t.element_size() for t in value)
+    return total
+
+
+def _as_list(value) -> list:
+    if value is None:
+        return []
+    if isinstance(value, (list, tuple)):
+        return list(value)
+    return [value]
+
+
+def prompt_embeds_match(a: PromptEmbeds, b: PromptEmbeds) -> bool:
+    # same layout, shapes, dtypes and values, bit for bit
+    for value_a, value_b in [
+        (a.text_embeds, b.text_embeds),
+        (a.pooled_embeds, b.pooled_embeds),
+        (a.attention_mask, b.attention_mask),
+    ]:
+        if isinstance(value_a, (list, tuple)) != isinstance(value_b, (list, tuple)):
+            return False
+        list_a = _as_list(value_a)
+        list_b = _as_list(value_b)
+        if len(list_a) != len(list_b):
+            return False
+        for t_a, t_b in zip(list_a, list_b):
+            if t_a.shape != t_b.shape or t_a.dtype != t_b.dtype:
+                return False
+            if not torch.equal(t_a.cpu(), t_b.cpu()):
+                return False
+    return True
+
+
+class BatchedPromptEncoder:
+    """
+    Encodes prompts with sd.encode_prompt in batches and splits the result back into exactly what
+    encode_prompt returns for each prompt on its own.
+
+    Encoders either pad every prompt to a fixed length, pad to the longest prompt in the batch, or
+    return one tensor per prompt, and which one a model does is not exposed. Batching can also change
+    the kernels the matmuls run with. So before the first batch, a full batch of the prompts, with a
+    one token prompt and the longest prompt among them, is encoded alone and together. The split that
+    reproduces every single prompt output exactly (plain slices, or slices trimmed by the attention
+    mask) is used from then on. If neither does, prompts are encoded one at a time like before.
+    """
+
+    def __init__(self, sd: Union['BaseModel', 'StableDiffusion'], batch_size: int = 1):
+        self.sd = sd
+        self.batch_size = max(1, batch_size)
+        # None until probed, then 'slice', 'trim' or 'single'
+        self.split_mode: Optional[str] = None if self.batch_size > 1 else 'single'
+
+    def _split(self, batched: PromptEmbeds, batch_size: int, split_mode: str) -> Optional[List[PromptEmbeds]]:
+        return unbatch_prompt_embeds(
+            batched,
+            batch_size,
+            trim_padding=split_mode == 'trim',
+            padding_side=self.sd.te_padding_side
+        )
+
+    def _probe(self, prompts: List[str]):
+        # the batch size the prompts are encoded with, in case it picks different kernels
+        probe_prompts = ['a', max(prompts, key=len)]
+        for prompt in prompts:
+            if len(probe_prompts) >= self.batch_size:
+                break
+            if prompt not in probe_prompts:
+                probe_prompts.append(prompt)
+        singles = [self.sd.encode_prompt(prompt) for prompt in probe_prompts]
+        batched = self.sd.encode_prompt(probe_prompts)
+        self.split_mode = 'single'
+        for split_mode in ['slice', 'trim']:
+            split = self._split(batched, len(probe_prompts), split_mode)
+            if split is not None and all(prompt_embeds_match(x, y) for x, y in zip(split, singles)):
+                self.split_mode = split_mode
+                break
+        if self.split_mode == 'single':
+            print_acc(" - Batched text encoding does not match single prompt encoding for this model, encoding one at a time")
+
+    @torch.no_grad()
+    def encode(self, prompts: List[str]) -> List[PromptEmbeds]:
+        if len(prompts) == 0:
+            return []
+        if self.split_mode is None:
+            self._probe(prompts)
+        if self.split_mode == 'single':
+            return [self.sd.encode_prompt(prompt) for prompt in prompts]
+
+        prompt_embeds_list = []
+        for start_idx in range(0, len(prompts), self.batch_size):
+            batch_prompts = prompts[start_idx:start_idx + self.batch_size]
+            if len(batch_prompts) == 1:
+                prompt_embeds_list.append(self.sd.encode_prompt(batch_prompts[0]))
+                continue
+            batched = self.sd.encode_prompt(batch_prompts)
+            split = self._split(batched, len(batch_prompts), self.split_mode)
+            if split is None:
+                # layout changed from the probe, should not happen
+                split = [self.sd.encode_prompt(prompt) for prompt in batch_prompts]
+            prompt_embeds_list.extend(split)
+        return prompt_embeds_list
+
+
+class TextEmbeddingCache:
+    """
+    Content addressed cache of encoded prompts, keyed by the text encoder identity, the prompt,
+    the control images and the padding side.
+
+    It has two tiers. A memory lru bounded to max_memory_mb, and a folder on disk shared by every
+    dataset, sample config and job that uses it. Identical prompts are only encoded once across
+    all of them. Entries are written through a temp file and renamed, so jobs sharing the folder
+    never read a partial file.
+
+    Embeds are stored and returned on the cpu as clones, PromptEmbeds.to works in place.
+    """
+
+    def __init__(self, cache_dir: Optional[str], max_memory_mb: float = 1024):
+        self.cache_dir = cache_dir
+        self.max_memory_bytes = int(max_memory_mb * 1024 * 1024)
+        self._memory: 'OrderedDict[str, PromptEmbeds]' = OrderedDict()
+        self._memory_nbytes: Dict[str, int] = {}
+        self._memory_total = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        if self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    def get_key(
+            self,
+            sd: Union['BaseModel', 'StableDiffusion'],
+            prompt: str,
+            control_hash: Optional[str] = None,
+    ) -> str:
+        key_dict = get_text_encoder_identity(sd)
+        key_dict["prompt"] = prompt
+        key_dict["control_hash"] = control_hash
+        key_input = json.dumps(key_dict, sort_keys=True).encode('utf-8')
+        return hashlib.sha256(key_input).hexdigest()
+
+    def _get_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], f"{key}.safetensors")
+
+    def _add_to_memory(self, key: str, prompt_embeds: PromptEmbeds):
+        nbytes = _get_embeds_nbytes(prompt_embeds)
+        if nbytes > self.max_memory_bytes:
+            return
+        with self._lock:
+            if key in self._memory:
+                self._memory_total -= self._memory_nbytes[key]
+            self._memory[key] = prompt_embeds
+            self._memory.move_to_end(key)
+            self._memory_nbytes[key] = nbytes
+            self._memory_total += nbytes
+            while self._memory_total > self.max_memory_bytes:
+                evicted_key, _ = self._memory.popitem(last=False)
+                self._memory_total -= self._memory_nbytes.pop(evicted_key)
+
+    def get(self, key: str) -> Optional[PromptEmbeds]:
+        with self._lock:
+            prompt_embeds = self._memory.get(key, None)
+            if prompt_embeds is not None:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return prompt_embeds.clone()
+
+        if self.cache_dir is not None:
+            path = self._get_path(key)
+            if os.path.exists(path):
+                try:
+                    prompt_embeds = PromptEmbeds.load(path)
+                except Exception as e:
+                    # another job may have left a bad file, it gets rewritten on put
+                    print_acc(f"Error loading cached text embedding {path}: {e}")
+                    prompt_embeds = None
+                if prompt_embeds is not None:
+                    self._add_to_memory(key, prompt_embeds)
+                    self.disk_hits += 1
+                    return prompt_embeds.clone()
+
+        self.misses += 1
+        return None
+
+    def put(self, key: str, prompt_embeds: PromptEmbeds):
+        prompt_embeds = prompt_embeds.detach().to('cpu')
+        self._add_to_memory(key, prompt_embeds)
+        if self.cache_dir is not None:
+            path = self._get_path(key)
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            try:
+                prompt_embeds.save(tmp_path)
+                os.replace(tmp_path, path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+
+    @torch.no_grad()
+    def encode_prompt(
+            self,
+            sd: Union['BaseModel', 'StableDiffusion'],
+            prompt: str,
+            control_images=None,
+            control_hash: Optional[str] = None,
+    ) -> PromptEmbeds:
+        """
+        sd.encode_prompt(prompt, control_images=control_images) through the cache. control_hash
+        has to identify the control images, see hash_control_images. Returns cpu embeds.
+        """
+        if control_images is not None and control_hash is None:
+            raise ValueError("control_hash is needed to cache prompts encoded with control images")
+        key = self.get_key(sd, prompt, control_hash)
+        prompt_embeds = self.get(key)
+        if prompt_embeds is None:
+            if control_images is not None:
+                prompt_embeds = sd.encode_prompt(prompt, control_images=control_images)
+            else:
+                prompt_embeds = sd.encode_prompt(prompt)
+            prompt_embeds = prompt_embeds.detach().to('cpu')
+            self.put(key, prompt_embeds)
+        return prompt_embeds
+
+    @torch.no_grad()
+    def encode_prompts(
+            self,
+            sd: Union['BaseModel', 'StableDiffusion'],
+            prompts: List[str],
+            batch_encoder: Optional[BatchedPromptEncoder] = None,
+    ) -> List[PromptEmbeds]:
+        # encode_prompt for many prompts, the ones not cached are encoded together with batch_encoder
+        keys = [self.get_key(sd, prompt) for prompt in prompts]
+        prompt_embeds_list = [self.get(key) for key in keys]
+        missing_idxs = [i for i, prompt_embeds in enumerate(prompt_embeds_list) if prompt_embeds is None]
+        if len(missing_idxs) > 0:
+            missing_prompts = [prompts[i] for i in missing_idxs]
+            if batch_encoder is not None:
+                encoded = batch_encoder.encode(missing_prompts)
+            else:
+                encoded = [sd.encode_prompt(prompt) for prompt in missing_prompts]
+            for i, prompt_embeds in zip(missing_idxs, encoded):
+                prompt_embeds = prompt_embeds.detach().to('cpu')
+                self.put(keys[i], prompt_embeds)
+                prompt_embeds_list[i] = prompt_embeds
+        return prompt_embeds_list
+
+    def print_stats(self, name: str = 'Text embedding cache'):
+        total = self.hits + self.disk_hits + self.misses
+        if total == 0:
+            return
+        print_acc(
+            f" - {name}: {self.hits} memory hits, {self.disk_hits} disk hits, {self.misses} encoded "
+            f"({(self.hits + self.disk_hits) / total * 100:.1f}% reused)"
+        )
+
+
+_caches: Dict[Optional[str], TextEmbeddingCache] = {}
+_caches_lock = threading.Lock()
+
+
+def get_text_embedding_cache(cache_dir: Optional[str], max_memory_mb: float = 1024) -> TextEmbeddingCache:
+    # one cache per folder per process, so every dataset and the sampler share the memory tier
+    if cache_dir is not None:
+        cache_dir = os.path.abspath(cache_dir)
+    with _caches_lock:
+        if cache_dir not in _caches:
+            _caches[cache_dir] = TextEmbeddingCache(cache_dir, max_memory_mb=max_memory_mb)
+        return _caches[cache_dir]
@@ -25,6 +25,18 @@ function all<T = any>(db: sqlite3.Database, sql: string, params: any[] = []) {
   });
 }
 
+// must match ROLLUP_RESOLUTIONS in toolkit/logging_aitk.py
+const ROLLUP_RESOLUTIONS = [10, 100, 1000, 10000];
+
+function get<T = any>(db: sqlite3.Database, sql: string, params: any[] = []) {
+  return new Promise<T | undefined>((resolve, reject) => {
+    db.get(sql, params, (err, row) => {
+      if (err) reject(err);
+      else resolve(row as T | undefined);
+    });
+  });
+}
+
 function closeDb(db: sqlite3.Database) {
   return new Promise<void>((resolve, reject) => {
     db.close((err) => (err ? reject(err) : resolve()));
@@ -59,12 +71,100 @@ export async function GET(request: NextRequest, { params }: { params: { jobID: s
     const keysRows = await all<{ key: string }>(db, `SELECT key FROM metric_keys ORDER BY key ASC`);
     const keys = keysRows.map((r) => r.key);
 
-    const points = await all<{
-      step: number;
-      wall_time: number;
-      value: number | null;
-      value_text: string | null;
+    // pick the finest resolution that fits the requested window in the limit. Older logs without
+    // rollups, and explicit strides, read the raw rows like before
+    let resolution = 1;
+    const range = await get<{ first_seen_step: number; last_seen_step: number }>(
+      db,
+      `SELECT first_seen_step, last_seen_step FROM metric_keys WHERE key = ?`,
+      [key],
+    );
+    if (stride === 1 && range) {
+      const hasRollups = await get(
+        db,
+        `SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'metric_rollups'`,
+      );
+      if (hasRollups) {
+        const windowStart = sinceStep != null ? sinceStep + 1 : range.first_seen_step;
+        const windowSize = range.last_seen_step - windowStart + 1;
+        for (const res of ROLLUP_RESOLUTIONS) {
+          if (windowSize / resolution <= limit) break;
+          resolution = res;
+        }
+      }
+    }
+
+    if (resolution === 1) {
+      const points = await all<{
+        step: number;
+        wall_time: number;
+        value: number | null;
+        value_text: string | null;
+      }>(
+        db,
+        `
+        SELECT
+          m.step AS step,
+          s.wall_time AS wall_time,
+          m.value_real AS value,
+          m.value_text AS value_text
+        FROM metrics m
+        JOIN steps s ON s.step = m.step
+        WHERE m.key = ?
+          AND (? IS NULL OR m.step > ?)
+          AND (m.step % ?) = 0
+        ORDER BY m.step ASC
+        LIMIT ?
+        `,
+        [key, sinceStep, sinceStep, stride, limit]
+      );
+
+      return NextResponse.json({
+        key,
+        keys,
+        resolution,
+        points: points.map((p) => ({
+          step: p.step,
+          wall_time: p.wall_time,
+          value: p.value ?? (p.value_text ? Number(p.value_text) : null),
+        })),
+      });
+    }
+
+    // only complete buckets are rolled up, the partial bucket at the end is sent as raw rows so the
+    // live tail of the chart is exact and polling with since_step picks up from the last raw step
+    const completeBuckets = Math.floor((range!.last_seen_step + 1) / resolution);
+
+    const buckets = await all<{
+      last_step: number;
+      wall_time: number | null;
+      count: number;
+      sum: number;
+      min: number;
+      max: number;
     }>(
+      db,
+      `
+      SELECT
+        r.last_step AS last_step,
+        s.wall_time AS wall_time,
+        r.count AS count,
+        r.sum AS sum,
+        r.min AS min,
+        r.max AS max
+      FROM metric_rollups r
+      LEFT JOIN steps s ON s.step = r.last_step
+      WHERE r.key = ?
+        AND r.resolution = ?
+        AND r.bucket < ?
+        AND (? IS NULL OR r.first_step > ?)
+      ORDER BY r.bucket ASC
+      LIMIT ?
+      `,
+      [key, resolution, completeBuckets, sinceStep, sinceStep, limit]
+    );
+
+    const tail = await all<{ step: number; wall_time: number; value: number | null; value_text: string | null }>(
       db,
       `
       SELECT
@@ -75,22 +175,32 @@ export async function GET(request: NextRequest, { params }: { params: { jobID: s
       FROM metrics m
       JOIN steps s ON s.step = m.step
       WHERE m.key = ?
+        AND m.step >= ?
         AND (? IS NULL OR m.step > ?)
-        AND (m.step % ?) = 0
       ORDER BY m.step ASC
       LIMIT ?
       `,
-      [key, sinceStep, sinceStep, stride, limit]
+      [key, completeBuckets * resolution, sinceStep, sinceStep, Math.max(0, limit - buckets.length)]
     );
 
     return NextResponse.json({
       key,
       keys,
-      points: points.map((p) => ({
-        step: p.step,
-        wall_time: p.wall_time,
-        value: p.value ?? (p.value_text ? Number(p.value_text) : null),
-      })),
+      resolution,
+      points: [
+        ...buckets.map((b) => ({
+          step: b.last_step,
+          wall_time: b.wall_time ?? undefined,
+          value: b.count > 0 ? b.sum / b.count : null,
+          min: b.min,
+          max: b.max,
+        })),
+        ...tail.map((p) => ({
+          step: p.step,
+          wall_time: p.wall_time,
+          value: p.value ?? (p.value_text ? Number(p.value_text) : null),
+        })),
+      ],
     });
   } finally {
     await closeDb(db);
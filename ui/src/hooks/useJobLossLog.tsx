@@ -7,6 +7,9 @@ export interface LossPoint {
   step: number;
   wall_time?: number;
   value: number | null;
+  // set when the point is the mean of a downsampled bucket of steps
+  min?: number;
+  max?: number;
 }
 
 type SeriesMap = Record<string, LossPoint[]>;